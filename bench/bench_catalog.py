@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2019 Erik Mossberg
+
+This file is part of SeriousBusiness.
+
+SeriousBusiness is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+SeriousBusiness is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import io
+import argparse
+import tempfile
+import contextlib
+import time
+
+# synth_library puts srv/ on the path.
+from synth_library import generate_library
+from media_library import MediaLibrary
+
+
+def timed_start(directory, **kwargs):
+    # Discovery is chatty, keep it out of the results.
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        library = MediaLibrary(directory, **kwargs)
+        elapsed = time.perf_counter() - start
+    return elapsed, len(library.get_clips())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cold start with and without a library catalog.')
+    parser.add_argument('-n', '--clips', type=int, default=10000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        library_dir = os.path.join(tmpdir, 'media')
+        catalog_path = os.path.join(tmpdir, 'catalog.db')
+        generate_library(library_dir, args.clips)
+
+        plain, count = timed_start(library_dir)
+        print("no catalog:      %8.3f s  (%d clips)" % (plain, count))
+
+        rebuild, count = timed_start(library_dir, catalog_path=catalog_path, rebuild_catalog=True)
+        print("catalog rebuild: %8.3f s  (%d clips)" % (rebuild, count))
+
+        warm, count = timed_start(library_dir, catalog_path=catalog_path)
+        print("catalog warm:    %8.3f s  (%d clips)" % (warm, count))
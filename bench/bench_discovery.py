@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2019 Erik Mossberg
+
+This file is part of SeriousBusiness.
+
+SeriousBusiness is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+SeriousBusiness is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import argparse
+import tempfile
+import time
+
+# synth_library puts srv/ on the path.
+from synth_library import generate_library
+from bench_results import collect_results, save_results, load_results, compare_results, print_results
+from media_library import MediaLibrary
+from media_clip import MediaClip
+from dir_index import DirectoryIndex
+from content_hash import content_hashes
+
+
+def best_of(rounds, func):
+    """
+    Shortest of rounds timed calls of func, in seconds.
+    """
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def entry(seconds, ops):
+    return {'seconds': round(seconds, 6), 'ops': ops,
+            'per_op_us': round(seconds / ops * 1e6, 3)}
+
+
+def run(library_dir, rounds):
+    results = {}
+    library = MediaLibrary(library_dir)
+    clips = library.get_clips()
+    n = len(clips)
+
+    results['discover'] = entry(best_of(rounds, library.discover), n)
+    results['rescan_unchanged'] = entry(best_of(rounds, library.rescan), n)
+
+    dir_index = DirectoryIndex(library_dir)
+    mp4s = [os.path.join(library_dir, name) for name in dir_index.files_with_ext('.mp4')]
+    results['content_hash'] = entry(best_of(rounds, lambda: content_hashes(mp4s, workers=4)), len(mp4s))
+
+    fields = [clip.to_fields() for clip in clips]
+
+    def infer_all():
+        for uid, filename, title, _ in fields:
+            MediaClip.from_fields((uid, filename, title, None)).infer_thumbnail(dir_index=dir_index)
+    results['infer_thumbnail'] = entry(best_of(rounds, infer_all), n)
+
+    titles = [clip.get_title() for clip in clips]
+
+    def check_all():
+        for title in titles:
+            MediaClip.check_string_safe(title)
+    results['check_string_safe'] = entry(best_of(rounds, check_all), n)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Library discovery microbenchmarks.')
+    parser.add_argument('-n', '--clips', type=int, default=10000)
+    parser.add_argument('--mp4-size-mb', type=int, default=0,
+                        help='Sparse MP4s of this size, so discovery probes them.')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--json', help='Write results to this file.')
+    parser.add_argument('--compare', help='Compare with results of an earlier run.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        library_dir = os.path.join(tmpdir, 'media')
+        generate_library(library_dir, args.clips, mp4_size=args.mp4_size_mb * 1024 * 1024)
+        results = run(library_dir, args.rounds)
+
+    print_results(results)
+    data = collect_results('discovery', vars(args), results)
+    if args.json:
+        save_results(args.json, data)
+    if args.compare:
+        print('\n'.join(compare_results(load_results(args.compare), data)))
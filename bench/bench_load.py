@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2019 Erik Mossberg
+
+This file is part of SeriousBusiness.
+
+SeriousBusiness is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+SeriousBusiness is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import random
+import shlex
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+import urllib.parse
+import concurrent.futures
+
+# synth_library puts srv/ on the path.
+from synth_library import generate_library
+from bench_results import (latency_summary, collect_results, save_results, load_results,
+                           compare_results, print_results)
+
+SCENARIOS = ('index', 'fronter', 'full', 'range')
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SRV_MAIN = os.path.join(ROOT_DIR, 'srv', 'srv_main.py')
+
+READ_CHUNK = 256 * 1024
+
+
+def fetch_targets(host, port):
+    """
+    (uid, filename) of every clip, paging through /api/clips.
+    """
+    conn = http.client.HTTPConnection(host, port, timeout=30)
+    targets = []
+    offset = 0
+    while offset is not None:
+        conn.request('GET', '/api/clips?offset=%d&limit=200' % offset)
+        response = conn.getresponse()
+        if response.status != 200:
+            raise IOError("Clip feed returned %d" % response.status)
+        feed = json.loads(response.read().decode('utf-8'))
+        targets += [(clip['uid'], clip['filename']) for clip in feed['clips']]
+        offset = feed['next_offset']
+    conn.close()
+    return targets
+
+
+def content_path(filename):
+    fkey = base64.b64encode(filename.encode('ascii')).decode('ascii')
+    return '/serve_content?fkey=%s' % urllib.parse.quote(fkey)
+
+
+class Client(object):
+
+    def __init__(self, host, port, scenario, targets, range_bytes, seed):
+        """
+        One keep-alive connection issuing requests of a scenario back to
+        back, each for a random clip.
+        """
+        self._host = host
+        self._port = port
+        self._scenario = scenario
+        self._targets = targets
+        self._range_bytes = range_bytes
+        self._random = random.Random(seed)
+        self._sizes = {}
+        self._conn = None
+        self._buf = bytearray(READ_CHUNK)
+        self.latencies = []
+        self.nbytes = 0
+        self.errors = 0
+
+    def _request(self, method, path, headers):
+        """
+        (status, headers, body bytes read), reconnecting as needed.
+        """
+        if self._conn is None:
+            self._conn = http.client.HTTPConnection(self._host, self._port, timeout=60)
+        try:
+            self._conn.request(method, path, headers=headers)
+            response = self._conn.getresponse()
+            nbytes = 0
+            while True:
+                n = response.readinto(self._buf)
+                if not n:
+                    break
+                nbytes += n
+            return response.status, response, nbytes
+        except (OSError, http.client.HTTPException):
+            self._conn.close()
+            self._conn = None
+            raise
+
+    def _size_of(self, path):
+        size = self._sizes.get(path)
+        if size is None:
+            _, response, _ = self._request('HEAD', path, {})
+            size = self._sizes[path] = int(response.getheader('Content-Length'))
+        return size
+
+    def _next(self):
+        uid, filename = self._random.choice(self._targets)
+        if self._scenario == 'index':
+            return '/', {}, 200
+        if self._scenario == 'fronter':
+            return '/fronter?clip_uid=%s' % urllib.parse.quote(uid or filename), {}, 200
+        path = content_path(filename)
+        if self._scenario == 'full':
+            return path, {}, 200
+        size = self._size_of(path)
+        start = self._random.randrange(max(1, size - self._range_bytes))
+        end = min(size, start + self._range_bytes) - 1
+        return path, {'Range': 'bytes=%d-%d' % (start, end)}, 206
+
+    def run(self, until):
+        while time.perf_counter() < until:
+            try:
+                path, headers, expected = self._next()
+                start = time.perf_counter()
+                status, _, nbytes = self._request('GET', path, headers)
+                elapsed = time.perf_counter() - start
+            except (OSError, http.client.HTTPException):
+                self.errors += 1
+                continue
+            if status != expected:
+                self.errors += 1
+                continue
+            self.latencies.append(elapsed)
+            self.nbytes += nbytes
+        if self._conn is not None:
+            self._conn.close()
+
+
+def client_process(host, port, scenario, targets, range_bytes, connections, duration, seed):
+    """
+    Run connections clients in threads for duration seconds. Returns
+    (latencies, bytes, errors, seconds).
+    """
+    clients = [Client(host, port, scenario, targets, range_bytes, seed * 1000 + i)
+               for i in range(connections)]
+    start = time.perf_counter()
+    until = start + duration
+    threads = [threading.Thread(target=client.run, args=(until,)) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    latencies = [latency for client in clients for latency in client.latencies]
+    return (latencies, sum(c.nbytes for c in clients), sum(c.errors for c in clients), elapsed)
+
+
+def run_scenario(pool, processes, host, port, scenario, targets, args, duration):
+    """
+    Spread args.concurrency connections over the client processes.
+    """
+    shares = [args.concurrency // processes + (1 if i < args.concurrency % processes else 0)
+              for i in range(processes)]
+    futures = [pool.submit(client_process, host, port, scenario, targets, args.range_kb * 1024,
+                           share, duration, i + 1)
+               for i, share in enumerate(shares) if share]
+    latencies = []
+    nbytes = 0
+    errors = 0
+    elapsed = 0.0
+    for future in futures:
+        part, part_bytes, part_errors, part_elapsed = future.result()
+        latencies += part
+        nbytes += part_bytes
+        errors += part_errors
+        elapsed = max(elapsed, part_elapsed)
+    return latency_summary(latencies, elapsed, nbytes, errors)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(library_dir, port, server_args):
+    """
+    srv_main.py serving library_dir, once it answers.
+    """
+    command = [sys.executable, SRV_MAIN, '-m', library_dir, '-p', str(port)] + server_args
+    server = subprocess.Popen(command, cwd=ROOT_DIR, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("Server exited with %d" % server.returncode)
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/')
+            conn.getresponse().read()
+            conn.close()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("Server did not start")
+
+
+def stop_server(server):
+    server.terminate()
+    try:
+        server.wait(10)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+def run(host, port, args):
+    targets = fetch_targets(host, port)
+    if not targets:
+        raise RuntimeError("The library is empty")
+
+    processes = max(1, min(args.client_processes, args.concurrency))
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+        for scenario in args.scenarios:
+            if args.warmup > 0:
+                run_scenario(pool, processes, host, port, scenario, targets, args, args.warmup)
+            result = run_scenario(pool, processes, host, port, scenario, targets, args, args.duration)
+            result['concurrency'] = args.concurrency
+            results['%s_c%d' % (scenario, args.concurrency)] = result
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='HTTP load driver: latency and throughput per route.')
+    parser.add_argument('--url', help='Server to load, e.g. http://127.0.0.1:8080. '
+                        'By default a server for a synthetic library is started.')
+    parser.add_argument('-n', '--clips', type=int, default=200,
+                        help='Clips in the synthetic library.')
+    parser.add_argument('--mp4-size-mb', type=int, default=32,
+                        help='Size of the sparse synthetic MP4s.')
+    parser.add_argument('--server-args', default='',
+                        help="Extra srv_main.py arguments, e.g. '--engine asyncio'.")
+    parser.add_argument('-c', '--concurrency', type=int, default=16,
+                        help='Concurrent connections.')
+    parser.add_argument('--client-processes', type=int, default=min(4, os.cpu_count() or 1),
+                        help='Processes the connections are spread over.')
+    parser.add_argument('-d', '--duration', type=float, default=10.0,
+                        help='Seconds per scenario.')
+    parser.add_argument('--warmup', type=float, default=1.0,
+                        help='Unrecorded seconds before each scenario.')
+    parser.add_argument('--range-kb', type=int, default=1024,
+                        help='Size of ranged requests.')
+    parser.add_argument('-s', '--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--json', help='Write results to this file.')
+    parser.add_argument('--compare', help='Compare with results of an earlier run.')
+    args = parser.parse_args()
+
+    if args.url:
+        parts = urllib.parse.urlsplit(args.url)
+        results = run(parts.hostname, parts.port or 80, args)
+    else:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            library_dir = os.path.join(tmpdir, 'media')
+            generate_library(library_dir, args.clips, mp4_size=args.mp4_size_mb * 1024 * 1024)
+            port = free_port()
+            server = start_server(library_dir, port, shlex.split(args.server_args))
+            try:
+                results = run('127.0.0.1', port, args)
+            finally:
+                stop_server(server)
+
+    print_results(results)
+    data = collect_results('load', vars(args), results)
+    if args.json:
+        save_results(args.json, data)
+    if args.compare:
+        print('\n'.join(compare_results(load_results(args.compare), data)))
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2019 Erik Mossberg
+
+This file is part of SeriousBusiness.
+
+SeriousBusiness is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+SeriousBusiness is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import io
+import gc
+import argparse
+import tempfile
+import contextlib
+import tracemalloc
+
+# synth_library puts srv/ on the path.
+from synth_library import generate_library
+from media_library import MediaLibrary
+from shared_library import SharedLibrary, SnapshotPublisher
+from srv_main import SeriousServer, build_parser, MAX_PAGE_SIZE
+
+
+def traced(build):
+    """
+    (result, bytes still allocated once build() returned).
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        # Discovery is chatty, keep it out of the results.
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = build()
+        gc.collect()
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, current
+
+
+def scroll_all(server):
+    """
+    Render every page of the clip feed, as a client scrolling to the
+    end would, filling the tile and page caches.
+    """
+    offset = 0
+    total = len(server.get_media_library().get_clips())
+    while offset < total:
+        server.get_clip_feed_page(offset, MAX_PAGE_SIZE)
+        offset += MAX_PAGE_SIZE
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Resident memory per clip, measured with tracemalloc.')
+    parser.add_argument('-n', '--clips', type=int, default=20000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        library_dir = os.path.join(tmpdir, 'media')
+        generate_library(library_dir, args.clips)
+
+        library, scanning = traced(lambda: MediaLibrary(library_dir))
+        count = len(library.get_clips())
+        print("scanning library:  %8.0f bytes/clip  (%d clips)" % (scanning / count, count))
+
+        publisher = SnapshotPublisher(os.path.join(tmpdir, 'snapshot.json'))
+        publisher.publish(library)
+        # Measured on its own, as in a worker process.
+        del library
+        shared, reading = traced(lambda: SharedLibrary(publisher.get_path(), library_dir))
+        print("shared library:    %8.0f bytes/clip" % (reading / count))
+
+        server_args = build_parser().parse_args(['-m', library_dir])
+        server = SeriousServer(server_args, shared)
+        _, scrolled = traced(lambda: scroll_all(server))
+        print("tiles and pages:   %8.0f bytes/clip" % (scrolled / count))
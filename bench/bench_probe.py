@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2019 Erik Mossberg
+
+This file is part of SeriousBusiness.
+
+SeriousBusiness is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+SeriousBusiness is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import argparse
+import resource
+import tempfile
+import time
+
+# synth_library puts srv/ on the path.
+from synth_library import write_sparse_mp4
+from mp4_probe import probe_mp4
+
+
+def probe_all(paths):
+    faults = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    infos = [probe_mp4(path) for path in paths]
+    elapsed = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    page_faults = (after.ru_minflt - faults.ru_minflt) + (after.ru_majflt - faults.ru_majflt)
+    return elapsed, page_faults, infos
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='MP4 box probing over a corpus of large sparse files.')
+    parser.add_argument('-n', '--files', type=int, default=200)
+    parser.add_argument('--size-gb', type=float, default=4.0)
+    args = parser.parse_args()
+
+    size = int(args.size_gb * 1024 ** 3)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = []
+        for i in range(args.files):
+            paths.append(os.path.join(tmpdir, 'clip%05d.mp4' % i))
+            write_sparse_mp4(paths[-1], size, moov_first=i % 2 == 1)
+
+        for label in ['first pass', 'second pass']:
+            elapsed, page_faults, infos = probe_all(paths)
+            assert all(info is not None and info.duration for info in infos)
+            print("%-12s %d files of %.1f GiB: %8.3f ms/file, %5.1f page faults/file" % (
+                label, len(paths), args.size_gb, 1000 * elapsed / len(paths),
+                page_faults / len(paths)))
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2019 Erik Mossberg
+
+This file is part of SeriousBusiness.
+
+SeriousBusiness is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+SeriousBusiness is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+
+# Compared across runs, with whether a larger value is better.
+COMPARED = {
+    'requests_per_s': True,
+    'mb_per_s': True,
+    'p50_ms': False,
+    'p99_ms': False,
+    'errors': False,
+    'per_op_us': False,
+}
+
+
+def percentile(sorted_values, fraction):
+    """
+    Nearest rank percentile of an ascending list, None if empty.
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(fraction * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def latency_summary(latencies, elapsed, nbytes, errors):
+    """
+    Result entry for a load test scenario. latencies in seconds.
+    """
+    latencies = sorted(latencies)
+    as_ms = lambda value: None if value is None else round(value * 1000, 3)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'requests_per_s': round(len(latencies) / elapsed, 1),
+        'mb_per_s': round(nbytes / elapsed / 1e6, 1),
+        'p50_ms': as_ms(percentile(latencies, 0.50)),
+        'p90_ms': as_ms(percentile(latencies, 0.90)),
+        'p99_ms': as_ms(percentile(latencies, 0.99)),
+        'max_ms': as_ms(latencies[-1] if latencies else None),
+    }
+
+
+def git_revision():
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=root,
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def collect_results(bench, params, results):
+    """
+    Results of a run, along with what they were measured on.
+    """
+    return {
+        'bench': bench,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'params': params,
+        'results': results,
+    }
+
+
+def save_results(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare_results(old, new):
+    """
+    Lines comparing the results of two runs of the same bench.
+    """
+    lines = ["%-28s %-15s %12s %12s %9s" % ('', '', old.get('revision') or 'old',
+                                           new.get('revision') or 'new', 'change')]
+    for name, entry in sorted(new['results'].items()):
+        previous = old['results'].get(name)
+        if previous is None:
+            continue
+        for key, larger_is_better in sorted(COMPARED.items()):
+            before = previous.get(key)
+            after = entry.get(key)
+            if before is None or after is None:
+                continue
+            change = ''
+            if before:
+                delta = (after - before) / before * 100
+                better = (delta > 0) == larger_is_better
+                change = '%+7.1f%%%s' % (delta, '' if abs(delta) < 5 else (' +' if better else ' -'))
+            lines.append("%-28s %-15s %12s %12s %9s" % (name, key, before, after, change))
+    return lines
+
+
+def print_results(results):
+    for name, entry in sorted(results.items()):
+        print("%-28s %s" % (name, '  '.join('%s=%s' % item for item in sorted(entry.items()))))
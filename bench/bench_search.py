@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2019 Erik Mossberg
+
+This file is part of SeriousBusiness.
+
+SeriousBusiness is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+SeriousBusiness is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import gc
+import itertools
+import random
+import argparse
+import resource
+import time
+
+# synth_library puts srv/ on the path.
+import synth_library
+from bench_results import (percentile, collect_results, save_results, load_results,
+                           compare_results, print_results)
+from media_clip import MediaClip
+from mp4_probe import Mp4Info
+from search_index import SearchIndex
+
+CODECS = ['avc1.64001e', 'avc1.4d401f', 'hvc1.1.6.L93', 'vp09.00.10.08']
+HEIGHTS = [360, 480, 720, 1080, 2160]
+
+
+def synth_words(count, rnd):
+    """
+    Pronounceable pseudo words, so prefixes and typos behave like in
+    real titles.
+    """
+    consonants = 'bcdfghjklmnprstvz'
+    vowels = 'aeiou'
+    words = set()
+    while len(words) < count:
+        length = rnd.randint(2, 5)
+        words.add(''.join(rnd.choice(consonants) + rnd.choice(vowels) for _ in range(length)))
+    return sorted(words)
+
+
+def synth_clips(count, words, rnd):
+    # Zipf-like, a few words are in many titles, most in few.
+    cum_weights = list(itertools.accumulate(1.0 / (rank + 1) for rank in range(len(words))))
+    clips = []
+    for i in range(count):
+        title = ' '.join(rnd.choices(words, cum_weights=cum_weights, k=rnd.randint(3, 7))).capitalize()
+        info = Mp4Info(duration=rnd.uniform(10, 7200), height=rnd.choice(HEIGHTS),
+                       video_codec=rnd.choice(CODECS))
+        clips.append(MediaClip.from_fields(('uid%07d' % i, 'clip%07d.mp4' % i, title, None), info))
+    return clips
+
+
+def typo(word, rnd):
+    i = rnd.randrange(len(word) - 1)
+    return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+
+
+def queries(kind, words, count, rnd):
+    # Rare words are picked from the tail of the vocabulary.
+    rare = words[len(words) // 10:]
+    for _ in range(count):
+        if kind == 'word':
+            yield rnd.choice(rare)
+        elif kind == 'two_words':
+            yield '%s %s' % (rnd.choice(words[:200]), rnd.choice(rare))
+        elif kind == 'prefix':
+            yield rnd.choice(rare)[:5]
+        elif kind == 'typo':
+            yield typo(rnd.choice([w for w in rare[:2000] if len(w) >= 6]), rnd)
+        elif kind == 'facet':
+            yield '%s codec:hvc1 height:720' % rnd.choice(rare)
+        elif kind == 'common_word':
+            yield rnd.choice(words[:10])
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Search index build, update and query latency.')
+    parser.add_argument('-n', '--clips', type=int, default=1000000)
+    parser.add_argument('--words', type=int, default=50000)
+    parser.add_argument('-q', '--queries', type=int, default=2000,
+                        help='Queries per kind.')
+    parser.add_argument('--json', help='Write results to this file.')
+    parser.add_argument('--compare', help='Compare with results of an earlier run.')
+    args = parser.parse_args()
+
+    rnd = random.Random(1)
+    words = synth_words(args.words, rnd)
+    clips = synth_clips(args.clips, words, rnd)
+    gc.collect()
+    rss_before = max_rss_mb()
+
+    results = {}
+    index = SearchIndex()
+    start = time.perf_counter()
+    index.update(clips)
+    results['build'] = {'seconds': round(time.perf_counter() - start, 3),
+                        'rss_mb': round(max_rss_mb() - rss_before, 1)}
+
+    # A rescan that replaced a hundred clips.
+    changed = list(clips)
+    for i in rnd.sample(range(len(changed)), 100):
+        changed[i] = MediaClip.from_fields(changed[i].to_fields(), changed[i].get_media_info())
+    start = time.perf_counter()
+    index.update(changed)
+    results['update_100'] = {'seconds': round(time.perf_counter() - start, 3)}
+
+    for kind in ('word', 'two_words', 'prefix', 'typo', 'facet', 'common_word'):
+        latencies = []
+        hits = 0
+        for query in queries(kind, words, args.queries, rnd):
+            start = time.perf_counter()
+            found, total = index.search(query, 0, 48)
+            latencies.append(time.perf_counter() - start)
+            hits += total
+        latencies.sort()
+        results['query_' + kind] = {
+            'p50_ms': round(percentile(latencies, 0.5) * 1000, 4),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 4),
+            'mean_matches': round(hits / len(latencies), 1),
+        }
+
+    print_results(results)
+    data = collect_results('search', vars(args), results)
+    if args.json:
+        save_results(args.json, data)
+    if args.compare:
+        print('\n'.join(compare_results(load_results(args.compare), data)))
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2019 Erik Mossberg
+
+This file is part of SeriousBusiness.
+
+SeriousBusiness is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+SeriousBusiness is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import socket
+import argparse
+import tempfile
+import multiprocessing
+import time
+
+# synth_library puts srv/ on the path.
+import synth_library
+from media_stream import FileRegion
+
+# cherrypy.lib.static.serve_file copies in chunks of this size.
+SERVE_FILE_CHUNK = 64 * 1024
+
+
+def drain(port):
+    """
+    Client side, in its own process: read and discard until EOF.
+    """
+    sock = socket.create_connection(('127.0.0.1', port))
+    buf = bytearray(1024 * 1024)
+    while sock.recv_into(buf):
+        pass
+    sock.close()
+
+
+def send_copy(conn, fileobj, size):
+    region = FileRegion(fileobj, 0, size)
+    for chunk in region.read_chunks(SERVE_FILE_CHUNK):
+        conn.sendall(chunk)
+
+
+def send_sendfile(conn, fileobj, size):
+    conn.sendfile(fileobj, 0, size)
+
+
+def run(sender, path, rounds):
+    size = os.path.getsize(path)
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    port = listener.getsockname()[1]
+
+    wall = 0.0
+    cpu = 0.0
+    for _ in range(rounds):
+        reader = multiprocessing.Process(target=drain, args=(port,))
+        reader.start()
+        conn, _ = listener.accept()
+        with open(path, 'rb') as fileobj:
+            start_wall = time.perf_counter()
+            start_cpu = time.thread_time()
+            sender(conn, fileobj, size)
+            cpu += time.thread_time() - start_cpu
+            wall += time.perf_counter() - start_wall
+        conn.close()
+        reader.join()
+
+    listener.close()
+    gbits = size * 8 * rounds / 1e9
+    return gbits / wall, cpu / gbits
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Userland copy versus sendfile streaming.')
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile(suffix='.mp4') as f:
+        block = os.urandom(1024 * 1024)
+        for _ in range(args.size_mb):
+            f.write(block)
+        f.flush()
+
+        for name, sender in [('userland copy', send_copy), ('sendfile', send_sendfile)]:
+            throughput, cpu_per_gbit = run(sender, f.name, args.rounds)
+            print("%-14s %7.2f Gbit/s  %6.3f CPU s/Gbit" % (name, throughput, cpu_per_gbit))
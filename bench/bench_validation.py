@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2019 Erik Mossberg
+
+This file is part of SeriousBusiness.
+
+SeriousBusiness is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+SeriousBusiness is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import random
+import time
+
+# synth_library puts srv/ on the path.
+import synth_library
+from media_clip import MediaClip
+
+VALID = MediaClip.VALID_STR_CHARS
+
+
+def char_by_char_safe(string):
+    """
+    Verdict of the char by char check_string_safe this replaced.
+    """
+    if len(string) == 0:
+        return False
+    for ch in string:
+        if ch not in VALID:
+            return False
+    return True
+
+
+def char_by_char_censor(string):
+    toreturn = ""
+    for ch in string:
+        if ch in VALID:
+            toreturn += ch
+    return toreturn
+
+
+def fast_safe(string):
+    try:
+        MediaClip.check_string_safe(string)
+        return True
+    except TypeError:
+        return False
+
+
+def synth_titles(count, invalid_share, seed=1):
+    """
+    Titles of 5 to 60 chars, invalid_share of them with a char outside
+    the valid set.
+    """
+    rnd = random.Random(seed)
+    bad = '<>&/\'"\xe9☃'
+    titles = []
+    for _ in range(count):
+        title = [rnd.choice(VALID) for _ in range(rnd.randint(5, 60))]
+        if rnd.random() < invalid_share:
+            title[rnd.randrange(len(title))] = rnd.choice(bad)
+        titles.append(''.join(title))
+    return titles
+
+
+def timed(func, titles):
+    start = time.perf_counter()
+    result = func(titles)
+    return time.perf_counter() - start, result
+
+
+def report(name, elapsed, count):
+    print("%-22s %8.3f s  %10.0f titles/s" % (name, elapsed, count / elapsed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Title validation throughput.')
+    parser.add_argument('-n', '--titles', type=int, default=1000000)
+    parser.add_argument('--invalid-share', type=float, default=0.01)
+    parser.add_argument('--batch', type=int, default=1000,
+                        help='Titles per check_strings_safe call.')
+    args = parser.parse_args()
+
+    titles = synth_titles(args.titles, args.invalid_share)
+    n = len(titles)
+
+    slow, expected = timed(lambda ts: [char_by_char_safe(t) for t in ts], titles)
+    report("char by char", slow, n)
+    fast, verdicts = timed(lambda ts: [fast_safe(t) for t in ts], titles)
+    report("check_string_safe", fast, n)
+    batched, batch_verdicts = timed(
+        lambda ts: [v for i in range(0, len(ts), args.batch)
+                    for v in MediaClip.check_strings_safe(ts[i:i + args.batch])], titles)
+    report("check_strings_safe", batched, n)
+
+    slow_censor, censored = timed(lambda ts: [char_by_char_censor(t) for t in ts], titles)
+    report("censor char by char", slow_censor, n)
+    fast_censor, fast_censored = timed(lambda ts: [MediaClip.censor_string_chs(t) for t in ts], titles)
+    report("censor_string_chs", fast_censor, n)
+
+    assert verdicts == expected and batch_verdicts == expected and fast_censored == censored
+    print("Identical verdicts for %d titles, %d rejected." % (n, expected.count(False)))
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2019 Erik Mossberg
+
+This file is part of SeriousBusiness.
+
+SeriousBusiness is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+SeriousBusiness is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import json
+import struct
+import argparse
+import functools
+
+SRV_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'srv')
+if SRV_DIR not in sys.path:
+    sys.path.insert(0, SRV_DIR)
+
+
+SAMPLE_CLIP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'media',
+                           'Simple landscape flyover.mp4')
+
+
+@functools.lru_cache()
+def sample_boxes(sample):
+    """
+    {b'ftyp': box, b'moov': box} of a sample clip.
+    """
+    from mp4_probe import iter_boxes
+
+    with open(sample, 'rb') as f:
+        data = f.read()
+    return dict((box_type, data[payload - 8:end])
+                for box_type, payload, end in iter_boxes(data, 0, len(data))
+                if box_type in (b'ftyp', b'moov'))
+
+
+def write_sparse_mp4(path, size, moov_first=False, sample=SAMPLE_CLIP, tag=b''):
+    """
+    Write an MP4 of size bytes, with the box layout of a real clip.
+
+    ftyp and moov are copied from sample, the mdat in between is a hole
+    in a sparse file, so multi-GB files cost no disk space. The moov is
+    at the end, as most encoders write it, unless moov_first. Only
+    meant for reading box structure, sample offsets are not adjusted.
+
+    A tag is written in a free box after the ftyp, so files can differ
+    in content.
+    """
+    boxes = sample_boxes(sample)
+    free = struct.pack('>I4s', 8 + len(tag), b'free') + tag if tag else b''
+    mdat_size = size - len(boxes[b'ftyp']) - len(free) - len(boxes[b'moov'])
+    mdat_header = struct.pack('>I4sQ', 1, b'mdat', mdat_size)
+    with open(path, 'wb') as f:
+        f.write(boxes[b'ftyp'])
+        f.write(free)
+        if moov_first:
+            f.write(boxes[b'moov'])
+        f.write(mdat_header)
+        f.seek(mdat_size - len(mdat_header), os.SEEK_CUR)
+        if not moov_first:
+            f.write(boxes[b'moov'])
+        f.truncate()
+
+
+def generate_library(directory, clips, per_dir=0, mp4_size=0):
+    """
+    Fill directory with a synthetic library.
+
+    Every third clip is a raw .mp4 with a same-named thumbnail, the
+    rest have a sidecar json, half of those naming a thumbnail. With
+    per_dir > 0 clips are spread over subdirectories of per_dir clips
+    each, otherwise the library is flat, which is the only layout
+    where raw clips are served.
+
+    With mp4_size, media files are sparse MP4s of that many bytes,
+    otherwise small placeholders that do not probe. Either way, every
+    media file has distinct content.
+    """
+    os.makedirs(directory, exist_ok=True)
+    for i in range(clips):
+        subdir = directory
+        if per_dir > 0:
+            subdir = os.path.join(directory, 'd%04d' % (i // per_dir))
+            os.makedirs(subdir, exist_ok=True)
+
+        base = 'clip%07d' % i
+        if mp4_size:
+            write_sparse_mp4(os.path.join(subdir, base + '.mp4'), mp4_size, tag=base.encode('ascii'))
+        else:
+            with open(os.path.join(subdir, base + '.mp4'), 'wb') as f:
+                # Shorter than a box header, so probing passes them by.
+                f.write(i.to_bytes(7, 'big'))
+
+        if i % 3 != 2:
+            with open(os.path.join(subdir, base + '.jpg'), 'wb') as f:
+                f.write(b'\0')
+        if i % 3 == 0:
+            continue
+
+        sidecar = {
+            'id': 'uid%07d' % i,
+            'title': 'Synthetic clip number %d' % i,
+            'filename': base + '.mp4',
+        }
+        if i % 3 == 1:
+            sidecar['thumbnail'] = base + '.jpg'
+        with open(os.path.join(subdir, base + '.json'), 'w') as f:
+            json.dump(sidecar, f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic media library.')
+    parser.add_argument('directory')
+    parser.add_argument('-n', '--clips', type=int, default=1000)
+    parser.add_argument('--per-dir', type=int, default=0)
+    parser.add_argument('--mp4-size-mb', type=int, default=0,
+                        help='Write sparse MP4s of this size instead of placeholders.')
+    args = parser.parse_args()
+    generate_library(args.directory, args.clips, args.per_dir, args.mp4_size_mb * 1024 * 1024)
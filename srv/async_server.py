@@ -0,0 +1,582 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2019 Erik Mossberg
+
+This file is part of SeriousBusiness.
+
+SeriousBusiness is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+SeriousBusiness is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+import asyncio
+import base64
+import email.utils
+import http
+import http.client
+import inspect
+import json
+import os
+import socket
+import threading
+import time
+import urllib.parse
+
+import cherrypy
+
+from media_stream import FileRegion, prepare_file_response, CHUNK_SIZE
+from bandwidth import RETRY_AFTER
+from page_cache import etag_matches, accepts_gzip
+from metrics import route_label, CONTENT_TYPE as METRICS_CONTENT_TYPE
+import logs
+
+log = logs.get_logger('async_server')
+
+# A request head larger than this is refused, it is also the read
+# buffer limit of a connection.
+MAX_HEADER_BYTES = 64 * 1024
+
+# Writes wait for the client once this much is buffered, so a slow
+# client holds at most this much response data in memory.
+WRITE_HIGH_WATER = 64 * 1024
+
+# Chunk size when a file region is copied instead of sent with sendfile.
+COPY_CHUNK = 64 * 1024
+
+KEEPALIVE_TIMEOUT = 30.0
+
+# Seconds a client may take to accept more of a response before the
+# connection is dropped.
+WRITE_TIMEOUT = 60.0
+
+# File regions are sent with sendfile in pieces of at most this many
+# bytes, each within WRITE_TIMEOUT.
+SENDFILE_PIECE = 4 * 1024 * 1024
+
+
+class _Request(object):
+
+    def __init__(self, method, target, version, headers):
+        self.method = method
+        self.version = version
+        self.headers = headers
+        self.head_sent = False
+        # Recorded with the response head, for the request metrics.
+        self.status = None
+        self.head_time = None
+        self.body_bytes = 0
+        parts = urllib.parse.urlsplit(target)
+        self.path = urllib.parse.unquote(parts.path)
+        self.params = dict(urllib.parse.parse_qsl(parts.query, keep_blank_values=True))
+
+        connection = (headers.get('connection') or '').lower()
+        if version == 'HTTP/1.1':
+            self.keep_alive = connection != 'close'
+        else:
+            self.keep_alive = connection == 'keep-alive'
+        # Request bodies are never read, the next request could not be
+        # told from one.
+        if 'content-length' in headers or 'transfer-encoding' in headers:
+            self.keep_alive = False
+
+    def get_header(self, name):
+        return self.headers.get(name.lower())
+
+
+class AsyncMediaServer(object):
+
+    def __init__(self, server, static_dir, host='0.0.0.0', port=8080, reuse_port=False):
+        """
+        asyncio HTTP/1.1 server for the routes of a SeriousServer.
+
+        Media is sent with non-blocking sendfile, so a stream costs a
+        socket and a small write buffer rather than a thread. Library
+        lookups and page rendering run in the default executor.
+
+        With reuse_port, several processes can listen on the same port.
+        """
+        self._server = server
+        self._static_dir = os.path.realpath(static_dir)
+        self._host = host
+        self._port = port
+        self._reuse_port = reuse_port
+        self._listener = None
+        self._connections = 0
+        self._streams = 0
+        self._requests = 0
+
+        self._routes = {
+            '/': (self._page, server.get_index_page),
+            '/index': (self._page, server.get_index_page),
+            '/search': (self._page, server.get_search_page),
+            '/api/clips': (self._page, server.get_clip_feed_page),
+            '/api/status': (self._json, server.get_status),
+            '/api/jobs': (self._json, lambda: server.get_job_queue().get_stats()),
+            '/fronter': (self._html, server.render_fronter),
+            '/serve_content': (self._content, server.locate_content),
+            '/thumbnail': (self._located, server.locate_thumbnail),
+            '/hls': (self._playlist, server.get_hls_playlist),
+            '/hls_init': (self._located, server.locate_hls_init),
+            '/hls_segment': (self._located, server.locate_hls_segment),
+            '/metrics': (self._metrics, lambda: server.render_metrics(self.get_stats())),
+        }
+
+    async def start(self):
+        self._listener = await asyncio.start_server(
+            self._handle_connection, self._host, self._port,
+            limit=MAX_HEADER_BYTES, reuse_address=True, reuse_port=self._reuse_port)
+        self._port = self._listener.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        async with self._listener:
+            await self._listener.serve_forever()
+
+    def close(self):
+        if self._listener is not None:
+            self._listener.close()
+
+    def get_port(self):
+        return self._port
+
+    def get_stats(self):
+        return {'connections': self._connections, 'streams': self._streams,
+                'requests': self._requests}
+
+    async def _handle_connection(self, reader, writer):
+        writer.transport.set_write_buffer_limits(high=WRITE_HIGH_WATER)
+        self._connections += 1
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), KEEPALIVE_TIMEOUT)
+                except asyncio.LimitOverrunError:
+                    await self._send(writer, None, 431, [], b'Request header too large')
+                    break
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+
+                request = self._parse_head(head)
+                if request is None:
+                    await self._send(writer, None, 400, [], b'Bad request')
+                    break
+                self._requests += 1
+                keep_alive = await self._dispatch(request, writer)
+        except ConnectionError:
+            pass
+        except asyncio.TimeoutError:
+            log.debug("Dropping a client that stopped reading.")
+            writer.transport.abort()
+        finally:
+            self._connections -= 1
+            writer.close()
+
+    @staticmethod
+    def _parse_head(head):
+        try:
+            lines = head.decode('latin-1').split('\r\n')
+            method, target, version = lines[0].split(' ')
+        except ValueError:
+            return None
+        if not version.startswith('HTTP/1.'):
+            return None
+
+        headers = {}
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, sep, value = line.partition(':')
+            if not sep:
+                return None
+            headers[name.strip().lower()] = value.strip()
+        return _Request(method, target, version, headers)
+
+    async def _dispatch(self, request, writer):
+        """
+        Respond to one request. Returns whether the connection may be
+        reused.
+        """
+        started = time.perf_counter()
+        try:
+            return await self._respond(request, writer)
+        finally:
+            head_time = request.head_time or time.perf_counter()
+            self._server.get_request_metrics().observe(
+                route_label(request.path), head_time - started,
+                request.status or 500, request.body_bytes)
+
+    async def _respond(self, request, writer):
+        if request.method not in ('GET', 'HEAD'):
+            # We never read request bodies, so the connection cannot be reused.
+            request.keep_alive = False
+            await self._send(writer, request, 405, [('Allow', 'GET, HEAD')], b'Method not allowed')
+            return False
+
+        try:
+            if request.path.startswith('/static/'):
+                await self._static(request, writer)
+            else:
+                route = self._routes.get(request.path)
+                if route is None:
+                    raise cherrypy.NotFound()
+                handler, func = route
+                try:
+                    inspect.signature(func).bind(**request.params)
+                except TypeError:
+                    raise cherrypy.NotFound()
+                await handler(request, writer, func)
+        except cherrypy.HTTPRedirect as redirect:
+            # Relative to this server, whatever host CherryPy assumed.
+            location = urllib.parse.urlsplit(redirect.urls[0])._replace(scheme='', netloc='').geturl()
+            # Redirects stand in for something not there yet, e.g. a
+            # thumbnail being derived, so they are not cached.
+            await self._send(writer, request, redirect.status,
+                             [('Location', location), ('Cache-Control', 'no-cache')], b'')
+        except cherrypy.HTTPError as error:
+            message = error.args[1] if len(error.args) > 1 else None
+            await self._send(writer, request, error.status, [], (message or '').encode('utf-8'))
+        except (ConnectionError, asyncio.TimeoutError):
+            raise
+        except Exception:
+            log.exception("Failed to serve '%s'", request.path)
+            request.keep_alive = False
+            if request.head_sent:
+                # Too late for an error status, the client sees a short body.
+                return False
+            await self._send(writer, request, 500, [], b'Internal server error')
+        return request.keep_alive
+
+    async def _call(self, func, params):
+        return await asyncio.get_running_loop().run_in_executor(None, lambda: func(**params))
+
+    async def _page(self, request, writer, func, headers=()):
+        page = await self._call(func, request.params)
+        gzipped = accepts_gzip(request.get_header('Accept-Encoding'))
+        etag = page.get_etag(gzipped)
+        headers = list(headers) + [('ETag', etag), ('Vary', 'Accept-Encoding'),
+                                   ('Content-Type', page.get_content_type())]
+        if etag_matches(request.get_header('If-None-Match'), etag):
+            await self._send(writer, request, 304, headers, b'')
+        elif gzipped:
+            headers.append(('Content-Encoding', 'gzip'))
+            await self._send(writer, request, 200, headers, page.get_body(gzipped=True))
+        else:
+            await self._send(writer, request, 200, headers, page.get_body())
+
+    async def _playlist(self, request, writer, func):
+        await self._page(request, writer, func, [('Cache-Control', 'public, max-age=60')])
+
+    async def _html(self, request, writer, func):
+        text = await self._call(func, request.params)
+        await self._send(writer, request, 200, [('Content-Type', 'text/html;charset=utf-8')],
+                         text.encode('utf-8'))
+
+    async def _metrics(self, request, writer, func):
+        text = await self._call(func, request.params)
+        await self._send(writer, request, 200, [('Content-Type', METRICS_CONTENT_TYPE)],
+                         text.encode('utf-8'))
+
+    async def _json(self, request, writer, func):
+        data = await self._call(func, request.params)
+        await self._send(writer, request, 200, [('Content-Type', 'application/json')],
+                         json.dumps(data).encode('utf-8'))
+
+    async def _content(self, request, writer, func):
+        fname = await self._call(func, request.params)
+        if fname is None:
+            await self._send(writer, request, 404, [('Content-Type', 'text/plain')], b'No such fkey')
+            return
+        log.debug("Statically serving '%s'", fname)
+        await self._stream_file(request, writer, fname, [], media=True)
+
+    async def _located(self, request, writer, func):
+        path, cache_control = await self._call(func, request.params)
+        await self._stream_file(request, writer, path, [('Cache-Control', cache_control)])
+
+    async def _static(self, request, writer):
+        path = os.path.realpath(os.path.join(self._static_dir, request.path[len('/static/'):]))
+        if not path.startswith(self._static_dir + os.sep) or not os.path.isfile(path):
+            raise cherrypy.NotFound()
+        fileobj = open(path, 'rb')
+        try:
+            await self._send_file(request, writer, fileobj, os.fstat(fileobj.fileno()), path, [])
+        finally:
+            fileobj.close()
+
+    async def _stream_file(self, request, writer, path, headers, media=False):
+        loop = asyncio.get_running_loop()
+        try:
+            cached = await loop.run_in_executor(None, self._server.open_file, path)
+        except OSError:
+            raise cherrypy.NotFound()
+        try:
+            await self._send_file(request, writer, cached.fileobj, cached.st, path, headers,
+                                  self._server.get_scheduler(),
+                                  self._server.get_readahead() if media else None)
+        finally:
+            cached.release()
+
+    async def _send_file(self, request, writer, fileobj, st, path, headers, scheduler=None,
+                         readahead=None):
+        """
+        Send a file, with its body admitted and paced by scheduler and
+        with readahead past it, if given.
+        """
+        status, file_headers, body = prepare_file_response(
+            fileobj, st, path, request.get_header, request.method)
+        transfer = None
+        if scheduler is not None and request.method != 'HEAD' and body:
+            transfer = scheduler.admit(status, int(dict(file_headers)['Content-Length']))
+            if transfer is None:
+                await self._send(writer, request, 503, [('Retry-After', str(RETRY_AFTER))],
+                                 b'Too many streams, retry later')
+                return
+
+        self._write_head(writer, request, status, headers + file_headers)
+        if request.method == 'HEAD':
+            await self._drain(writer)
+            return
+
+        self._streams += 1
+        try:
+            if readahead is not None and body:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, readahead.start_stream, path, fileobj, body)
+            for item in body:
+                pieces = [item]
+                if transfer is not None and transfer.is_shaped() and isinstance(item, FileRegion):
+                    pieces = item.split(CHUNK_SIZE)
+                for piece in pieces:
+                    if transfer is not None:
+                        delay = transfer.reserve(piece.count if isinstance(piece, FileRegion) else len(piece))
+                        if delay:
+                            await self._drain(writer)
+                            await asyncio.sleep(delay)
+                    if isinstance(piece, FileRegion):
+                        await self._send_region(writer, piece)
+                    else:
+                        writer.write(piece)
+            await self._drain(writer)
+        finally:
+            self._streams -= 1
+            if transfer is not None:
+                transfer.finish()
+
+    async def _send_region(self, writer, region):
+        loop = asyncio.get_running_loop()
+        await self._drain(writer)
+        try:
+            for piece in region.split(SENDFILE_PIECE):
+                sent = await asyncio.wait_for(
+                    loop.sendfile(writer.transport, piece.fileobj, piece.offset, piece.count,
+                                  fallback=False),
+                    WRITE_TIMEOUT)
+                if sent != piece.count:
+                    raise IOError("Short sendfile, %d of %d bytes" % (sent, piece.count))
+            return
+        except asyncio.SendfileNotAvailableError:
+            pass
+
+        fd = region.fileobj.fileno()
+        offset = region.offset
+        end = region.offset + region.count
+        while offset < end:
+            chunk = await loop.run_in_executor(None, os.pread, fd, min(COPY_CHUNK, end - offset), offset)
+            if not chunk:
+                raise IOError("File shrank while being served")
+            offset += len(chunk)
+            writer.write(chunk)
+            await self._drain(writer)
+
+    @staticmethod
+    async def _drain(writer):
+        await asyncio.wait_for(writer.drain(), WRITE_TIMEOUT)
+
+    @staticmethod
+    def _write_head(writer, request, status, headers):
+        keep_alive = request is not None and request.keep_alive
+        if request is not None:
+            request.head_sent = True
+            request.status = status
+            request.head_time = time.perf_counter()
+            if request.method != 'HEAD' and status != 304:
+                request.body_bytes = int(dict(headers).get('Content-Length', 0))
+        lines = ['HTTP/1.1 %d %s' % (status, http.HTTPStatus(status).phrase),
+                 'Date: %s' % email.utils.formatdate(usegmt=True),
+                 'Connection: %s' % ('keep-alive' if keep_alive else 'close')]
+        lines += ['%s: %s' % header for header in headers]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+    async def _send(self, writer, request, status, headers, body):
+        headers = list(headers)
+        if status != 304:
+            if not any(name == 'Content-Type' for name, _ in headers):
+                headers.append(('Content-Type', 'text/plain'))
+            headers.append(('Content-Length', str(len(body))))
+        self._write_head(writer, request, status, headers)
+        if body and status != 304 and (request is None or request.method != 'HEAD'):
+            writer.write(body)
+        await self._drain(writer)
+
+
+class TestAsyncMediaServer(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        from srv_main import SeriousServer, build_parser
+        cls._server = SeriousServer(build_parser().parse_args(
+            ['-m', '../media', '--fd-cache-size', '4', '--max-streams', '2']))
+        cls._app = AsyncMediaServer(cls._server, '../static', '127.0.0.1', 0)
+        cls._loop = asyncio.new_event_loop()
+        cls._loop.run_until_complete(cls._app.start())
+        cls._thread = threading.Thread(target=cls._loop.run_forever, daemon=True)
+        cls._thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._loop.call_soon_threadsafe(cls._app.close)
+        cls._loop.call_soon_threadsafe(cls._loop.stop)
+        cls._thread.join()
+        cls._loop.close()
+
+    def _connect(self):
+        return http.client.HTTPConnection('127.0.0.1', self._app.get_port(), timeout=10)
+
+    def test_routes(self):
+        conn = self._connect()
+        conn.request('GET', '/')
+        response = conn.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertIn(b'<html', response.read())
+
+        # Same connection, kept alive.
+        fkey = base64.b64encode(b'Moving donut.mp4').decode('ascii')
+        conn.request('GET', '/serve_content?fkey=%s' % urllib.parse.quote(fkey),
+                     headers={'Range': 'bytes=4-11'})
+        response = conn.getresponse()
+        self.assertEqual(response.status, 206)
+        self.assertEqual(response.read(), b'ftypisom')
+
+        conn.request('GET', '/static/sbsns.css')
+        response = conn.getresponse()
+        self.assertEqual(response.status, 200)
+        response.read()
+
+        conn.request('GET', '/search?q=donut+%3C%3E')
+        response = conn.getresponse()
+        self.assertEqual(response.status, 200)
+        body = response.read()
+        uid = self._server._media_library.get_clip_by_filename('Moving donut.mp4').get_uid()
+        self.assertIn(('fronter?clip_uid=%s' % uid).encode('ascii'), body)
+        self.assertIn(b'value=\'donut &lt;&gt;\'', body)
+        self.assertIn(b'codec: <a', body)
+
+        for path in ('/static/../srv/srv_main.py', '/serve_content?fkey=bm9wZQ==', '/nope'):
+            conn.request('GET', path)
+            response = conn.getresponse()
+            self.assertEqual(response.status, 404)
+            response.read()
+
+        conn.request('POST', '/')
+        self.assertEqual(conn.getresponse().status, 405)
+        conn.close()
+
+    def test_request_body(self):
+        # The body is not read, so it must not be taken for the next request.
+        smuggled = b'GET /nope HTTP/1.1\r\nHost: x\r\n\r\n'
+        with socket.create_connection(('127.0.0.1', self._app.get_port()), timeout=10) as sock:
+            sock.sendall(b'GET /static/sbsns.css HTTP/1.1\r\nHost: x\r\nContent-Length: %d\r\n\r\n%s'
+                         % (len(smuggled), smuggled))
+            received = b''
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                received += data
+        self.assertTrue(received.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertIn(b'Connection: close\r\n', received)
+        self.assertNotIn(b'404', received)
+
+    def test_admission(self):
+        scheduler = self._server.get_scheduler()
+        held = [scheduler.admit(206, 100), scheduler.admit(206, 100)]
+        conn = self._connect()
+        fkey = base64.b64encode(b'Moving donut.mp4').decode('ascii')
+        conn.request('GET', '/serve_content?fkey=%s' % urllib.parse.quote(fkey),
+                     headers={'Range': 'bytes=4-11'})
+        response = conn.getresponse()
+        self.assertEqual(response.status, 503)
+        self.assertEqual(response.getheader('Retry-After'), '5')
+        response.read()
+
+        # Bodiless responses need no stream.
+        conn.request('HEAD', '/serve_content?fkey=%s' % urllib.parse.quote(fkey))
+        response = conn.getresponse()
+        self.assertEqual(response.status, 200)
+        response.read()
+
+        for transfer in held:
+            transfer.finish()
+        conn.request('GET', '/serve_content?fkey=%s' % urllib.parse.quote(fkey),
+                     headers={'Range': 'bytes=4-11'})
+        response = conn.getresponse()
+        self.assertEqual(response.status, 206)
+        self.assertEqual(response.read(), b'ftypisom')
+        self.assertEqual(scheduler.get_stats()['rejected_interactive'], 1)
+        conn.close()
+
+    def test_readahead(self):
+        readahead = self._server.get_readahead()
+        hints = readahead.get_stats()['hints']
+        conn = self._connect()
+        fkey = base64.b64encode(b'Moving donut.mp4').decode('ascii')
+        conn.request('GET', '/serve_content?fkey=%s' % urllib.parse.quote(fkey),
+                     headers={'Range': 'bytes=4-11'})
+        response = conn.getresponse()
+        self.assertEqual(response.read(), b'ftypisom')
+        conn.close()
+
+        self.assertEqual(readahead.get_stats()['hints'], hints + 1)
+        uid = self._server.get_media_library().get_clip_by_filename('Moving donut.mp4').get_uid()
+        self.assertEqual(self._server._popularity.top(1), [uid])
+        self._server.warm_cache()
+        deadline = time.monotonic() + 10
+        while readahead.get_stats()['warmed_files'] < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(readahead.get_stats()['warmed_files'], 2)
+
+    def test_metrics(self):
+        conn = self._connect()
+        conn.request('GET', '/static/sbsns.css')
+        response = conn.getresponse()
+        size = len(response.read())
+
+        conn.request('GET', '/metrics')
+        response = conn.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader('Content-Type'), METRICS_CONTENT_TYPE)
+        text = response.read().decode('utf-8')
+        self.assertIn('sbsns_http_responses_total{route="static",status="200"}', text)
+        self.assertIn('sbsns_http_request_duration_seconds_count{route="static"}', text)
+        self.assertIn('sbsns_cache_hit_ratio{cache="page"}', text)
+        self.assertIn('sbsns_discovery_last_seconds{phase="json_scan"}', text)
+        self.assertIn('sbsns_engine_connections', text)
+        bytes_served = [line for line in text.splitlines()
+                        if line.startswith('sbsns_http_response_bytes_total{route="static"}')]
+        self.assertGreaterEqual(int(bytes_served[0].split()[1]), size)
+        conn.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2019 Erik Mossberg
+
+This file is part of SeriousBusiness.
+
+SeriousBusiness is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+SeriousBusiness is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+import collections
+import threading
+import time
+
+import logs
+
+log = logs.get_logger('bandwidth')
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+PRIORITIES = (INTERACTIVE, BULK)
+
+# Range requests, and responses this small, are interactive for their
+# first this many bytes, e.g. a player reading around the playback
+# position. Past that, and for larger whole files, they are bulk.
+INTERACTIVE_BYTES = 8 * 1024 * 1024
+
+# Seconds of traffic a rate limit lets through ahead of its rate.
+BURST_SECONDS = 0.25
+
+# Share of the stream budget open to bulk transfers, the rest is kept
+# for players.
+BULK_SHARE = 0.75
+
+# Seconds a refused client is asked to wait.
+RETRY_AFTER = 5
+
+
+class RateLimit(object):
+
+    def __init__(self, rate, burst=BURST_SECONDS):
+        """
+        Token bucket of rate bytes per second, as reservations: each
+        reserve() books its bytes and tells how long to wait before
+        sending them. Not thread safe on its own.
+        """
+        self._cost = 1.0 / rate
+        self._burst = burst
+        # When the traffic booked so far is paid off.
+        self._paid = 0.0
+
+    def reserve(self, nbytes, now):
+        start = max(self._paid, now)
+        self._paid = start + nbytes * self._cost
+        return max(0.0, start - now - self._burst)
+
+
+class PriorityRateLimit(object):
+
+    def __init__(self, rate, burst=BURST_SECONDS):
+        """
+        RateLimit shared by interactive and bulk transfers, where
+        interactive ones go first: they only wait for each other, bulk
+        transfers wait for all traffic booked before them.
+        """
+        self._cost = 1.0 / rate
+        self._burst = burst
+        self._paid_interactive = 0.0
+        self._paid_all = 0.0
+
+    def reserve(self, nbytes, priority, now):
+        cost = nbytes * self._cost
+        if priority == INTERACTIVE:
+            start = max(self._paid_interactive, now)
+            self._paid_interactive = start + cost
+            self._paid_all = max(self._paid_all, now) + cost
+        else:
+            start = max(self._paid_all, now)
+            self._paid_all = start + cost
+        return max(0.0, start - now - self._burst)
+
+
+class BandwidthScheduler(object):
+
+    def __init__(self, max_rate=0, stream_rate=0, max_streams=0, clock=time.monotonic):
+        """
+        Admission and pacing of media transfers, shared by whichever
+        HTTP engine serves them.
+
+        max_rate bounds the bytes per second of all transfers together,
+        with interactive transfers served first. stream_rate bounds
+        each transfer. At most max_streams transfers run at once, bulk
+        ones only up to BULK_SHARE of them. 0 is no limit.
+        """
+        self._max_rate = max_rate
+        self._stream_rate = stream_rate
+        self._max_streams = max_streams
+        self._max_bulk = max(1, int(max_streams * BULK_SHARE))
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._global = PriorityRateLimit(max_rate) if max_rate else None
+        self._active = collections.Counter()
+        self._admitted = collections.Counter()
+        self._rejected = collections.Counter()
+        self._bytes = collections.Counter()
+        self._waited = collections.Counter()
+
+    @staticmethod
+    def classify(status, length):
+        if status == 206 or length <= INTERACTIVE_BYTES:
+            return INTERACTIVE
+        return BULK
+
+    def is_shaping(self):
+        """
+        Whether transfers are paced, rather than sent as fast as the
+        client reads.
+        """
+        return self._global is not None or self._stream_rate > 0
+
+    def admit(self, status, length):
+        """
+        Transfer for a response of length body bytes, or None once the
+        stream budget is spent. Refused requests should be answered
+        with 503 and a Retry-After of RETRY_AFTER.
+        """
+        priority = self.classify(status, length)
+        with self._lock:
+            if self._max_streams:
+                active = self._active[INTERACTIVE] + self._active[BULK]
+                limit = self._max_streams if priority == INTERACTIVE else self._max_bulk
+                if active >= limit:
+                    self._rejected[priority] += 1
+                    log.warning("Refusing a %s transfer, %d of %d streams in use.",
+                                priority, active, self._max_streams)
+                    return None
+            self._active[priority] += 1
+            self._admitted[priority] += 1
+        return Transfer(self, priority, RateLimit(self._stream_rate) if self._stream_rate else None)
+
+    def _reserve(self, transfer, nbytes):
+        with self._lock:
+            if transfer._priority == INTERACTIVE and transfer._sent >= INTERACTIVE_BYTES:
+                self._active[INTERACTIVE] -= 1
+                self._active[BULK] += 1
+                transfer._priority = BULK
+            priority = transfer._priority
+            transfer._sent += nbytes
+            self._bytes[priority] += nbytes
+
+            now = self._clock()
+            delay = 0.0
+            if self._global is not None:
+                delay = self._global.reserve(nbytes, priority, now)
+            if transfer._limit is not None:
+                delay = max(delay, transfer._limit.reserve(nbytes, now))
+            self._waited[priority] += delay
+            return delay
+
+    def _finish(self, transfer):
+        with self._lock:
+            self._active[transfer._priority] -= 1
+
+    def get_stats(self):
+        with self._lock:
+            stats = {'max_rate': self._max_rate, 'stream_rate': self._stream_rate,
+                     'max_streams': self._max_streams}
+            for priority in PRIORITIES:
+                stats['active_' + priority] = self._active[priority]
+                stats['admitted_' + priority] = self._admitted[priority]
+                stats['rejected_' + priority] = self._rejected[priority]
+                stats['bytes_' + priority] = self._bytes[priority]
+                stats['wait_seconds_' + priority] = self._waited[priority]
+        return stats
+
+    def write(self, writer):
+        stats = self.get_stats()
+        writer.add('sbsns_bandwidth_limit_bytes_per_second', 'gauge',
+                   'Configured rate limits, 0 for none.', stats['max_rate'], [('scope', 'global')])
+        writer.add('sbsns_bandwidth_limit_bytes_per_second', 'gauge',
+                   'Configured rate limits, 0 for none.', stats['stream_rate'], [('scope', 'stream')])
+        writer.add('sbsns_streams_max', 'gauge', 'Stream budget, 0 for none.', stats['max_streams'])
+        for priority in PRIORITIES:
+            labels = [('priority', priority)]
+            writer.add('sbsns_streams_active', 'gauge', 'Transfers in progress.',
+                       stats['active_' + priority], labels)
+            writer.add('sbsns_streams_admitted_total', 'counter', 'Transfers started.',
+                       stats['admitted_' + priority], labels)
+            writer.add('sbsns_streams_rejected_total', 'counter', 'Transfers refused with 503.',
+                       stats['rejected_' + priority], labels)
+            writer.add('sbsns_stream_bytes_total', 'counter', 'Bytes sent, by the priority sent at.',
+                       stats['bytes_' + priority], labels)
+            writer.add('sbsns_stream_wait_seconds_total', 'counter',
+                       'Time transfers were held back by rate limits.',
+                       stats['wait_seconds_' + priority], labels)
+
+
+class Transfer(object):
+
+    def __init__(self, scheduler, priority, limit):
+        """
+        One admitted transfer. Call reserve() before sending each piece
+        and finish() once done.
+        """
+        self._scheduler = scheduler
+        self._priority = priority
+        self._limit = limit
+        self._sent = 0
+        self._finished = False
+
+    def get_priority(self):
+        return self._priority
+
+    def is_shaped(self):
+        return self._scheduler.is_shaping()
+
+    def reserve(self, nbytes):
+        """
+        Seconds to wait before sending the next nbytes.
+        """
+        return self._scheduler._reserve(self, nbytes)
+
+    def finish(self):
+        if not self._finished:
+            self._finished = True
+            self._scheduler._finish(self)
+
+
+class TestBandwidth(unittest.TestCase):
+
+    def test_rate_limit(self):
+        limit = RateLimit(1000, burst=0)
+        self.assertEqual(limit.reserve(500, 0.0), 0.0)
+        self.assertEqual(limit.reserve(500, 0.0), 0.5)
+        self.assertEqual(limit.reserve(500, 0.0), 1.0)
+        # Idle time is not saved up beyond the burst.
+        self.assertEqual(limit.reserve(500, 10.0), 0.0)
+        self.assertEqual(limit.reserve(500, 10.0), 0.5)
+
+    def test_priority(self):
+        limit = PriorityRateLimit(1000, burst=0)
+        self.assertEqual(limit.reserve(1000, BULK, 0.0), 0.0)
+        self.assertEqual(limit.reserve(1000, BULK, 0.0), 1.0)
+        # Ahead of the booked bulk traffic.
+        self.assertEqual(limit.reserve(1000, INTERACTIVE, 0.0), 0.0)
+        self.assertEqual(limit.reserve(1000, INTERACTIVE, 0.0), 1.0)
+        # Behind all of it.
+        self.assertEqual(limit.reserve(1000, BULK, 0.0), 4.0)
+
+    def test_admission(self):
+        scheduler = BandwidthScheduler(max_streams=4)
+        self.assertFalse(scheduler.is_shaping())
+        bulk = [scheduler.admit(200, INTERACTIVE_BYTES + 1) for _ in range(4)]
+        self.assertEqual([t is None for t in bulk], [False, False, False, True])
+        ranged = scheduler.admit(206, INTERACTIVE_BYTES * 10)
+        self.assertEqual(ranged.get_priority(), INTERACTIVE)
+        self.assertIsNone(scheduler.admit(200, 100))
+        bulk[0].finish()
+        bulk[0].finish()
+        self.assertIsNotNone(scheduler.admit(200, 100))
+
+        stats = scheduler.get_stats()
+        self.assertEqual(stats['active_bulk'], 2)
+        self.assertEqual(stats['active_interactive'], 2)
+        self.assertEqual(stats['rejected_bulk'], 1)
+        self.assertEqual(stats['rejected_interactive'], 1)
+
+    def test_pacing(self):
+        now = [0.0]
+        scheduler = BandwidthScheduler(max_rate=1000, stream_rate=100, clock=lambda: now[0])
+        self.assertTrue(scheduler.is_shaping())
+        transfer = scheduler.admit(206, 1000)
+        self.assertEqual(transfer.reserve(100), 0.0)
+        # The stream limit binds before the global one.
+        self.assertAlmostEqual(transfer.reserve(100), 1.0 - BURST_SECONDS)
+        transfer.finish()
+
+        # Interactive for the first INTERACTIVE_BYTES only.
+        transfer = BandwidthScheduler().admit(206, INTERACTIVE_BYTES * 2)
+        transfer.reserve(INTERACTIVE_BYTES)
+        self.assertEqual(transfer.get_priority(), INTERACTIVE)
+        transfer.reserve(1)
+        self.assertEqual(transfer.get_priority(), BULK)
+        stats = transfer._scheduler.get_stats()
+        self.assertEqual((stats['active_interactive'], stats['active_bulk']), (0, 1))
+        self.assertEqual((stats['bytes_interactive'], stats['bytes_bulk']), (INTERACTIVE_BYTES, 1))
+
+if __name__ == '__main__':
+    unittest.main()
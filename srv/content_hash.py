@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2019 Erik Mossberg
+
+This file is part of SeriousBusiness.
+
+SeriousBusiness is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+SeriousBusiness is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+import concurrent.futures
+import hashlib
+import os
+import struct
+import tempfile
+
+import logs
+
+log = logs.get_logger('content_hash')
+
+# Bytes read from each end of a file.
+SAMPLE_SIZE = 64 * 1024
+
+# Hex digits of a content hash.
+HASH_LENGTH = 16
+
+
+def content_hash(path):
+    """
+    Fingerprint of a file's content, from its size and the bytes at its
+    head and tail, as hex.
+
+    Copies of a file hash the same whatever their name or stat, files
+    differing only in their middle do as well. For MP4s, the head and
+    tail hold the ftyp and moov boxes, so edits that change the media
+    show there.
+    """
+    digest = hashlib.blake2b(digest_size=HASH_LENGTH // 2)
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        digest.update(struct.pack('<Q', size))
+        if size <= 2 * SAMPLE_SIZE:
+            digest.update(f.read())
+        else:
+            digest.update(f.read(SAMPLE_SIZE))
+            f.seek(size - SAMPLE_SIZE)
+            digest.update(f.read(SAMPLE_SIZE))
+    return digest.hexdigest()
+
+
+def _try_content_hash(path):
+    try:
+        return content_hash(path)
+    except OSError as ex:
+        log.warning("Failed to hash '%s': %s", path, ex)
+        return None
+
+
+def content_hashes(paths, workers=1):
+    """
+    Content hashes of paths, in the same order, None for files that
+    could not be read. Reads overlap on a thread pool of workers.
+    """
+    if workers <= 1 or len(paths) < 2:
+        return [_try_content_hash(path) for path in paths]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_try_content_hash, paths))
+
+
+class TestContentHash(unittest.TestCase):
+
+    def test_content_hash(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            def write(name, data):
+                path = os.path.join(tmpdir, name)
+                with open(path, 'wb') as f:
+                    f.write(data)
+                return path
+
+            data = bytes(range(256)) * 1024
+            original = content_hash(write('a.mp4', data))
+            self.assertEqual(len(original), HASH_LENGTH)
+            self.assertEqual(content_hash(write('b.mp4', data)), original)
+            self.assertNotEqual(content_hash(write('c.mp4', data[:-1] + b'x')), original)
+            self.assertNotEqual(content_hash(write('d.mp4', data + b'\0')), original)
+            # Sampled, the middle is not read.
+            middle = len(data) // 2
+            self.assertEqual(content_hash(write('e.mp4', data[:middle] + b'x' + data[middle + 1:])), original)
+            self.assertNotEqual(content_hash(write('f.mp4', b'x')), content_hash(write('g.mp4', b'y')))
+
+            paths = [os.path.join(tmpdir, name) for name in ['a.mp4', 'nope.mp4', 'b.mp4']]
+            self.assertEqual(content_hashes(paths), [original, None, original])
+            self.assertEqual(content_hashes(paths, workers=2), [original, None, original])
+
+if __name__ == '__main__':
+    unittest.main()
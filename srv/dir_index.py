@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2019 Erik Mossberg
+
+This file is part of SeriousBusiness.
+
+SeriousBusiness is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+SeriousBusiness is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+import hashlib
+import os
+import tempfile
+
+import logs
+
+log = logs.get_logger('dir_index')
+
+
+class DirectoryIndex(object):
+
+    THUMBNAIL_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif']
+
+    def __init__(self, directory_name, previous=None, dirty_dirs=()):
+        """
+        In-memory index of every file below a directory.
+
+        Built from a single os.scandir walk. Files are indexed by
+        extension, by basename stem and by directory, with paths
+        relative to directory_name. Each file also gets a stat
+        fingerprint (inode, size, mtime_ns) for change detection.
+
+        If previous is given, only dirty_dirs (and directories that
+        are new below them) are read from disk, the rest is reused.
+        """
+        self._directory_name = directory_name
+        # reldir -> ([(basename, fingerprint)], [subdir relpaths])
+        self._dirs = {}
+        self._files = []
+        self._fingerprints = {}
+        self._by_ext = {}
+        self._by_stem = {}
+        self._by_dir = {}
+        if previous is None:
+            self._walk({}, set(), force=True)
+        else:
+            self._walk(previous._dirs, set(dirty_dirs), force=False)
+
+    def refresh(self, dirty_dirs):
+        """
+        Return a new index, re-scanning only dirty_dirs.
+        """
+        return DirectoryIndex(self._directory_name, previous=self, dirty_dirs=dirty_dirs)
+
+    def _walk(self, old_dirs, dirty_dirs, force):
+        """
+        Walk the directory tree depth first, in sorted order.
+
+        Directories not dirty and present in old_dirs are not touched
+        on disk.
+        """
+        pending = [('', force)]
+        while pending:
+            reldir, forced = pending.pop()
+            cached = old_dirs.get(reldir)
+            if forced or cached is None or reldir in dirty_dirs:
+                scanned = self._scan_dir(reldir)
+                if scanned is None:
+                    continue
+                files, subdirs = scanned
+                # Subdirectories we have not seen before are scanned in full,
+                # even if a stale entry with the same name is cached.
+                known = set() if cached is None else set(cached[1])
+                children = [(d, forced or d not in known) for d in subdirs]
+            else:
+                files, subdirs = cached
+                children = [(d, False) for d in subdirs]
+
+            self._dirs[reldir] = (files, subdirs)
+            for basename, fingerprint in files:
+                relpath = os.path.join(reldir, basename)
+                self._add(reldir, basename, relpath)
+                self._fingerprints[relpath] = fingerprint
+
+            # Reversed, so that popping visits subdirectories in sorted order.
+            pending += reversed(children)
+
+    def _scan_dir(self, reldir):
+        """
+        List one directory. Returns (files, subdirs) or None.
+        """
+        absdir = os.path.join(self._directory_name, reldir)
+        try:
+            with os.scandir(absdir) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError as ex:
+            log.warning("Failed to scan directory '%s': %s", absdir, ex)
+            return None
+
+        files = []
+        subdirs = []
+        for entry in entries:
+            try:
+                # Symlinked directories are not walked, they can loop,
+                # and the watcher does not follow them either.
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(os.path.join(reldir, entry.name))
+                    continue
+                if not entry.is_file():
+                    continue
+                st = entry.stat()
+            except OSError:
+                continue
+            files.append((entry.name, (st.st_ino, st.st_size, st.st_mtime_ns)))
+
+        return files, subdirs
+
+    def _add(self, reldir, basename, relpath):
+        stem, ext = os.path.splitext(basename)
+        self._files.append(relpath)
+        self._by_ext.setdefault(ext, []).append(relpath)
+        self._by_stem.setdefault(stem, []).append(relpath)
+        self._by_dir.setdefault(reldir, []).append(basename)
+
+    def get_directory_name(self):
+        return self._directory_name
+
+    def get_files(self):
+        """
+        All files, relative to the indexed directory.
+        """
+        return self._files
+
+    def get_fingerprint(self, relpath):
+        """
+        (inode, size, mtime_ns) of a file at scan time, or None.
+        """
+        return self._fingerprints.get(relpath)
+
+    def files_with_ext(self, ext):
+        """
+        Files with the given extension (including the dot, e.g. '.mp4').
+        """
+        return self._by_ext.get(ext, [])
+
+    def files_with_stem(self, stem):
+        """
+        Files whose basename, minus extension, equals stem.
+        """
+        return self._by_stem.get(stem, [])
+
+    def files_in_dir(self, reldir=''):
+        """
+        Basenames of files directly in reldir ('' is the top directory).
+        """
+        return self._by_dir.get(reldir, [])
+
+    def count_thumbnails(self):
+        """
+        Number of image files anywhere in the tree.
+        """
+        return sum(len(self.files_with_ext(ext)) for ext in self.THUMBNAIL_EXTENSIONS)
+
+    def thumbnail_signature(self):
+        """
+        Digest of the image file paths, for thumbnail inference
+        invalidation.
+        """
+        digest = hashlib.sha1()
+        for ext in self.THUMBNAIL_EXTENSIONS:
+            for relpath in self.files_with_ext(ext):
+                digest.update(os.fsencode(relpath) + b'\0')
+        return digest.hexdigest()
+
+    def any_thumbnail(self):
+        """
+        Basename of the first image file found, or None.
+        """
+        for ext in self.THUMBNAIL_EXTENSIONS:
+            found = self.files_with_ext(ext)
+            if found:
+                return os.path.basename(found[0])
+        return None
+
+    def find_thumbnail(self, base):
+        """
+        Basename of an image named base + image extension, or None.
+        """
+        stem_matches = self.files_with_stem(base)
+        if not stem_matches:
+            return None
+
+        basenames = [os.path.basename(p) for p in stem_matches]
+        for ext in self.THUMBNAIL_EXTENSIONS:
+            candidate = '%s%s' % (base, ext)
+            if candidate in basenames:
+                return candidate
+        return None
+
+
+class TestDirectoryIndex(unittest.TestCase):
+
+    def test_index(self):
+        index = DirectoryIndex('../media')
+        self.assertIn('donut_clip.json', index.get_files())
+        self.assertIn('landscape_clip.json', index.files_with_ext('.json'))
+        self.assertIn('hello.txt', index.files_in_dir(''))
+        self.assertEqual(index.files_with_stem('donut_thumb'), ['donut_thumb.png'])
+        self.assertEqual(index.files_with_ext('.nope'), [])
+        self.assertEqual(index.get_fingerprint('hello.txt')[1], 6)
+        self.assertIsNone(index.get_fingerprint('nope.txt'))
+
+    def test_find_thumbnail(self):
+        index = DirectoryIndex('../media')
+        self.assertEqual(index.count_thumbnails(), 2)
+        self.assertEqual(index.find_thumbnail('landscape_thumb'), 'landscape_thumb.png')
+        self.assertIsNone(index.find_thumbnail('landscape_clip'))
+
+    def test_refresh(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.mkdir(os.path.join(tmpdir, 'a'))
+            open(os.path.join(tmpdir, 'a', 'one.mp4'), 'w').close()
+            index = DirectoryIndex(tmpdir)
+            self.assertEqual(index.get_files(), [os.path.join('a', 'one.mp4')])
+
+            open(os.path.join(tmpdir, 'a', 'two.mp4'), 'w').close()
+            os.makedirs(os.path.join(tmpdir, 'b', 'c'))
+            open(os.path.join(tmpdir, 'b', 'c', 'three.mp4'), 'w').close()
+
+            # Only the listed directory is re-read.
+            self.assertEqual(len(index.refresh(['']).get_files()), 2)
+            refreshed = index.refresh(['', 'a'])
+            self.assertEqual(len(refreshed.files_with_ext('.mp4')), 3)
+            self.assertEqual(len(index.get_files()), 1)
+
+    def test_symlink_loop(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            open(os.path.join(tmpdir, 'a.mp4'), 'w').close()
+            os.symlink('.', os.path.join(tmpdir, 'loop'))
+            os.symlink('a.mp4', os.path.join(tmpdir, 'b.mp4'))
+            index = DirectoryIndex(tmpdir)
+            # Symlinked files are indexed, symlinked directories are not.
+            self.assertEqual(index.get_files(), ['a.mp4', 'b.mp4'])
+            self.assertEqual(index.refresh(['']).get_files(), ['a.mp4', 'b.mp4'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2019 Erik Mossberg
+
+This file is part of SeriousBusiness.
+
+SeriousBusiness is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+SeriousBusiness is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+import collections
+import os
+import tempfile
+import threading
+import time
+
+
+class DiskCache(object):
+
+    # Seconds between listings of a shared directory.
+    SYNC_INTERVAL = 1.0
+
+    def __init__(self, cache_dir, max_bytes, shared=False):
+        """
+        Size-bounded directory of derived files, evicted least recently
+        used first.
+
+        Files are named by their content (e.g. a hash of what they were
+        derived from), so a cached file never goes stale. Files already
+        in the directory are adopted at startup, oldest first.
+
+        With shared set, other processes add and evict files too, e.g.
+        with --workers. The directory is then listed when files are
+        added, at most every SYNC_INTERVAL seconds, so max_bytes bounds
+        the files of all of them together.
+        """
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        self._shared = shared
+        self._synced = time.monotonic()
+        self._lock = threading.Lock()
+        self._name_locks = {}
+        # name -> size in bytes, least recently used first.
+        self._entries = collections.OrderedDict()
+        self._total_bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_entries()
+
+    def _load_entries(self):
+        found = []
+        for entry in os.scandir(self._cache_dir):
+            if '.tmp' in entry.name or not entry.is_file():
+                continue
+            st = entry.stat()
+            found.append((st.st_mtime_ns, entry.name, st.st_size))
+
+        for _, name, size in sorted(found):
+            self._entries[name] = size
+            self._total_bytes += size
+        self._evict()
+
+    def path_for(self, name):
+        return os.path.join(self._cache_dir, name)
+
+    def contains(self, name):
+        with self._lock:
+            if name in self._entries:
+                if os.path.exists(self.path_for(name)):
+                    return True
+                # Evicted by another process sharing the directory.
+                self._total_bytes -= self._entries.pop(name)
+                return False
+        if os.path.exists(self.path_for(name)):
+            # Created by another process sharing the directory.
+            self.add(name)
+            return True
+        return False
+
+    def find(self, name):
+        """
+        Path of a cached file, or None. Unlike get(), this is no lookup
+        that counts as a hit or miss, a file found just counts as used.
+        """
+        if not self.contains(name):
+            return None
+        with self._lock:
+            if name in self._entries:
+                self._entries.move_to_end(name)
+        return self.path_for(name)
+
+    def get(self, name, create):
+        """
+        Path of a cached file, calling create(path) to make it on a
+        miss. create must write path atomically and return whether it
+        did. Concurrent misses for one name only create it once.
+        Returns None if it could not be created. A file some other
+        process put at path is taken as is.
+        """
+        path = self.path_for(name)
+        with self._lock:
+            if name in self._entries and os.path.exists(path):
+                self._entries.move_to_end(name)
+                self._hits += 1
+                return path
+            name_lock = self._name_locks.setdefault(name, threading.Lock())
+
+        with name_lock:
+            try:
+                with self._lock:
+                    if name in self._entries and os.path.exists(path):
+                        self._hits += 1
+                        return path
+                if os.path.exists(path):
+                    # Created by another process sharing the directory.
+                    self.add(name)
+                    with self._lock:
+                        self._hits += 1
+                    return path
+                with self._lock:
+                    self._misses += 1
+                created = create(path)
+            finally:
+                with self._lock:
+                    self._name_locks.pop(name, None)
+
+            if not created:
+                return None
+            self.add(name)
+            return path
+
+    def add(self, name):
+        """
+        Take a file created at path_for(name) elsewhere into the cache,
+        e.g. by a worker process.
+        """
+        path = self.path_for(name)
+        with self._lock:
+            if not os.path.exists(path):
+                return
+            if name in self._entries:
+                self._total_bytes -= self._entries.pop(name)
+            size = os.path.getsize(path)
+            self._entries[name] = size
+            self._total_bytes += size
+            self._evict(keep=name)
+
+    def discard(self, name):
+        """
+        Remove a file from the cache and the directory.
+        """
+        with self._lock:
+            if name in self._entries:
+                self._total_bytes -= self._entries.pop(name)
+        try:
+            os.remove(self.path_for(name))
+        except OSError:
+            pass
+
+    def _evict(self, keep=None):
+        if self._shared and time.monotonic() - self._synced >= self.SYNC_INTERVAL:
+            self._sync()
+        while self._total_bytes > self._max_bytes and self._entries:
+            name, size = next(iter(self._entries.items()))
+            if name == keep and len(self._entries) == 1:
+                break
+            del self._entries[name]
+            self._total_bytes -= size
+            self._evictions += 1
+            try:
+                os.remove(self.path_for(name))
+            except OSError:
+                pass
+
+    def _sync(self):
+        """
+        Take the entries from the directory: files other processes
+        removed are dropped, ones they made are adopted as just used.
+        Known files keep their place.
+        """
+        found = {}
+        for entry in os.scandir(self._cache_dir):
+            if '.tmp' in entry.name or not entry.is_file():
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            found[entry.name] = (st.st_mtime_ns, st.st_size)
+
+        entries = collections.OrderedDict(
+            (name, found.pop(name)[1]) for name in self._entries if name in found)
+        for _, name, size in sorted((mtime, name, size) for name, (mtime, size) in found.items()):
+            entries[name] = size
+        self._entries = entries
+        self._total_bytes = sum(entries.values())
+        self._synced = time.monotonic()
+
+    def get_stats(self):
+        return {'hits': self._hits, 'misses': self._misses, 'evictions': self._evictions,
+                'entries': len(self._entries), 'bytes': self._total_bytes}
+
+
+def write_atomic(path, data):
+    """
+    Write data to path so readers never see a partial file.
+    """
+    tmp_path = '%s.tmp%d.%d' % (path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return True
+
+
+class TestDiskCache(unittest.TestCase):
+
+    def test_lru(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = DiskCache(tmpdir, max_bytes=25)
+            made = []
+
+            def create(data):
+                def write(path):
+                    made.append(data)
+                    return write_atomic(path, data)
+                return write
+
+            a = cache.get('a', create(b'a' * 10))
+            self.assertEqual(cache.get('a', create(b'never')), a)
+            cache.get('b', create(b'b' * 10))
+            cache.get('a', create(b'never'))
+            cache.get('c', create(b'c' * 10))
+            # b was least recently used.
+            self.assertFalse(cache.contains('b'))
+            self.assertTrue(cache.contains('a'))
+            self.assertEqual(made, [b'a' * 10, b'b' * 10, b'c' * 10])
+            self.assertEqual(cache.get_stats(), {'hits': 2, 'misses': 3, 'evictions': 1,
+                                                 'entries': 2, 'bytes': 20})
+            self.assertIsNone(cache.get('d', lambda path: False))
+
+            reloaded = DiskCache(tmpdir, max_bytes=25)
+            self.assertEqual(reloaded.get_stats()['entries'], 2)
+
+            # Another process sharing the directory made this one.
+            write_atomic(cache.path_for('e'), b'e')
+            self.assertEqual(cache.get('e', create(b'never')), cache.path_for('e'))
+            self.assertTrue(cache.contains('e'))
+            stats = cache.get_stats()
+            self.assertEqual(cache.find('e'), cache.path_for('e'))
+            self.assertIsNone(cache.find('f'))
+            self.assertEqual(cache.get_stats(), stats)
+
+    def test_shared(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            first = DiskCache(tmpdir, max_bytes=25, shared=True)
+            second = DiskCache(tmpdir, max_bytes=25, shared=True)
+            first.SYNC_INTERVAL = second.SYNC_INTERVAL = 0
+            first.get('a', lambda path: write_atomic(path, b'a' * 10))
+            second.get('b', lambda path: write_atomic(path, b'b' * 10))
+            second.get('c', lambda path: write_atomic(path, b'c' * 10))
+
+            # The bound holds for both processes' files together.
+            self.assertEqual(sorted(os.listdir(tmpdir)), ['a', 'c'])
+            self.assertEqual(second.get_stats()['bytes'], 20)
+            first.get('d', lambda path: write_atomic(path, b'd' * 10))
+            self.assertLessEqual(sum(os.path.getsize(os.path.join(tmpdir, name))
+                                     for name in os.listdir(tmpdir)), 25)
+            self.assertTrue(first.contains('d'))
+
+if __name__ == '__main__':
+    unittest.main()
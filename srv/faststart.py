@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2019 Erik Mossberg
+
+This file is part of SeriousBusiness.
+
+SeriousBusiness is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+SeriousBusiness is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+
+from mp4_probe import walk_boxes, probe_mp4, Mp4Error
+from disk_cache import DiskCache
+
+# Boxes on the way from moov to the chunk offset tables.
+_CONTAINERS = {b'moov', b'trak', b'mdia', b'minf', b'stbl'}
+
+COPY_CHUNK = 8 * 1024 * 1024
+
+_BOX_HEADER = struct.Struct('>I4s')
+_U32 = struct.Struct('>I')
+
+
+def faststart_key(source_fingerprint):
+    """
+    Cache file name stem for the faststart copy of a media file.
+    """
+    desc = 'faststart|%s' % '-'.join(str(f) for f in source_fingerprint)
+    return hashlib.sha256(desc.encode('ascii')).hexdigest()[:32]
+
+
+def _rewrite_boxes(buf, start, end, shift, co64):
+    """
+    Bytes of the boxes in buf[start:end], with every chunk offset
+    passed through shift(), and stco tables widened to co64 if co64.
+    """
+    out = []
+    for box_type, box_start, payload, box_end in walk_boxes(buf, start, end):
+        if box_type in _CONTAINERS:
+            body = _rewrite_boxes(buf, payload, box_end, shift, co64)
+            out.append(_BOX_HEADER.pack(8 + len(body), box_type) + body)
+        elif box_type in (b'stco', b'co64'):
+            count = _U32.unpack_from(buf, payload + 4)[0]
+            fmt = '>%d%s' % (count, 'I' if box_type == b'stco' else 'Q')
+            offsets = [shift(offset) for offset in struct.unpack_from(fmt, buf, payload + 8)]
+            wide = co64 or box_type == b'co64'
+            table = struct.pack('>%d%s' % (count, 'Q' if wide else 'I'), *offsets)
+            body = bytes(buf[payload:payload + 4]) + _U32.pack(count) + table
+            out.append(_BOX_HEADER.pack(8 + len(body), b'co64' if wide else b'stco') + body)
+        else:
+            out.append(bytes(buf[box_start:box_end]))
+    return b''.join(out)
+
+
+def read_chunk_offsets(buf, start, end):
+    """
+    All chunk offsets in the stco/co64 tables under buf[start:end].
+    """
+    offsets = []
+    for box_type, _, payload, box_end in walk_boxes(buf, start, end):
+        if box_type in _CONTAINERS:
+            offsets += read_chunk_offsets(buf, payload, box_end)
+        elif box_type in (b'stco', b'co64'):
+            count = _U32.unpack_from(buf, payload + 4)[0]
+            fmt = '>%d%s' % (count, 'I' if box_type == b'stco' else 'Q')
+            offsets += struct.unpack_from(fmt, buf, payload + 8)
+    return offsets
+
+
+def _copy_range(src_fd, dst, offset, count):
+    dst.flush()
+    dst_fd = dst.fileno()
+    end = offset + count
+    while offset < end:
+        n = min(COPY_CHUNK, end - offset)
+        if hasattr(os, 'copy_file_range'):
+            try:
+                copied = os.copy_file_range(src_fd, dst_fd, n, offset)
+            except OSError:
+                copied = os.write(dst_fd, os.pread(src_fd, n, offset))
+        else:
+            copied = os.write(dst_fd, os.pread(src_fd, n, offset))
+        if copied <= 0:
+            raise IOError("Source shrank while remuxing")
+        offset += copied
+
+
+def remux_faststart(source_path, out_path):
+    """
+    Write a copy of an MP4 with its moov box ahead of the media data.
+
+    Chunk offsets in the moov are rewritten for the new layout, and
+    widened to 64 bits if the file is large enough to need it. Media
+    data is copied in the kernel where possible. Returns False if the
+    file already is faststart, raises Mp4Error for files that cannot
+    be remuxed, e.g. fragmented ones.
+    """
+    with open(source_path, 'rb') as src:
+        size = os.fstat(src.fileno()).st_size
+        with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            boxes = []
+            for box_type, box_start, payload, box_end in walk_boxes(buf, 0, size):
+                boxes.append((box_type, box_start, box_end, payload))
+
+            types = [box[0] for box in boxes]
+            if b'moof' in types:
+                raise Mp4Error("Fragmented MP4, nothing to move")
+            if b'moov' not in types or b'mdat' not in types:
+                raise Mp4Error("Need both moov and mdat")
+            moov_index = types.index(b'moov')
+            mdat_index = types.index(b'mdat')
+            if moov_index < mdat_index:
+                return False
+
+            _, moov_start, moov_end, moov_payload = boxes[moov_index]
+            insert_at = boxes[mdat_index][1]
+
+            # Widen before the offsets can overflow 32 bits.
+            co64 = size > 0xffffffff - (moov_end - moov_start) - 1024
+            moov_size = 8 + len(_rewrite_boxes(buf, moov_payload, moov_end, lambda o: o, co64))
+
+            def shift(offset):
+                if insert_at <= offset < moov_start:
+                    return offset + moov_size
+                return offset
+
+            moov = _rewrite_boxes(buf, moov_payload, moov_end, shift, co64)
+            moov = _BOX_HEADER.pack(8 + len(moov), b'moov') + moov
+
+        tmp_path = '%s.tmp%d' % (out_path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as dst:
+                src_fd = src.fileno()
+                for i, (box_type, box_start, box_end, _) in enumerate(boxes):
+                    if i == moov_index:
+                        continue
+                    if i == mdat_index:
+                        dst.write(moov)
+                    _copy_range(src_fd, dst, box_start, box_end - box_start)
+            os.replace(tmp_path, out_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return True
+
+
+class FaststartCache(object):
+
+    def __init__(self, cache_dir, max_bytes=16 * 1024 * 1024 * 1024, shared=False):
+        """
+        Directory of faststart copies of media files whose moov box is
+        at the end, named by the source file's content hash or stat
+        fingerprint. Copies are kept in a size-bounded DiskCache, the
+        least recently served are removed past max_bytes. See DiskCache
+        for shared.
+        """
+        self._cache_dir = cache_dir
+        self._cache = DiskCache(cache_dir, max_bytes, shared)
+
+    @staticmethod
+    def get_name(source_fingerprint):
+        return faststart_key(source_fingerprint) + '.mp4'
+
+    def get_path(self, source_fingerprint):
+        """
+        Where the faststart copy of a file goes, whether it exists or not.
+        """
+        return self._cache.path_for(self.get_name(source_fingerprint))
+
+    def contains(self, source_fingerprint):
+        """
+        Whether there is a faststart copy, without counting a lookup.
+        """
+        return self._cache.contains(self.get_name(source_fingerprint))
+
+    def find(self, source_fingerprint):
+        """
+        Path of an existing faststart copy, or None.
+        """
+        return self._cache.get(self.get_name(source_fingerprint), lambda path: False)
+
+    def add(self, name):
+        """
+        Take a copy written to the cache directory by remux_faststart()
+        into the cache.
+        """
+        self._cache.add(name)
+
+    def prune(self, keep_fingerprints):
+        """
+        Remove copies of files that changed or are gone. Returns the
+        number of files removed.
+        """
+        keep = set(self.get_name(fp) for fp in keep_fingerprints)
+        removed = 0
+        for entry in os.scandir(self._cache_dir):
+            if entry.name.endswith('.mp4') and entry.name not in keep:
+                self._cache.discard(entry.name)
+                removed += 1
+        return removed
+
+    def get_stats(self):
+        return self._cache.get_stats()
+
+
+def needs_faststart(media_info):
+    """
+    Would a clip with this Mp4Info benefit from a faststart copy.
+    """
+    return media_info is not None and not media_info.fragmented and \
+        not media_info.is_faststart()
+
+
+class TestFaststart(unittest.TestCase):
+
+    def test_remux(self):
+        source = '../media/Simple landscape flyover.mp4'
+        with tempfile.TemporaryDirectory() as tmpdir:
+            out = os.path.join(tmpdir, 'out.mp4')
+            self.assertTrue(remux_faststart(source, out))
+            self.assertEqual(os.path.getsize(out), os.path.getsize(source))
+
+            before = probe_mp4(source)
+            after = probe_mp4(out)
+            self.assertTrue(needs_faststart(before))
+            self.assertFalse(needs_faststart(after))
+            self.assertEqual(after.duration, before.duration)
+            self.assertEqual(after.video_codec, before.video_codec)
+
+            # Every chunk offset still points at the same media data.
+            with open(source, 'rb') as f:
+                old = f.read()
+            with open(out, 'rb') as f:
+                new = f.read()
+            old_offsets = read_chunk_offsets(old, before.moov_offset + 8, before.moov_offset + before.moov_size)
+            new_offsets = read_chunk_offsets(new, after.moov_offset + 8, after.moov_offset + after.moov_size)
+            self.assertEqual(len(old_offsets), len(new_offsets))
+            for old_offset, new_offset in zip(old_offsets, new_offsets):
+                self.assertEqual(new_offset, old_offset + after.moov_size)
+                self.assertEqual(new[new_offset:new_offset + 64], old[old_offset:old_offset + 64])
+
+            self.assertFalse(remux_faststart(out, os.path.join(tmpdir, 'again.mp4')))
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = FaststartCache(tmpdir)
+            self.assertIsNone(cache.find((1, 2, 3)))
+            with open(cache.get_path((1, 2, 3)), 'wb') as f:
+                f.write(b'x')
+            self.assertEqual(cache.find((1, 2, 3)), cache.get_path((1, 2, 3)))
+            self.assertEqual(cache.prune([(4, 5, 6)]), 1)
+            self.assertIsNone(cache.find((1, 2, 3)))
+            self.assertEqual(cache.get_stats()['bytes'], 0)
+
+            cache = FaststartCache(tmpdir, max_bytes=10)
+            for fingerprint in [(1,), (2,), (3,)]:
+                with open(cache.get_path(fingerprint), 'wb') as f:
+                    f.write(b'x' * 4)
+                cache.add(cache.get_name(fingerprint))
+            # Over the budget, the least recently used copy goes.
+            self.assertIsNone(cache.find((1,)))
+            self.assertIsNotNone(cache.find((3,)))
+
+if __name__ == '__main__':
+    unittest.main()
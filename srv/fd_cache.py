@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2019 Erik Mossberg
+
+This file is part of SeriousBusiness.
+
+SeriousBusiness is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+SeriousBusiness is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+import collections
+import os
+import tempfile
+import threading
+import time
+
+
+def stat_fingerprint(st):
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class CachedFile(object):
+
+    def __init__(self, fileobj, st):
+        """
+        An open file shared by concurrent requests.
+
+        Users must only read with explicit offsets (os.pread, sendfile).
+        The file is closed once it was evicted and every user released it.
+        """
+        self.fileobj = fileobj
+        self.st = st
+        self.checked = time.monotonic()
+        self._refs = 1
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._refs == 0:
+                return False
+            self._refs += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._refs -= 1
+            closing = self._refs == 0
+        if closing:
+            self.fileobj.close()
+
+
+class FileCache(object):
+
+    def __init__(self, max_files=128, revalidate_after=1.0):
+        """
+        Bounded LRU cache of open files and their stat results.
+
+        Entries are re-checked with a stat at most every
+        revalidate_after seconds and dropped when the file's inode,
+        size or mtime changed. Everything is dropped when the library
+        generation changes. With max_files 0, nothing is cached.
+        """
+        self._max_files = max_files
+        self._revalidate_after = revalidate_after
+        self._entries = collections.OrderedDict()
+        self._generation = None
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._stale = 0
+
+    def open(self, path, generation=None):
+        """
+        Return an acquired CachedFile for path. The caller must call
+        release() on it when done. Raises OSError like open().
+        """
+        with self._lock:
+            if generation != self._generation:
+                self._generation = generation
+                self._clear()
+
+            entry = self._entries.get(path)
+            if entry is not None and self._still_valid(path, entry) and entry.acquire():
+                self._entries.move_to_end(path)
+                self._hits += 1
+                return entry
+
+            if entry is not None:
+                self._stale += 1
+                self._evict(path)
+            self._misses += 1
+
+        fileobj = open(path, 'rb')
+        try:
+            if hasattr(os, 'posix_fadvise'):
+                # Mostly streamed front to back, this widens the
+                # kernel's readahead window.
+                os.posix_fadvise(fileobj.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            entry = CachedFile(fileobj, os.fstat(fileobj.fileno()))
+        except OSError:
+            fileobj.close()
+            raise
+
+        if self._max_files <= 0:
+            return entry
+
+        entry.acquire()
+        with self._lock:
+            if path in self._entries:
+                self._evict(path)
+            self._entries[path] = entry
+            while len(self._entries) > self._max_files:
+                self._evict(next(iter(self._entries)))
+        return entry
+
+    def _still_valid(self, path, entry):
+        now = time.monotonic()
+        if now - entry.checked < self._revalidate_after:
+            return True
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        if stat_fingerprint(st) != stat_fingerprint(entry.st):
+            return False
+        entry.checked = now
+        return True
+
+    def _evict(self, path):
+        self._entries.pop(path).release()
+
+    def _clear(self):
+        while self._entries:
+            self._evict(next(iter(self._entries)))
+
+    def invalidate(self):
+        with self._lock:
+            self._clear()
+
+    def get_stats(self):
+        return {'hits': self._hits, 'misses': self._misses, 'stale': self._stale,
+                'open': len(self._entries)}
+
+
+class TestFileCache(unittest.TestCase):
+
+    def test_hits_and_eviction(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = []
+            for i in range(3):
+                paths.append(os.path.join(tmpdir, '%d.mp4' % i))
+                with open(paths[-1], 'wb') as f:
+                    f.write(b'x' * (i + 1))
+
+            cache = FileCache(max_files=2)
+            first = cache.open(paths[0])
+            self.assertEqual(first.st.st_size, 1)
+            first.release()
+            again = cache.open(paths[0])
+            self.assertIs(again, first)
+
+            cache.open(paths[1]).release()
+            cache.open(paths[2]).release()
+            self.assertEqual(cache.get_stats(), {'hits': 1, 'misses': 3, 'stale': 0, 'open': 2})
+
+            # Evicted while in use, closed only once released.
+            self.assertFalse(first.fileobj.closed)
+            self.assertEqual(os.pread(first.fileobj.fileno(), 1, 0), b'x')
+            first.release()
+            self.assertTrue(first.fileobj.closed)
+
+    def test_invalidation(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'clip.mp4')
+            with open(path, 'wb') as f:
+                f.write(b'old')
+
+            cache = FileCache(revalidate_after=0)
+            cache.open(path, generation=1).release()
+
+            with open(path + '.new', 'wb') as f:
+                f.write(b'newer')
+            os.replace(path + '.new', path)
+            entry = cache.open(path, generation=1)
+            self.assertEqual(entry.st.st_size, 5)
+            entry.release()
+            self.assertEqual(cache.get_stats()['stale'], 1)
+
+            cache.open(path, generation=2).release()
+            self.assertEqual(cache.get_stats()['misses'], 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,500 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2019 Erik Mossberg
+
+This file is part of SeriousBusiness.
+
+SeriousBusiness is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+SeriousBusiness is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+import bisect
+import collections
+import hashlib
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+from mp4_probe import walk_boxes, Mp4Error
+from disk_cache import DiskCache, write_atomic
+import logs
+
+log = logs.get_logger('hls')
+
+_BOX_HEADER = struct.Struct('>I4s')
+_U32 = struct.Struct('>I')
+
+# Boxes on the way from trak to the sample tables.
+_TRAK_CONTAINERS = {b'trak', b'mdia', b'minf', b'stbl'}
+
+# trun sample flags.
+SAMPLE_SYNC = 0x02000000
+SAMPLE_NON_SYNC = 0x01010000
+
+TARGET_DURATION = 6.0
+
+
+def _box(box_type, *payload):
+    body = b''.join(payload)
+    return _BOX_HEADER.pack(8 + len(body), box_type) + body
+
+
+def _full_box(box_type, version, flags, *payload):
+    return _box(box_type, _U32.pack((version << 24) | flags), *payload)
+
+
+class Track(object):
+
+    def __init__(self, trak_start, trak_end):
+        """
+        Sample tables of one trak, expanded to per-sample lists.
+        """
+        self.trak_start = trak_start
+        self.trak_end = trak_end
+        self.track_id = None
+        self.timescale = None
+        self.handler = None
+        self.sizes = []
+        self.offsets = []
+        self.dts = []
+        self.durations = []
+        self.cts_offsets = None
+        # Version 0 ctts offsets are unsigned, version 1 ones signed.
+        self.cts_signed = False
+        # None when every sample is a sync sample.
+        self.sync = None
+
+    def is_sync(self, index):
+        return self.sync is None or index in self.sync
+
+
+def _unpack_table(buf, payload, fmt_per_entry):
+    count = _U32.unpack_from(buf, payload + 4)[0]
+    width = struct.calcsize('>' + fmt_per_entry)
+    fmt = '>' + fmt_per_entry * count
+    values = struct.unpack_from(fmt, buf, payload + 8)
+    per = len(fmt_per_entry)
+    return [values[i:i + per] for i in range(0, len(values), per)], payload + 8 + width * count
+
+
+def _parse_stbl(buf, start, end, track):
+    stsc = None
+    chunk_offsets = None
+    for box_type, _, payload, box_end in walk_boxes(buf, start, end):
+        if box_type == b'stts':
+            entries, _ = _unpack_table(buf, payload, 'II')
+            for count, delta in entries:
+                track.durations += [delta] * count
+        elif box_type == b'ctts':
+            version = buf[payload]
+            entries, _ = _unpack_table(buf, payload, 'Ii' if version == 1 else 'II')
+            track.cts_offsets = []
+            track.cts_signed = version == 1
+            for count, offset in entries:
+                track.cts_offsets += [offset] * count
+        elif box_type == b'stss':
+            entries, _ = _unpack_table(buf, payload, 'I')
+            track.sync = set(number - 1 for number, in entries)
+        elif box_type == b'stsz':
+            sample_size, count = struct.unpack_from('>II', buf, payload + 4)
+            if sample_size:
+                track.sizes = [sample_size] * count
+            else:
+                track.sizes = list(struct.unpack_from('>%dI' % count, buf, payload + 12))
+        elif box_type == b'stsc':
+            stsc, _ = _unpack_table(buf, payload, 'III')
+        elif box_type in (b'stco', b'co64'):
+            entries, _ = _unpack_table(buf, payload, 'I' if box_type == b'stco' else 'Q')
+            chunk_offsets = [offset for offset, in entries]
+        elif box_type == b'stz2':
+            raise Mp4Error("Compact sample sizes are not supported")
+
+    if stsc is None or chunk_offsets is None:
+        raise Mp4Error("Track without chunk tables")
+
+    # Lay the samples out over the chunks.
+    sample = 0
+    for i, (first_chunk, per_chunk, _) in enumerate(stsc):
+        last_chunk = stsc[i + 1][0] - 1 if i + 1 < len(stsc) else len(chunk_offsets)
+        for chunk in range(first_chunk - 1, last_chunk):
+            offset = chunk_offsets[chunk]
+            for _ in range(per_chunk):
+                if sample >= len(track.sizes):
+                    break
+                track.offsets.append(offset)
+                offset += track.sizes[sample]
+                sample += 1
+
+    if len(track.offsets) != len(track.sizes) or len(track.durations) < len(track.sizes):
+        raise Mp4Error("Inconsistent sample tables")
+    del track.durations[len(track.sizes):]
+
+    dts = 0
+    for duration in track.durations:
+        track.dts.append(dts)
+        dts += duration
+
+
+def _parse_trak(buf, trak_start, trak_end):
+    track = Track(trak_start, trak_end)
+    stack = [(trak_start + 8, trak_end)]
+    while stack:
+        start, end = stack.pop()
+        for box_type, _, payload, box_end in walk_boxes(buf, start, end):
+            if box_type == b'stbl':
+                _parse_stbl(buf, payload, box_end, track)
+            elif box_type in _TRAK_CONTAINERS:
+                stack.append((payload, box_end))
+            elif box_type == b'tkhd':
+                track.track_id = _U32.unpack_from(buf, payload + (20 if buf[payload] == 1 else 12))[0]
+            elif box_type == b'mdhd':
+                track.timescale = _U32.unpack_from(buf, payload + (20 if buf[payload] == 1 else 12))[0]
+            elif box_type == b'hdlr':
+                track.handler = bytes(buf[payload + 8:payload + 12])
+    if not track.track_id or not track.timescale:
+        raise Mp4Error("Track without id or timescale")
+    return track
+
+
+def _rewrite_trak(buf, start, end):
+    """
+    A trak for an fMP4 init segment, with empty sample tables.
+    """
+    out = []
+    for box_type, box_start, payload, box_end in walk_boxes(buf, start, end):
+        if box_type == b'stbl':
+            stsd = b''
+            for child, child_start, _, child_end in walk_boxes(buf, payload, box_end):
+                if child == b'stsd':
+                    stsd = bytes(buf[child_start:child_end])
+            out.append(_box(b'stbl', stsd,
+                            _full_box(b'stts', 0, 0, _U32.pack(0)),
+                            _full_box(b'stsc', 0, 0, _U32.pack(0)),
+                            _full_box(b'stsz', 0, 0, _U32.pack(0), _U32.pack(0)),
+                            _full_box(b'stco', 0, 0, _U32.pack(0))))
+        elif box_type in _TRAK_CONTAINERS:
+            out.append(_box(box_type, _rewrite_trak(buf, payload, box_end)))
+        else:
+            out.append(bytes(buf[box_start:box_end]))
+    return b''.join(out)
+
+
+class HlsPlan(object):
+
+    def __init__(self, path, target_duration=TARGET_DURATION):
+        """
+        Segment layout of an MP4 for HLS with fMP4 segments.
+
+        Segments are cut at sync samples of the first video track, at
+        least target_duration seconds apart, so every segment starts
+        with a key frame. Samples are copied, never transcoded.
+        """
+        self._path = path
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                self._parse(buf, size)
+        self._plan_segments(target_duration)
+
+    def _parse(self, buf, size):
+        moov = None
+        for box_type, box_start, payload, box_end in walk_boxes(buf, 0, size):
+            if box_type == b'moov':
+                moov = (payload, box_end)
+            elif box_type == b'moof':
+                raise Mp4Error("Already fragmented")
+        if moov is None:
+            raise Mp4Error("No moov box")
+
+        self.tracks = []
+        init = []
+        for box_type, box_start, payload, box_end in walk_boxes(buf, moov[0], moov[1]):
+            if box_type == b'mvhd':
+                init.append(bytes(buf[box_start:box_end]))
+            elif box_type == b'trak':
+                track = _parse_trak(buf, box_start, box_end)
+                if track.sizes:
+                    self.tracks.append(track)
+                    init.append(_box(b'trak', _rewrite_trak(buf, payload, box_end)))
+        if not self.tracks:
+            raise Mp4Error("No tracks with samples")
+
+        trex = [_full_box(b'trex', 0, 0, struct.pack('>IIIII', track.track_id, 1, 0, 0, 0))
+                for track in self.tracks]
+        init.append(_box(b'mvex', *trex))
+        self._init = _box(b'ftyp', b'iso6', _U32.pack(0), b'iso6', b'mp41') + _box(b'moov', *init)
+
+    def _plan_segments(self, target_duration):
+        ref = self.tracks[0]
+        for track in self.tracks:
+            if track.handler == b'vide':
+                ref = track
+                break
+
+        starts = [0]
+        target = target_duration * ref.timescale
+        for i in range(1, len(ref.sizes)):
+            if ref.is_sync(i) and ref.dts[i] - ref.dts[starts[-1]] >= target:
+                starts.append(i)
+        end_dts = ref.dts[-1] + ref.durations[-1]
+        bounds = [ref.dts[i] for i in starts] + [end_dts]
+
+        self.durations = [(b - a) / ref.timescale for a, b in zip(bounds, bounds[1:])]
+        # Per segment, per track, (first sample, end sample).
+        self.segments = []
+        cuts = {}
+        for track in self.tracks:
+            if track is ref:
+                cuts[track] = starts + [len(ref.sizes)]
+                continue
+            cut = [0]
+            for bound in bounds[1:-1]:
+                cut.append(bisect.bisect_left(track.dts, -(-bound * track.timescale // ref.timescale)))
+            cut.append(len(track.sizes))
+            cuts[track] = cut
+        for n in range(len(starts)):
+            self.segments.append([(cuts[track][n], cuts[track][n + 1]) for track in self.tracks])
+
+    def get_init_segment(self):
+        return self._init
+
+    def get_segment_count(self):
+        return len(self.segments)
+
+    def get_target_duration(self):
+        return int(math.ceil(max(self.durations)))
+
+    def build_segment(self, n):
+        """
+        Bytes of media segment n, a moof and an mdat.
+        """
+        ranges = self.segments[n]
+
+        def moof(data_offsets):
+            trafs = []
+            for track, (first, end), data_offset in zip(self.tracks, ranges, data_offsets):
+                if first == end:
+                    continue
+                flags = 0x000001 | 0x000100 | 0x000200 | 0x000400
+                version = 1
+                fmt = '>III'
+                if track.cts_offsets is not None:
+                    # Same signedness as the source ctts.
+                    flags |= 0x000800
+                    version = 1 if track.cts_signed else 0
+                    fmt = '>IIIi' if track.cts_signed else '>IIII'
+                entries = []
+                for i in range(first, end):
+                    sample = (track.durations[i], track.sizes[i],
+                              SAMPLE_SYNC if track.is_sync(i) else SAMPLE_NON_SYNC)
+                    if track.cts_offsets is not None:
+                        sample += (track.cts_offsets[i],)
+                    entries.append(struct.pack(fmt, *sample))
+                trafs.append(_box(b'traf',
+                                  _full_box(b'tfhd', 0, 0x020000, _U32.pack(track.track_id)),
+                                  _full_box(b'tfdt', 1, 0, struct.pack('>Q', track.dts[first])),
+                                  _full_box(b'trun', version, flags, struct.pack('>Ii', end - first, data_offset),
+                                            *entries)))
+            return _box(b'moof', _full_box(b'mfhd', 0, 0, _U32.pack(n + 1)), *trafs)
+
+        lengths = [sum(track.sizes[first:end]) for track, (first, end) in zip(self.tracks, ranges)]
+        moof_size = len(moof([0] * len(self.tracks)))
+        data_offsets = []
+        offset = moof_size + 8
+        for length in lengths:
+            data_offsets.append(offset)
+            offset += length
+
+        data = []
+        with open(self._path, 'rb') as f:
+            fd = f.fileno()
+            for track, (first, end) in zip(self.tracks, ranges):
+                # Read contiguous samples in one go.
+                run_start = run_end = None
+                for i in range(first, end):
+                    offset = track.offsets[i]
+                    if offset != run_end:
+                        if run_start is not None:
+                            data.append(os.pread(fd, run_end - run_start, run_start))
+                        run_start = offset
+                        run_end = offset
+                    run_end += track.sizes[i]
+                if run_start is not None:
+                    data.append(os.pread(fd, run_end - run_start, run_start))
+
+        mdat = b''.join(data)
+        if len(mdat) != sum(lengths):
+            raise Mp4Error("Source shrank while segmenting")
+        return moof(data_offsets) + _BOX_HEADER.pack(8 + len(mdat), b'mdat') + mdat
+
+
+def hls_key(source_fingerprint, target_duration):
+    desc = 'hls|%s|%s' % ('-'.join(str(f) for f in source_fingerprint), target_duration)
+    return hashlib.sha256(desc.encode('ascii')).hexdigest()[:32]
+
+
+class HlsSegmenter(object):
+
+    def __init__(self, cache_dir, max_bytes=1024 * 1024 * 1024, target_duration=TARGET_DURATION,
+                 max_plans=64, shared=False):
+        """
+        Lazy HLS for library clips: playlists, init and media segments
+        are made on first request from the source MP4's sample tables.
+        Segments are kept in a size-bounded DiskCache, parsed plans in
+        a small in-memory LRU. See DiskCache for shared.
+        """
+        self._cache = DiskCache(cache_dir, max_bytes, shared)
+        self._target_duration = target_duration
+        self._max_plans = max_plans
+        self._plans = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_key(self, source_fingerprint):
+        return hls_key(source_fingerprint, self._target_duration)
+
+    def get_plan(self, source_path, source_fingerprint):
+        """
+        HlsPlan for a source file, or None if it cannot be segmented.
+        """
+        key = self.get_key(source_fingerprint)
+        with self._lock:
+            if key in self._plans:
+                self._plans.move_to_end(key)
+                return self._plans[key]
+
+        try:
+            plan = HlsPlan(source_path, self._target_duration)
+        except (OSError, ValueError, IndexError, struct.error, Mp4Error) as ex:
+            log.warning("Cannot segment '%s': %s", source_path, ex)
+            plan = None
+
+        with self._lock:
+            self._plans[key] = plan
+            while len(self._plans) > self._max_plans:
+                self._plans.popitem(last=False)
+        return plan
+
+    def render_playlist(self, plan, init_url, segment_url):
+        """
+        VOD media playlist. segment_url(n) gives the URL of segment n.
+        """
+        lines = ['#EXTM3U',
+                 '#EXT-X-VERSION:7',
+                 '#EXT-X-TARGETDURATION:%d' % plan.get_target_duration(),
+                 '#EXT-X-PLAYLIST-TYPE:VOD',
+                 '#EXT-X-INDEPENDENT-SEGMENTS',
+                 '#EXT-X-MAP:URI="%s"' % init_url]
+        for n, duration in enumerate(plan.durations):
+            lines.append('#EXTINF:%.3f,' % duration)
+            lines.append(segment_url(n))
+        lines.append('#EXT-X-ENDLIST')
+        return '\n'.join(lines) + '\n'
+
+    def get_init_segment(self, plan, source_fingerprint):
+        """
+        Path of the cached init segment.
+        """
+        return self._cache.get('%s-init.mp4' % self.get_key(source_fingerprint),
+                               lambda path: write_atomic(path, plan.get_init_segment()))
+
+    def get_segment(self, plan, source_fingerprint, n):
+        """
+        Path of cached media segment n, None if there is no such segment.
+        """
+        if n < 0 or n >= plan.get_segment_count():
+            return None
+        return self._cache.get('%s-%05d.m4s' % (self.get_key(source_fingerprint), n),
+                               lambda path: write_atomic(path, plan.build_segment(n)))
+
+    def get_stats(self):
+        stats = self._cache.get_stats()
+        stats['plans'] = len(self._plans)
+        return stats
+
+
+class TestHls(unittest.TestCase):
+
+    SOURCE = '../media/Simple landscape flyover.mp4'
+
+    def test_plan(self):
+        plan = HlsPlan(self.SOURCE, target_duration=2)
+        track = plan.tracks[0]
+        self.assertEqual(track.handler, b'vide')
+        self.assertGreater(plan.get_segment_count(), 1)
+        self.assertAlmostEqual(sum(plan.durations), len(track.sizes) * track.durations[0] / track.timescale)
+
+        # Segments start on key frames and cover every sample once.
+        covered = []
+        for ranges in plan.segments:
+            first, end = ranges[0]
+            self.assertTrue(track.is_sync(first))
+            covered += range(first, end)
+        self.assertEqual(covered, list(range(len(track.sizes))))
+
+        init = plan.get_init_segment()
+        self.assertEqual([t for t, _, _, _ in walk_boxes(init, 0, len(init))], [b'ftyp', b'moov'])
+        self.assertIn(b'mvex', init)
+
+    def test_segment(self):
+        plan = HlsPlan(self.SOURCE, target_duration=2)
+        track = plan.tracks[0]
+        segment = plan.build_segment(1)
+        boxes = dict((t, (p, e)) for t, _, p, e in walk_boxes(segment, 0, len(segment)))
+        self.assertEqual(set(boxes), {b'moof', b'mdat'})
+
+        # trun's data offset points at the first sample of the segment.
+        first, end = plan.segments[1][0]
+        trun = segment.index(b'trun') + 4
+        count, data_offset = struct.unpack_from('>Ii', segment, trun + 4)
+        self.assertEqual(count, end - first)
+        with open(self.SOURCE, 'rb') as f:
+            f.seek(track.offsets[first])
+            expected = f.read(track.sizes[first])
+        self.assertEqual(segment[data_offset:data_offset + len(expected)], expected)
+        self.assertEqual(boxes[b'mdat'][1] - boxes[b'mdat'][0], sum(track.sizes[first:end]))
+
+    def test_unsigned_cts_offsets(self):
+        plan = HlsPlan(self.SOURCE, target_duration=2)
+        track = plan.tracks[0]
+        track.cts_offsets = [2 ** 31 + 5] * len(track.sizes)
+        track.cts_signed = False
+        segment = plan.build_segment(0)
+        trun = segment.index(b'trun') + 4
+        self.assertEqual(segment[trun], 0)
+        # Count and data offset, then duration, size, flags and cts offset.
+        self.assertEqual(struct.unpack_from('>I', segment, trun + 12 + 12)[0], 2 ** 31 + 5)
+
+    def test_segmenter(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            segmenter = HlsSegmenter(tmpdir)
+            st = os.stat(self.SOURCE)
+            fingerprint = (st.st_ino, st.st_size, st.st_mtime_ns)
+            plan = segmenter.get_plan(self.SOURCE, fingerprint)
+            playlist = segmenter.render_playlist(plan, 'init.mp4', lambda n: 'seg%d.m4s' % n)
+            self.assertIn('#EXT-X-MAP:URI="init.mp4"', playlist)
+            self.assertEqual(playlist.count('#EXTINF'), plan.get_segment_count())
+
+            path = segmenter.get_segment(plan, fingerprint, 0)
+            self.assertEqual(segmenter.get_segment(plan, fingerprint, 0), path)
+            self.assertIsNone(segmenter.get_segment(plan, fingerprint, plan.get_segment_count()))
+            self.assertEqual(segmenter.get_stats()['hits'], 1)
+            self.assertIsNone(segmenter.get_plan('../media/hello.txt', (0, 0, 0)))
+
+if __name__ == '__main__':
+    unittest.main()
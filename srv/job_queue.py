@@ -0,0 +1,570 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2019 Erik Mossberg
+
+This file is part of SeriousBusiness.
+
+SeriousBusiness is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+SeriousBusiness is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+import collections
+import concurrent.futures
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import logs
+
+log = logs.get_logger('job_queue')
+
+# Lower runs first.
+PRIORITY_VISIBLE = 0
+PRIORITY_BACKGROUND = 10
+
+# Completions older than this do not count towards throughput.
+THROUGHPUT_WINDOW = 60.0
+
+
+class JobState(object):
+
+    def __init__(self, path):
+        """
+        Persistent job state in an sqlite file.
+
+        Pending jobs are kept until they finish, so a restart picks them
+        up again. Finished jobs keep their result, so work that was done
+        before a restart is not repeated.
+        """
+        self._path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS jobs (kind TEXT, key TEXT,"
+                               " args TEXT, priority INTEGER, state TEXT, attempts INTEGER,"
+                               " result TEXT, PRIMARY KEY (kind, key))")
+            self._conn.commit()
+
+    def get_path(self):
+        return self._path
+
+    def pending(self):
+        """
+        (kind, key, args, priority) of jobs that did not finish.
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT kind, key, args, priority FROM jobs"
+                                      " WHERE state = 'pending'").fetchall()
+        return [(kind, key, json.loads(args), priority) for kind, key, args, priority in rows]
+
+    def get_result(self, kind, key):
+        """
+        (True, result) for a finished job, otherwise (False, None).
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT result FROM jobs WHERE kind = ? AND key = ?"
+                                     " AND state = 'done'", (kind, key)).fetchone()
+        if row is None:
+            return False, None
+        return True, json.loads(row[0])
+
+    def set_pending(self, kind, key, args, priority):
+        self.set_pending_many([(kind, key, args, priority)])
+
+    def set_pending_many(self, jobs):
+        """
+        set_pending() for (kind, key, args, priority) tuples, in one
+        transaction.
+        """
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, 'pending', 0, NULL)",
+                                   [(kind, key, json.dumps(args), priority)
+                                    for kind, key, args, priority in jobs])
+            self._conn.commit()
+
+    def set_done(self, kind, key, result):
+        self._write("UPDATE jobs SET state = 'done', result = ? WHERE kind = ? AND key = ?",
+                    (json.dumps(result), kind, key))
+
+    def set_failed(self, kind, key, attempts):
+        self._write("UPDATE jobs SET state = 'failed', attempts = ? WHERE kind = ? AND key = ?",
+                    (attempts, kind, key))
+
+    def _write(self, sql, params):
+        with self._lock:
+            self._conn.execute(sql, params)
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class Job(object):
+
+    def __init__(self, kind, key, args, priority):
+        self.kind = kind
+        self.key = key
+        self.args = args
+        self.priority = priority
+        self.attempts = 0
+        self.not_before = 0.0
+
+
+class JobQueue(object):
+
+    def __init__(self, workers=2, state_path=None, use_processes=True,
+                 max_attempts=3, backoff=2.0):
+        """
+        Background jobs for expensive per-clip work, such as deriving
+        thumbnails, probing or checksumming media.
+
+        Jobs are identified by kind and key. Each kind is registered with
+        a module level function that runs in a bounded pool of worker
+        processes (threads with use_processes False), and an optional
+        on_done(key, result) callback run in this process. Failed jobs
+        are retried with exponential back-off, up to max_attempts.
+
+        With a state_path, pending jobs and results survive restarts.
+        Start and stop it with the server, e.g. from the engine bus.
+        """
+        self._workers = max(1, workers)
+        self._use_processes = use_processes
+        self._max_attempts = max_attempts
+        self._backoff = backoff
+        self._state = JobState(state_path) if state_path else None
+
+        self._handlers = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._queued = {}
+        self._running = set()
+        self._cond = threading.Condition(threading.RLock())
+        self._executor = None
+        self._thread = None
+        self._stopping = False
+
+        self._completed = collections.deque()
+        self._done = 0
+        self._failed = 0
+        self._retries = 0
+
+    def register(self, kind, func, on_done=None):
+        self._handlers[kind] = (func, on_done)
+
+    def get_result(self, kind, key):
+        """
+        (True, result) if a job has finished, also in an earlier run
+        with persistent state, otherwise (False, None).
+        """
+        if self._state is None:
+            return False, None
+        return self._state.get_result(kind, key)
+
+    def submit(self, kind, key, args=(), priority=PRIORITY_BACKGROUND, redo=False):
+        """
+        Queue a job, unless it already finished and redo is False.
+
+        A job that is already queued keeps its place, or moves ahead if
+        submitted again with a higher priority. Returns whether the job
+        is queued or running.
+        """
+        return self.submit_many([(kind, key, args, priority)], redo)[0]
+
+    def submit_many(self, jobs, redo=False):
+        """
+        submit() for (kind, key, args, priority) tuples, with the state
+        of the new jobs saved in one transaction. Returns whether each
+        job is queued or running.
+        """
+        jobs = list(jobs)
+        for kind, _, _, _ in jobs:
+            if kind not in self._handlers:
+                raise KeyError("No handler for job kind '%s'" % kind)
+
+        queued = []
+        added = []
+        with self._cond:
+            for kind, key, args, priority in jobs:
+                if not redo and self.get_result(kind, key)[0]:
+                    queued.append(False)
+                    continue
+                queued.append(True)
+                job_id = (kind, key)
+                if job_id in self._running:
+                    continue
+                job = self._queued.get(job_id)
+                if job is not None:
+                    if priority < job.priority:
+                        job.priority = priority
+                        self._push(job)
+                    continue
+
+                job = Job(kind, key, list(args), priority)
+                self._queued[job_id] = job
+                added.append(job)
+
+            # Saved before any of them can run and finish.
+            if self._state is not None and added:
+                self._state.set_pending_many([(job.kind, job.key, job.args, job.priority)
+                                              for job in added])
+            for job in added:
+                self._push(job)
+        return queued
+
+    def listen(self, source):
+        """
+        Submit the jobs that JobForwarders in other processes put on
+        source, a multiprocessing queue, from a thread until None is
+        put on it.
+        """
+        def run():
+            while True:
+                forwarded = source.get()
+                if forwarded is None:
+                    return
+                jobs, redo = forwarded
+                try:
+                    self.submit_many(jobs, redo)
+                except KeyError as ex:
+                    log.warning("Dropped forwarded jobs: %s", ex)
+
+        thread = threading.Thread(target=run, name='JobListener', daemon=True)
+        thread.start()
+        return thread
+
+    def _push(self, job):
+        # Entries are not removed when a job moves, stale ones are
+        # skipped when popped.
+        with self._cond:
+            heapq.heappush(self._heap, (job.priority, job.not_before, next(self._seq), job))
+            self._cond.notify()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        if self._state is not None:
+            resumed = self._state.pending()
+            for kind, key, args, priority in resumed:
+                if kind in self._handlers:
+                    self.submit(kind, key, args, priority, redo=True)
+            if resumed:
+                log.info("Resuming %d background jobs.", len(resumed))
+
+        if self._use_processes:
+            # Spawn, as forking a threaded server is unsafe.
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                self._workers, mp_context=multiprocessing.get_context('spawn'))
+        else:
+            self._executor = concurrent.futures.ThreadPoolExecutor(self._workers)
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='JobQueue', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._thread = None
+        # Running jobs finish, queued ones stay pending in the state.
+        self._executor.shutdown(wait=True)
+        self._executor = None
+
+    def _next_job(self):
+        """
+        Pop the most urgent runnable job. Returns (job, wait), with job
+        None when nothing can run yet.
+        """
+        now = time.monotonic()
+        deferred = []
+        found = None
+        wait = None
+        while self._heap:
+            priority, not_before, _, job = heapq.heappop(self._heap)
+            if self._queued.get((job.kind, job.key)) is not job or \
+                    priority != job.priority or not_before != job.not_before:
+                continue
+            if not_before > now:
+                deferred.append((priority, not_before, next(self._seq), job))
+                wait = not_before - now if wait is None else min(wait, not_before - now)
+                continue
+            found = job
+            break
+        for entry in deferred:
+            heapq.heappush(self._heap, entry)
+        return found, wait
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopping:
+                        return
+                    job, wait = None, None
+                    if len(self._running) < self._workers:
+                        job, wait = self._next_job()
+                    if job is not None:
+                        break
+                    self._cond.wait(wait)
+
+                del self._queued[(job.kind, job.key)]
+                self._running.add((job.kind, job.key))
+
+            func, _ = self._handlers[job.kind]
+            try:
+                future = self._executor.submit(func, *job.args)
+            except RuntimeError:
+                # Executor shut down underneath us.
+                return
+            future.add_done_callback(lambda f, job=job: self._finished(job, f))
+
+    def _finished(self, job, future):
+        job_id = (job.kind, job.key)
+        try:
+            result = future.result()
+            error = None
+        except Exception as ex:
+            result = None
+            error = ex
+
+        if error is None:
+            _, on_done = self._handlers[job.kind]
+            if on_done is not None:
+                try:
+                    on_done(job.key, result)
+                except Exception as ex:
+                    log.warning("Job %s '%s' completion failed: %s", job.kind, job.key, ex)
+            if self._state is not None:
+                try:
+                    self._state.set_done(job.kind, job.key, result)
+                except (TypeError, ValueError, sqlite3.Error) as ex:
+                    log.warning("Could not store result of job %s '%s': %s", job.kind, job.key, ex)
+
+        with self._cond:
+            self._running.discard(job_id)
+            if error is None:
+                self._done += 1
+                self._completed.append(time.monotonic())
+            else:
+                job.attempts += 1
+                if job.attempts < self._max_attempts and job_id not in self._queued:
+                    log.warning("Job %s '%s' failed (%s), retrying.", job.kind, job.key, error)
+                    self._retries += 1
+                    job.not_before = time.monotonic() + self._backoff * 2 ** (job.attempts - 1)
+                    self._queued[job_id] = job
+                    self._push(job)
+                else:
+                    log.warning("Job %s '%s' failed (%s), giving up.", job.kind, job.key, error)
+                    self._failed += 1
+                    if self._state is not None:
+                        self._state.set_failed(job.kind, job.key, job.attempts)
+            self._cond.notify()
+
+    def wait_idle(self, timeout=None):
+        """
+        Block until no jobs are queued or running. Returns whether it
+        became idle within timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._cond:
+                if not self._queued and not self._running:
+                    return True
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+
+    def get_stats(self):
+        with self._cond:
+            now = time.monotonic()
+            while self._completed and now - self._completed[0] > THROUGHPUT_WINDOW:
+                self._completed.popleft()
+            depth = collections.Counter(job.kind for job in self._queued.values())
+            return {
+                'queued': len(self._queued),
+                'queued_by_kind': dict(depth),
+                'running': len(self._running),
+                'workers': self._workers,
+                'done': self._done,
+                'failed': self._failed,
+                'retries': self._retries,
+                'per_minute': len(self._completed) * 60.0 / THROUGHPUT_WINDOW,
+            }
+
+
+class JobForwarder(object):
+
+    def __init__(self, target, state_path=None):
+        """
+        Stands in for the JobQueue of another process, e.g. the one
+        scanning the library for --workers processes. Submitted jobs
+        are put on target, a multiprocessing queue that process reads
+        with JobQueue.listen(), and run there. Results are read from
+        that queue's state_path, if it has one.
+        """
+        self._target = target
+        self._state = JobState(state_path) if state_path else None
+        self._kinds = set()
+        self._forwarded = 0
+
+    def register(self, kind, func=None, on_done=None):
+        # Both run in the process running the job.
+        self._kinds.add(kind)
+
+    def get_result(self, kind, key):
+        if self._state is None:
+            return False, None
+        try:
+            return self._state.get_result(kind, key)
+        except sqlite3.Error as ex:
+            log.debug("Could not read result of job %s '%s': %s", kind, key, ex)
+            return False, None
+
+    def submit(self, kind, key, args=(), priority=PRIORITY_BACKGROUND, redo=False):
+        return self.submit_many([(kind, key, args, priority)], redo)[0]
+
+    def submit_many(self, jobs, redo=False):
+        queued = []
+        forwarded = []
+        for kind, key, args, priority in jobs:
+            if kind not in self._kinds:
+                raise KeyError("No handler for job kind '%s'" % kind)
+            if not redo and self.get_result(kind, key)[0]:
+                queued.append(False)
+                continue
+            queued.append(True)
+            forwarded.append((kind, key, list(args), priority))
+        if forwarded:
+            self._target.put((forwarded, redo))
+            self._forwarded += len(forwarded)
+        return queued
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def get_stats(self):
+        return {'forwarded': self._forwarded}
+
+
+def _square(value):
+    return value * value
+
+
+_flaky_calls = collections.Counter()
+
+
+def _flaky(key):
+    _flaky_calls[key] += 1
+    if _flaky_calls[key] < 2:
+        raise IOError("flaky")
+    return key
+
+
+class TestJobQueue(unittest.TestCase):
+
+    def test_priorities_and_results(self):
+        order = []
+        queue = JobQueue(workers=1, use_processes=False)
+        queue.register('square', _square, lambda key, result: order.append((key, result)))
+        queue.submit('square', 'a', [2])
+        queue.submit('square', 'b', [3])
+        queue.submit('square', 'c', [4], priority=PRIORITY_VISIBLE)
+        self.assertEqual(queue.get_stats()['queued_by_kind'], {'square': 3})
+
+        queue.start()
+        self.assertTrue(queue.wait_idle(5))
+        queue.stop()
+        self.assertEqual(order, [('c', 16), ('a', 4), ('b', 9)])
+        self.assertEqual(queue.get_stats()['done'], 3)
+
+    def test_retry(self):
+        queue = JobQueue(workers=1, use_processes=False, backoff=0.01)
+        queue.register('flaky', _flaky)
+        queue.start()
+        queue.submit('flaky', 'x', ['x'])
+        self.assertTrue(queue.wait_idle(5))
+        queue.stop()
+        stats = queue.get_stats()
+        self.assertEqual((stats['done'], stats['retries'], stats['failed']), (1, 1, 0))
+
+    def test_persistent_state(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            state_path = os.path.join(tmpdir, 'jobs.db')
+            queue = JobQueue(workers=1, state_path=state_path, use_processes=False)
+            queue.register('square', _square)
+            queue.submit('square', 'done', [5])
+            queue.start()
+            self.assertTrue(queue.wait_idle(5))
+            queue.stop()
+            # Never started, so left pending.
+            queue.submit('square', 'left', [6])
+
+            results = []
+            resumed = JobQueue(workers=2, state_path=state_path)
+            resumed.register('square', _square, lambda key, result: results.append((key, result)))
+            self.assertEqual(resumed.get_result('square', 'done'), (True, 25))
+            self.assertFalse(resumed.submit('square', 'done', [5]))
+            self.assertEqual(resumed.submit_many([('square', 'done', [5], PRIORITY_BACKGROUND),
+                                                  ('square', 'more', [7], PRIORITY_BACKGROUND)]),
+                             [False, True])
+            resumed.start()
+            self.assertTrue(resumed.wait_idle(30))
+            resumed.stop()
+            self.assertEqual(sorted(results), [('left', 36), ('more', 49)])
+
+    def test_forwarder(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            state_path = os.path.join(tmpdir, 'jobs.db')
+            results = []
+            queue = JobQueue(workers=1, state_path=state_path, use_processes=False)
+            queue.register('square', _square, lambda key, result: results.append((key, result)))
+            source = multiprocessing.get_context('spawn').Queue()
+            listener = queue.listen(source)
+
+            forwarder = JobForwarder(source, state_path)
+            forwarder.register('square')
+            self.assertRaises(KeyError, forwarder.submit, 'nope', 'x')
+            self.assertTrue(forwarder.submit('square', 'a', [3]))
+            queue.start()
+            deadline = time.monotonic() + 5
+            while not results and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertTrue(queue.wait_idle(5))
+            self.assertEqual(results, [('a', 9)])
+
+            # Done, as seen from the forwarding process too.
+            self.assertEqual(forwarder.get_result('square', 'a'), (True, 9))
+            self.assertEqual(forwarder.submit_many([('square', 'a', [3], PRIORITY_BACKGROUND)]), [False])
+            self.assertEqual(forwarder.get_stats(), {'forwarded': 1})
+            source.put(None)
+            listener.join(5)
+            self.assertFalse(listener.is_alive())
+            queue.stop()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2019 Erik Mossberg
+
+This file is part of SeriousBusiness.
+
+SeriousBusiness is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+SeriousBusiness is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+import os
+import json
+import sqlite3
+import tempfile
+
+from media_clip import MediaClip
+from mp4_probe import Mp4Info
+import logs
+
+log = logs.get_logger('library_catalog')
+
+
+class LibraryCatalog(object):
+
+    SCHEMA_VERSION = 3
+
+    def __init__(self, path):
+        """
+        Persistent snapshot of a MediaLibrary's parsed clips.
+
+        Stored as an sqlite file. Every sidecar json and media file is
+        one row holding its stat fingerprint and the clip fields it
+        produced, so a restart only needs to re-parse files whose
+        fingerprint changed. Content hashes of media files are kept
+        the same way.
+        """
+        self._path = path
+
+    def get_path(self):
+        return self._path
+
+    def load(self, directory_name):
+        """
+        Load a catalog written for directory_name.
+
+        Returns (json_cache, raw_cache, hash_cache, thumbnail_signature)
+        in the format MediaLibrary uses, or None if there is no usable catalog.
+        """
+        if not os.path.exists(self._path):
+            return None
+
+        try:
+            conn = sqlite3.connect(self._path)
+            try:
+                meta = dict(conn.execute("SELECT key, value FROM meta"))
+                if meta.get('schema_version') != str(self.SCHEMA_VERSION) or \
+                        meta.get('directory_name') != os.path.abspath(directory_name):
+                    log.warning("Ignoring catalog '%s' written for another library.", self._path)
+                    return None
+
+                caches = {'json': {}, 'raw': {}}
+                rows = conn.execute(
+                    "SELECT kind, relpath, ino, size, mtime_ns, has_clip, inferred,"
+                    " uid, filename, title, thumbnail, media_info FROM entries")
+                for kind, relpath, ino, size, mtime_ns, has_clip, inferred, *fields, media_info in rows:
+                    clip = None
+                    if has_clip:
+                        if media_info is not None:
+                            media_info = Mp4Info.from_dict(json.loads(media_info))
+                        clip = MediaClip.from_fields(fields, media_info)
+                    caches[kind][relpath] = ((ino, size, mtime_ns), clip, bool(inferred))
+                hash_cache = {}
+                for relpath, ino, size, mtime_ns, content_hash in conn.execute(
+                        "SELECT relpath, ino, size, mtime_ns, hash FROM hashes"):
+                    hash_cache[relpath] = ((ino, size, mtime_ns), content_hash)
+            finally:
+                conn.close()
+        except sqlite3.Error as ex:
+            log.warning("Failed to load catalog '%s': %s", self._path, ex)
+            return None
+
+        return caches['json'], caches['raw'], hash_cache, meta.get('thumbnail_signature')
+
+    def save(self, directory_name, json_cache, raw_cache, hash_cache, thumbnail_signature):
+        """
+        Write a new catalog, atomically replacing the previous one.
+        """
+        tmp_path = '%s.tmp%d' % (self._path, os.getpid())
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        conn = sqlite3.connect(tmp_path)
+        try:
+            conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+            conn.execute("CREATE TABLE entries (kind TEXT, relpath TEXT, ino INTEGER,"
+                         " size INTEGER, mtime_ns INTEGER, has_clip INTEGER, inferred INTEGER,"
+                         " uid TEXT, filename TEXT, title TEXT, thumbnail TEXT, media_info TEXT,"
+                         " PRIMARY KEY (kind, relpath))")
+            conn.execute("CREATE TABLE hashes (relpath TEXT PRIMARY KEY, ino INTEGER,"
+                         " size INTEGER, mtime_ns INTEGER, hash TEXT)")
+            conn.executemany("INSERT INTO meta VALUES (?, ?)", [
+                ('schema_version', str(self.SCHEMA_VERSION)),
+                ('directory_name', os.path.abspath(directory_name)),
+                ('thumbnail_signature', thumbnail_signature),
+            ])
+            conn.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             self._rows('json', json_cache) + self._rows('raw', raw_cache))
+            conn.executemany("INSERT INTO hashes VALUES (?, ?, ?, ?, ?)",
+                             [(relpath,) + tuple(fingerprint) + (content_hash,)
+                              for relpath, (fingerprint, content_hash) in hash_cache.items()])
+            conn.commit()
+        finally:
+            conn.close()
+
+        os.replace(tmp_path, self._path)
+
+    def _rows(self, kind, cache):
+        rows = []
+        for relpath, (fingerprint, clip, inferred) in cache.items():
+            fields = (None,) * 4 if clip is None else clip.to_fields()
+            media_info = None
+            if clip is not None and clip.get_media_info() is not None:
+                media_info = json.dumps(clip.get_media_info().to_dict())
+            rows.append((kind, relpath) + tuple(fingerprint) +
+                        (clip is not None, inferred) + fields + (media_info,))
+        return rows
+
+
+class TestLibraryCatalog(unittest.TestCase):
+
+    def test_roundtrip(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            catalog = LibraryCatalog(os.path.join(tmpdir, 'catalog.db'))
+            self.assertIsNone(catalog.load('../media'))
+
+            clip = MediaClip('foo', 'foo.mp4', 'Foo', None).with_media_info(Mp4Info(duration=1.5))
+            json_cache = {'foo.json': ((1, 2, 3), clip, True), 'bad.json': ((4, 5, 6), None, False)}
+            hash_cache = {'foo.mp4': ((7, 8, 9), '0123456789abcdef')}
+            catalog.save('../media', json_cache, {}, hash_cache, 'abc')
+
+            loaded_json, loaded_raw, loaded_hashes, signature = catalog.load('../media')
+            self.assertEqual(signature, 'abc')
+            self.assertEqual(loaded_raw, {})
+            self.assertEqual(loaded_hashes, hash_cache)
+            self.assertEqual(loaded_json['bad.json'], ((4, 5, 6), None, False))
+            fingerprint, loaded_clip, inferred = loaded_json['foo.json']
+            self.assertEqual(fingerprint, (1, 2, 3))
+            self.assertTrue(inferred)
+            self.assertEqual(loaded_clip.to_fields(), clip.to_fields())
+            self.assertEqual(loaded_clip.get_media_info(), Mp4Info(duration=1.5))
+
+            self.assertIsNone(catalog.load('../srv'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2019 Erik Mossberg
+
+This file is part of SeriousBusiness.
+
+SeriousBusiness is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+SeriousBusiness is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import tempfile
+import threading
+import time
+
+import logs
+
+log = logs.get_logger('library_watcher')
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = os.O_CLOEXEC
+IN_NONBLOCK = os.O_NONBLOCK
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify(object):
+
+    def __init__(self):
+        """
+        Minimal ctypes binding to the Linux inotify API.
+
+        Raises OSError if inotify is not available.
+        """
+        libc_name = ctypes.util.find_library('c')
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify not available")
+
+        self._libc = libc
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def fileno(self):
+        return self._fd
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        """
+        Watch a directory, returns the watch descriptor.
+        """
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._libc.inotify_rm_watch(self._fd, wd)
+
+    def read_events(self):
+        """
+        Read pending events as a list of (wd, mask, cookie, name).
+        """
+        try:
+            buf = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(buf):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(buf, offset)
+            offset += _EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class LibraryWatcher(object):
+
+    def __init__(self, directory_name, on_change, debounce=1.0, max_delay=10.0,
+                 poll_interval=30.0, use_inotify=True):
+        """
+        Watches a media directory tree and reports changes in batches.
+
+        on_change(dirty_dirs) is called from a background thread with
+        the directories (relative to directory_name) touched during one
+        debounce window, or with None when everything should be
+        rescanned. A batch is flushed once no events arrived for
+        debounce seconds, or at the latest max_delay seconds after its
+        first event.
+
+        Falls back to calling on_change(None) every poll_interval
+        seconds if inotify is unavailable.
+        """
+        self._directory_name = directory_name
+        self._on_change = on_change
+        self._debounce = debounce
+        self._max_delay = max_delay
+        self._poll_interval = poll_interval
+        self._use_inotify = use_inotify
+        self._stopping = threading.Event()
+        self._thread = None
+        self._inotify = None
+        self._wd_to_reldir = {}
+        self._full_rescan = False
+        self._dirty = set()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='LibraryWatcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+
+    def is_polling(self):
+        return self._inotify is None
+
+    def _run(self):
+        if self._use_inotify:
+            try:
+                self._inotify = Inotify()
+                self._watch_tree('')
+                self._dirty = set()
+            except OSError as ex:
+                log.warning("Inotify unavailable (%s), polling every %s s.", ex, self._poll_interval)
+                self._close_inotify()
+
+        try:
+            if self._inotify is None:
+                self._run_polling()
+            else:
+                self._run_inotify()
+        finally:
+            self._close_inotify()
+
+    def _close_inotify(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+        self._wd_to_reldir = {}
+
+    def _run_polling(self):
+        while not self._stopping.wait(self._poll_interval):
+            self._notify(None)
+
+    def _run_inotify(self):
+        first_event = None
+        last_event = None
+        while not self._stopping.is_set():
+            timeout = 0.5
+            if first_event is not None:
+                deadline = min(last_event + self._debounce, first_event + self._max_delay)
+                timeout = max(0.0, min(timeout, deadline - time.monotonic()))
+
+            readable, _, _ = select.select([self._inotify], [], [], timeout)
+            now = time.monotonic()
+            if readable:
+                for event in self._inotify.read_events():
+                    self._handle_event(*event)
+                if self._dirty or self._full_rescan:
+                    last_event = now
+                    if first_event is None:
+                        first_event = now
+
+            if first_event is None:
+                continue
+
+            if now >= last_event + self._debounce or now >= first_event + self._max_delay:
+                dirty = None if self._full_rescan else sorted(self._dirty)
+                self._dirty = set()
+                self._full_rescan = False
+                first_event = None
+                last_event = None
+                self._notify(dirty)
+
+    def _notify(self, dirty_dirs):
+        try:
+            self._on_change(dirty_dirs)
+        except Exception as ex:
+            log.error("Library update failed: %s", ex)
+
+    def _watch_tree(self, reldir):
+        """
+        Add watches for reldir and every directory below it. Every
+        watched directory is marked dirty, since files may have landed
+        in it before the watch existed.
+        """
+        pending = [reldir]
+        while pending:
+            current = pending.pop()
+            abspath = os.path.join(self._directory_name, current)
+            try:
+                wd = self._inotify.add_watch(abspath)
+            except OSError as ex:
+                if ex.errno == errno.ENOSPC:
+                    # Out of watches, a partial watch would silently miss changes.
+                    raise
+                continue
+
+            self._wd_to_reldir[wd] = current
+            self._dirty.add(current)
+            try:
+                with os.scandir(abspath) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(os.path.join(current, entry.name))
+            except OSError:
+                pass
+
+    def _unwatch_tree(self, reldir):
+        prefix = reldir + os.sep
+        for wd, watched in list(self._wd_to_reldir.items()):
+            if watched == reldir or watched.startswith(prefix):
+                self._inotify.rm_watch(wd)
+                del self._wd_to_reldir[wd]
+
+    def _handle_event(self, wd, mask, cookie, name):
+        if mask & IN_Q_OVERFLOW:
+            self._full_rescan = True
+            return
+
+        reldir = self._wd_to_reldir.get(wd)
+        if reldir is None:
+            return
+
+        if mask & IN_IGNORED:
+            del self._wd_to_reldir[wd]
+            return
+
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            if reldir == '':
+                self._full_rescan = True
+            return
+
+        self._dirty.add(reldir)
+        if not name or not mask & IN_ISDIR:
+            return
+
+        relpath = os.path.join(reldir, name)
+        if mask & (IN_CREATE | IN_MOVED_TO):
+            try:
+                self._watch_tree(relpath)
+            except OSError:
+                self._full_rescan = True
+        elif mask & IN_MOVED_FROM:
+            self._unwatch_tree(relpath)
+
+
+class TestLibraryWatcher(unittest.TestCase):
+
+    def _watch(self, tmpdir, use_inotify):
+        batches = []
+        watcher = LibraryWatcher(tmpdir, batches.append, debounce=0.2,
+                                 poll_interval=0.2, use_inotify=use_inotify)
+        watcher.start()
+        # Let the watcher set up before producing events.
+        time.sleep(0.2)
+        return watcher, batches
+
+    def test_debounced_batch(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            watcher, batches = self._watch(tmpdir, True)
+            if watcher.is_polling():
+                watcher.stop()
+                self.skipTest("inotify not available")
+
+            os.mkdir(os.path.join(tmpdir, 'sub'))
+            for i in range(100):
+                with open(os.path.join(tmpdir, 'sub', 'clip%d.mp4' % i), 'w') as f:
+                    f.write('x')
+            time.sleep(0.8)
+            watcher.stop()
+
+            self.assertEqual(len(batches), 1)
+            self.assertEqual(batches[0], ['', 'sub'])
+
+    def test_polling_fallback(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            watcher, batches = self._watch(tmpdir, False)
+            time.sleep(0.3)
+            watcher.stop()
+            self.assertTrue(watcher.is_polling())
+            self.assertIn(None, batches)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2019 Erik Mossberg
+
+This file is part of SeriousBusiness.
+
+SeriousBusiness is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+SeriousBusiness is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+import logging
+import threading
+import time
+
+LEVELS = ('debug', 'info', 'warning', 'error')
+
+# Records with the same message template are let through this many
+# times per window, the rest are counted and summarized.
+RATE_LIMIT_BURST = 10
+RATE_LIMIT_WINDOW = 10.0
+
+# Distinct templates tracked before the table is reset.
+MAX_TRACKED = 10000
+
+
+class RateLimitFilter(logging.Filter):
+
+    def __init__(self, burst=RATE_LIMIT_BURST, window=RATE_LIMIT_WINDOW, clock=time.monotonic):
+        """
+        Lets at most burst records per message template through in each
+        window of seconds. The first record after a window with drops
+        says how many were dropped.
+
+        Keyed on the unformatted message, so a failure repeated for
+        every file of a large library is one key.
+        """
+        super().__init__()
+        self._burst = burst
+        self._window = window
+        self._clock = clock
+        self._lock = threading.Lock()
+        # (logger, template) -> [window start, passed, dropped]
+        self._windows = {}
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = self._clock()
+        with self._lock:
+            state = self._windows.get(key)
+            if state is None:
+                if len(self._windows) >= MAX_TRACKED:
+                    self._windows.clear()
+                state = self._windows[key] = [now, 0, 0]
+            elif now - state[0] >= self._window:
+                dropped = state[2]
+                state[:] = [now, 0, 0]
+                if dropped:
+                    record.msg = '%s (%d similar messages suppressed)' % (record.getMessage(), dropped)
+                    record.args = None
+
+            if state[1] >= self._burst:
+                state[2] += 1
+                return False
+            state[1] += 1
+            return True
+
+
+_filter = RateLimitFilter()
+
+
+def get_logger(name):
+    """
+    Logger for a module, rate limited per message template.
+    """
+    logger = logging.getLogger('sbsns.' + name)
+    if _filter not in logger.filters:
+        logger.addFilter(_filter)
+    return logger
+
+
+def configure(level='info'):
+    """
+    Log to stderr at level and above. Without this only warnings and
+    errors are shown, by the logging module's last resort handler.
+    """
+    root = logging.getLogger('sbsns')
+    root.setLevel(getattr(logging, level.upper()))
+    if not root.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+        root.addHandler(handler)
+        root.propagate = False
+
+
+class TestRateLimitFilter(unittest.TestCase):
+
+    def _record(self, msg, *args):
+        return logging.LogRecord('sbsns.test', logging.INFO, __file__, 0, msg, args, None)
+
+    def test_burst(self):
+        now = [0.0]
+        limit = RateLimitFilter(burst=2, window=10.0, clock=lambda: now[0])
+        passed = [limit.filter(self._record("Failed '%s'", n)) for n in range(5)]
+        self.assertEqual(passed, [True, True, False, False, False])
+        # Other templates have their own budget.
+        self.assertTrue(limit.filter(self._record("Other")))
+
+        now[0] = 10.0
+        record = self._record("Failed '%s'", 5)
+        self.assertTrue(limit.filter(record))
+        self.assertEqual(record.getMessage(), "Failed '5' (3 similar messages suppressed)")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -21,13 +21,27 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import unittest
-import pathlib
 import os
+import re
+import random
+
+from dir_index import DirectoryIndex
+import logs
+
+log = logs.get_logger('media_clip')
 
 class MediaClip():
 
+    # Libraries hold millions of clips, keep them free of a per
+    # instance __dict__.
+    __slots__ = ('_uid', '_filename', '_title', '_thumbnail_filename', '_media_info')
+
     VALID_STR_CHARS = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ -_.}[]{()|"
 
+    # VALID_STR_CHARS precompiled, so whole strings are checked in C.
+    _VALID_BYTES = VALID_STR_CHARS.encode('ascii')
+    _INVALID_CHAR = re.compile('[^%s]' % re.escape(VALID_STR_CHARS))
+
     def __init__(self, uid, filename, title, thumbnail_filename):
         """
         Simple media item.
@@ -36,9 +50,10 @@ class MediaClip():
         self._uid = self.check_string_safe(uid)
         self._title = self.check_string_safe(title)
         self._thumbnail_filename = self.check_string_safe(thumbnail_filename)
+        self._media_info = None
 
 
-    def infer_thumbnail(self, thumbs_directory=None):
+    def infer_thumbnail(self, thumbs_directory=None, dir_index=None):
         """
         Make an attempt at inferring a thumbnail.
 
@@ -47,29 +62,59 @@ class MediaClip():
            name as the media file, with a different extension.
          - Clip is audio only, but there is only one jpg in the
            directory (i.e. podcasts, albums).
-        """
-        if thumbs_directory:
-            whitelist = []
-            whitelist += [str(p) for p in pathlib.Path(thumbs_directory).rglob("*jpg")]
-            whitelist += [str(p) for p in pathlib.Path(thumbs_directory).rglob("*jpeg")]
-            whitelist += [str(p) for p in pathlib.Path(thumbs_directory).rglob("*png")]
-            whitelist += [str(p) for p in pathlib.Path(thumbs_directory).rglob("*gif")]
 
-            whitelist = [os.path.basename(p) for p in whitelist]
+        Pass a prebuilt DirectoryIndex as dir_index to avoid walking
+        thumbs_directory once per clip.
+        """
+        if dir_index is None and thumbs_directory:
+            dir_index = DirectoryIndex(thumbs_directory)
 
-            if len(whitelist) == 1:
-                return whitelist[0]
+        if dir_index is not None:
+            if dir_index.count_thumbnails() == 1:
+                return dir_index.any_thumbnail()
 
             base, _ = os.path.splitext(self._filename)
 
-            candidates = ['%s.jpg' % base, '%s.jpeg' % base, '%s.png' % base, '%s.gif' % base]
-            for candidate in candidates:
-                if candidate in whitelist:
-                    print("Inferred thumbnail %s for base %s" % (candidate, base))
-                    self._thumbnail_filename = candidate
-                    return
+            candidate = dir_index.find_thumbnail(base)
+            if candidate is not None:
+                log.debug("Inferred thumbnail %s for base %s", candidate, base)
+                self._thumbnail_filename = candidate
+                return
+
+            log.debug("Could not infer thumbnail for media filename %s, %d candidate images", self._filename, dir_index.count_thumbnails())
+
+    def to_fields(self):
+        """
+        Raw (uid, filename, title, thumbnail_filename), for persisting.
+        """
+        return (self._uid, self._filename, self._title, self._thumbnail_filename)
+
+    @classmethod
+    def from_fields(cls, fields, media_info=None):
+        """
+        Rebuild a clip from to_fields() output.
+
+        Skips validation, only use for fields that were validated
+        when the clip was first created.
+        """
+        clip = cls.__new__(cls)
+        clip._uid, clip._filename, clip._title, clip._thumbnail_filename = fields
+        clip._media_info = media_info
+        return clip
 
-            print("Could not infer thumbnail for media filename %s, whitelist is '%s' " % (self._filename, whitelist))
+    def without_thumbnail(self):
+        """
+        Copy of this clip with no thumbnail, for re-running inference.
+        """
+        clip = MediaClip(self._uid, self._filename, self._title, None)
+        clip._media_info = self._media_info
+        return clip
+
+    def with_media_info(self, media_info):
+        """
+        Copy of this clip carrying media_info.
+        """
+        return MediaClip.from_fields(self.to_fields(), media_info)
 
     @classmethod
     def check_string_safe(cls, string):
@@ -92,11 +137,57 @@ class MediaClip():
         if len(string) == 0:
             raise TypeError("Validation failed, got empty string.")
 
-        for ch in string:
-            if ch not in cls.VALID_STR_CHARS:
-                raise TypeError("Validation failed, got invalid char '%s'<%s> for string '%s'" % (ch, ord(ch), string))
+        if not isinstance(string, str):
+            for ch in string:
+                if ch not in cls.VALID_STR_CHARS:
+                    raise TypeError("Validation failed, got invalid char '%s'<%s> for string '%s'" % (ch, ord(ch), string))
+            return string
+
+        # Deleting every valid byte leaves nothing of a valid string.
+        if string.isascii() and not string.encode('ascii').translate(None, cls._VALID_BYTES):
+            return string
+        ch = cls._INVALID_CHAR.search(string).group()
+        raise TypeError("Validation failed, got invalid char '%s'<%s> for string '%s'" % (ch, ord(ch), string))
+
+    @classmethod
+    def check_strings_safe(cls, strings):
+        """
+        For each of strings, whether check_string_safe accepts it.
 
-        return string
+        Meant for all fields of many clips at once. Non-empty strings
+        are checked in a single pass over their concatenation, halved
+        until the invalid ones are isolated, so a few bad strings in a
+        large batch cost a few extra passes.
+        """
+        strings = list(strings)
+        verdicts = [True] * len(strings)
+        plain = []
+        for i, string in enumerate(strings):
+            if isinstance(string, str) and string:
+                plain.append(i)
+            elif string is not None:
+                verdicts[i] = cls._accepts(string)
+
+        pending = [plain]
+        while pending:
+            indexes = pending.pop()
+            joined = ''.join([strings[i] for i in indexes])
+            if joined.isascii() and not joined.encode('ascii').translate(None, cls._VALID_BYTES):
+                continue
+            if len(indexes) == 1:
+                verdicts[indexes[0]] = False
+                continue
+            middle = len(indexes) // 2
+            pending += [indexes[:middle], indexes[middle:]]
+        return verdicts
+
+    @classmethod
+    def _accepts(cls, string):
+        try:
+            cls.check_string_safe(string)
+            return True
+        except TypeError:
+            return False
 
     @classmethod
     def censor_string_chs(cls, string):
@@ -105,13 +196,9 @@ class MediaClip():
 
         This may result in 0-length strings.
         """
-
-        toreturn = ""
-        for ch in string:
-            if ch in cls.VALID_STR_CHARS:
-                toreturn += ch
-
-        return toreturn
+        if isinstance(string, str):
+            return cls._INVALID_CHAR.sub('', string)
+        return ''.join(ch for ch in string if ch in cls.VALID_STR_CHARS)
 
     def get_uid(self):
         """
@@ -127,6 +214,25 @@ class MediaClip():
             return 'static/missing_media.jpg'
         return "serve_content?fkey=%s" % self._thumbnail_filename
 
+    def get_thumbnail_filename(self):
+        """
+        Thumbnail image filename, or None.
+        """
+        return self._thumbnail_filename
+
+    def get_media_info(self):
+        """
+        Mp4Info probed from the media file, or None.
+        """
+        return self._media_info
+
+    def get_duration(self):
+        """
+        Duration in seconds, or None if unknown.
+        """
+        if self._media_info is None:
+            return None
+        return self._media_info.duration
 
     def get_title(self):
         """
@@ -204,5 +310,41 @@ class TestMediaClip(unittest.TestCase):
         clip.infer_thumbnail('../media')
         self.assertEqual(clip.get_thumbnail_page(), 'serve_content?fkey=landscape_thumb.png')
 
+    def test_fields_roundtrip(self):
+        clip = MediaClip('foo', 'foo.mp4', None, 'foo.jpg')
+        copy = MediaClip.from_fields(clip.to_fields())
+        self.assertEqual(copy.to_fields(), ('foo', 'foo.mp4', None, 'foo.jpg'))
+        self.assertEqual(copy.get_title(), 'foo.mp4')
+
+    def test_fast_checks(self):
+        """
+        Same verdicts as checking char by char.
+        """
+        def reference(string):
+            if len(string) == 0:
+                return False
+            return all(ch in MediaClip.VALID_STR_CHARS for ch in string)
+
+        rnd = random.Random(19)
+        alphabet = MediaClip.VALID_STR_CHARS + '<>&/\\\'"\n\x00\x7f\xe9\u2603\U0001f600'
+        strings = [''.join(rnd.choice(alphabet) for _ in range(rnd.randint(0, 12)))
+                   for _ in range(2000)]
+        for string in strings:
+            self.assertEqual(MediaClip._accepts(string), reference(string), repr(string))
+            self.assertEqual(MediaClip.censor_string_chs(string),
+                             ''.join(ch for ch in string if ch in MediaClip.VALID_STR_CHARS))
+
+        with self.assertRaisesRegex(TypeError, "invalid char '<'<60> for string 'a<b&'"):
+            MediaClip.check_string_safe('a<b&')
+
+        self.assertEqual(MediaClip.check_strings_safe(strings), [reference(s) for s in strings])
+        self.assertEqual(MediaClip.check_strings_safe(['foo', None, 'bar.mp4']), [True] * 3)
+        self.assertEqual(MediaClip.check_strings_safe(['foo', '', 'a/b']), [True, False, False])
+
+    def test_slots(self):
+        clip = MediaClip('foo', 'foo.mp4', None, 'foo.jpg')
+        self.assertFalse(hasattr(clip, '__dict__'))
+        self.assertFalse(hasattr(clip.with_media_info(None), '__dict__'))
+
 if __name__ == '__main__':
     unittest.main()
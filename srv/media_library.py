@@ -21,151 +21,681 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import unittest
-import pathlib
 import os
 import json
+import base64
+import threading
+import concurrent.futures
+import tempfile
+import shutil
 
 from media_clip import MediaClip
+from dir_index import DirectoryIndex
+from content_hash import content_hashes
+from library_catalog import LibraryCatalog
+from mp4_probe import probe_mp4
+from metrics import PhaseClock
+from search_index import SearchIndex
+import logs
 
+log = logs.get_logger('media_library')
 
-class MediaLibrary(object):
-    def __init__(self, directory_name):
+
+def clip_from_json(json_str):
+    """
+    Given a string of json, return a media clip.
+
+    Return None is loading / parsing json fails. Thumbnails are not
+    inferred here.
+    """
+
+    json_obj = json.loads(json_str)
+    keys = list(json_obj)
+    log.debug("Got %d keys worth of json.", len(keys))
+
+    uid = None
+    filename = None
+    title = None
+    thumbnail_filename = None
+
+    for key in json_obj:
+        val = json_obj[key]
+
+        if key.startswith('_'):
+            key = key.lstrip('_')
+
+        if key == 'id' or key == 'uid':
+            if type(val) == str:
+                uid = val
+
+        if key == 'filename':
+            if type(val) == str:
+                filename = val
+
+        if key == 'title':
+            if type(val) == str:
+                try:
+                    title = MediaClip.check_string_safe(val)
+                except TypeError:
+                    # title contains invalid chars.
+                    alternate = MediaClip.censor_string_chs(val)
+                    if len(alternate) > 5:
+                        log.debug("Title '%s' has alternate '%s'", val, alternate)
+                        title = alternate
+
+
+        # Thumbnail must have image-ish file extension.
+        if key in ['thumbnail_filename', 'thumbnail']:
+            if type(val) == str and '.' in val:
+                _, ext = os.path.splitext(val)
+                if ext in ['.jpg', '.jpeg', '.png', 'gif']:
+                    try:
+                        # Check if thumbnail filename is in any way
+                        # 'dangerous'. Admittedly there is low
+                        # risk that someone would inject
+                        # directory traversal or html escapes
+                        # via metadata. But still...
+                        MediaClip.check_string_safe(val)
+                        thumbnail_filename = val
+                    except TypeError:
+                        # Thumbnail contains invalid chars.
+                        pass
+
+    if filename is None:
+        log.warning("Failed to extract filename from json keys %s", keys)
+        return
+
+    clip = None
+    try:
+        clip = MediaClip(uid, filename, title, thumbnail_filename)
+    except TypeError as err:
+        # If filename is valid, _discover_raws will catch this clip.
+        log.warning("Failed to create clip for filename '%s'", filename)
+
+    return clip
+
+
+def parse_json_clip(json_str, json_fname_abspath):
+    """
+    clip_from_json, logging instead of raising on malformed json.
+    """
+    try:
+        return clip_from_json(json_str)
+    except json.decoder.JSONDecodeError:
+        log.warning("Failed to read json from file '%s'", json_fname_abspath)
+    return None
+
+
+def read_json_file(json_fname_abspath):
+    """
+    Read a sidecar json file, returning None on failure.
+    """
+    try:
+        with open(json_fname_abspath) as json_file:
+            return json_file.read()
+    except OSError as ex:
+        log.warning("Failed to open json file '%s': %s", json_fname_abspath, ex)
+    return None
+
+
+def load_json_clip(json_fname_abspath):
+    """
+    Read and parse one sidecar json file. Returns a clip or None.
+
+    Module level, so that it can run in a process pool.
+    """
+    json_str = read_json_file(json_fname_abspath)
+    if json_str is None:
+        return None
+    return parse_json_clip(json_str, json_fname_abspath)
+
+
+class LibrarySnapshot(object):
+
+    SORT_KEYS = {
+        'title': lambda clip: (clip.get_title().lower(), clip.get_filename()),
+        'filename': lambda clip: clip.get_filename(),
+    }
+
+    def __init__(self, clips, content_names, generation):
+        """
+        Immutable view of a library at one generation.
+
+        Holds the clip list together with lookup indexes by uid and by
+        filename, and the set of servable file names, so readers always
+        see indexes consistent with the clips.
+        """
+        self._clips = clips
+        self._content_names = frozenset(content_names)
+        self._generation = generation
+        self._by_uid = {}
+        self._by_filename = {}
+        # Discovery order, plus sorted orders computed on first use.
+        self._orders = {'library': clips}
+        for clip in clips:
+            # Later clips win, like the linear scans they replace.
+            if clip.get_uid() is not None:
+                self._by_uid[clip.get_uid()] = clip
+            self._by_filename[clip.get_filename()] = clip
+
+    def get_clips(self):
+        return self._clips
+
+    def get_content_names(self):
+        return self._content_names
+
+    def get_generation(self):
+        return self._generation
+
+    def get_order(self, sort):
+        """
+        Clips in the given sort order.
+        """
+        order = self._orders.get(sort)
+        if order is None:
+            # A concurrent first use may sort twice, the results are equal.
+            order = sorted(self._clips, key=self.SORT_KEYS[sort])
+            self._orders[sort] = order
+        return order
+
+
+class LibraryReader(object):
+    """
+    Read side of a library, answering from its current LibrarySnapshot.
+
+    Subclasses set _directory_name, publish snapshots with
+    _set_snapshot() and provide get_fingerprint(), get_content_hash()
+    and rescan().
+    """
+
+    def __init__(self):
+        self._snapshot = None
+        self._search_index = None
+        self._search_lock = threading.Lock()
+
+    def _set_snapshot(self, snapshot):
+        self._snapshot = snapshot
+        if self._search_index is not None:
+            self._search_index.update(snapshot._clips)
+
+    def get_directory_name(self):
+        return self._directory_name
+
+    def get_generation(self):
+        """
+        Counter bumped every time the clip list changes.
+        """
+        return self._snapshot._generation
+
+    def get_sort_orders(self):
+        return ['library'] + sorted(LibrarySnapshot.SORT_KEYS)
+
+    def get_clip_page(self, offset, limit, sort='library'):
+        """
+        Return (clips, total) for one page of the library in the given
+        sort order. Raises KeyError for an unknown sort order.
+        """
+        if sort not in self.get_sort_orders():
+            raise KeyError(sort)
+        order = self._snapshot.get_order(sort)
+        return order[offset:offset + limit], len(order)
+
+    def get_clip_by_uid(self, uid):
+        """
+        Clip by uid. Clips without a sidecar used to be named by their
+        file name, which still finds them.
+        """
+        snapshot = self._snapshot
+        clip = snapshot._by_uid.get(uid)
+        if clip is None:
+            clip = snapshot._by_filename.get(uid)
+        return clip
+
+    def get_clip_by_filename(self, filename):
+        return self._snapshot._by_filename.get(filename)
+
+    def get_clip_by_fkey(self, fkey):
+        """
+        Clip whose filename b64-encodes to fkey, or None.
+        """
+        try:
+            filename = base64.b64decode(fkey.encode('ascii'), validate=True).decode('ascii')
+        except Exception:
+            return None
+        clip = self._snapshot._by_filename.get(filename)
+        # b64decode accepts variants, e.g. missing padding. Only the
+        # canonical encoding of the filename names the clip.
+        if clip is None or base64.b64encode(filename.encode('ascii')).decode('ascii') != fkey:
+            return None
+        return clip
+
+    def resolve_content(self, fkey):
+        """
+        Absolute path of a servable file, or None.
+
+        fkey is a file name, or its b64 encoding. Only files directly
+        in the library directory, as seen by the last scan, are
+        servable. Names are matched exactly against that listing, so
+        path separators or '..' can never resolve outside of it.
+        """
+        content_names = self._snapshot._content_names
+        name = None
+        if fkey in content_names:
+            name = fkey
+        else:
+            try:
+                clearkey = base64.b64decode(fkey.encode('ascii')).decode('ascii')
+            except Exception:
+                clearkey = None
+            if clearkey in content_names:
+                name = clearkey
+
+        if name is None:
+            return None
+        return os.path.abspath(os.path.join(self._directory_name, name))
+
+
+    def get_clip_filenames(self):
+        """
+        Get filenames of media library.
+        """
+        toreturn = []
+        for clip in self._snapshot._clips:
+            filename = clip.get_filename()
+            if filename is not None:
+                toreturn.append(filename)
+
+        return toreturn
+
+
+    def get_clips(self):
+        return self._snapshot._clips
+
+    def get_snapshot(self):
+        """
+        The current LibrarySnapshot.
+        """
+        return self._snapshot
+
+    def get_content_key(self, name):
+        """
+        Key for caches derived from a library file: its content hash
+        for media files, so copies and renames share derived files,
+        else its stat fingerprint. None if there is no such file.
+        """
+        content_hash = self.get_content_hash(name)
+        if content_hash is not None:
+            return (content_hash,)
+        return self.get_fingerprint(name)
+
+    def get_scan_stats(self):
+        """
+        Discovery timings, None for libraries that do not scan.
+        """
+        return None
+
+    def search(self, query, offset=0, limit=48):
+        """
+        (clips, total) matching a search query, best matches first. See
+        SearchIndex for the query syntax.
+        """
+        return self._get_search_index().search(query, offset, limit)
+
+    def get_search_facets(self, query=''):
+        """
+        {facet: [(value, clips)]} of the clips matching query, of all
+        clips for an empty one.
+        """
+        return self._get_search_index().get_facets(query)
+
+    def _get_search_index(self):
+        """
+        The search index, built on first use and kept up to date with
+        every snapshot from then on.
+        """
+        if self._search_index is None:
+            with self._search_lock:
+                if self._search_index is None:
+                    index = SearchIndex()
+                    index.update(self._snapshot._clips)
+                    self._search_index = index
+        # Covers a snapshot published while the index was built.
+        self._search_index.update(self._snapshot._clips)
+        return self._search_index
+
+
+class MediaLibrary(LibraryReader):
+    def __init__(self, directory_name, catalog_path=None, rebuild_catalog=False,
+                 discovery_workers=1, discovery_processes=False, hash_workers=4):
         """
         Represents a library based on a filesystem directory.
+
+        Remembers the stat fingerprint of every sidecar json and media
+        file it has seen, so rescan() only re-parses what changed. Media
+        files are probed for their Mp4Info when first seen or changed.
+
+        Media files are also hashed by content when first seen or
+        changed, by a pool of hash_workers threads. Clips without a
+        sidecar are named by their content hash, so renames keep their
+        uid, and copies of media already in the library are left out.
+        Probed info is reused for content probed before.
+
+        With a catalog_path, that state is persisted in a LibraryCatalog
+        and reloaded at startup, unless rebuild_catalog is set.
+
+        With discovery_workers > 1, sidecar jsons are read by a thread
+        pool, or read and parsed by a process pool if
+        discovery_processes is set.
         """
+        LibraryReader.__init__(self)
         self._directory_name = directory_name
-        self._clips = None
-        self.discover()
+        self._discovery_workers = discovery_workers
+        self._discovery_processes = discovery_processes
+        self._dir_index = None
+        self._thumbnail_signature = None
+        self._thumbnails_changed = True
+        # relpath -> (fingerprint, clip or None, thumbnail was inferred)
+        self._json_cache = {}
+        self._raw_cache = {}
+        # relpath -> (fingerprint, content hash or None)
+        self._hash_cache = {}
+        self._hash_workers = hash_workers
+        self._duplicates = 0
+        self._rescan_lock = threading.Lock()
+        self._phase_clock = PhaseClock()
+        # Seconds per discovery phase, of the last scan and in total.
+        self._scans = 0
+        self._last_scan = {}
+        self._scan_totals = {}
+        self._catalog = None
+        if catalog_path is not None:
+            self._catalog = LibraryCatalog(catalog_path)
+
+        if self._catalog is not None and not rebuild_catalog and self._load_catalog():
+            self.rescan()
+        else:
+            self.discover()
+
+    def _load_catalog(self):
+        """
+        Seed the fingerprint caches from the catalog. Returns success.
+        """
+        loaded = self._catalog.load(self._directory_name)
+        if loaded is None:
+            return False
+
+        self._json_cache, self._raw_cache, self._hash_cache, self._thumbnail_signature = loaded
+        log.info("Loaded catalog '%s' with %d json and %d media entries, %d hashed.",
+                 self._catalog.get_path(), len(self._json_cache), len(self._raw_cache),
+                 len(self._hash_cache))
+        return True
 
     def _discover_jsons(self):
         """
         Helper function that discoveres media via json metafiles.
         """
         clips = []
+        json_cache = {}
 
-        jsons = [str(p) for p in pathlib.Path(self._directory_name).rglob("*.json")]
-        jsons = [s[len(self._directory_name):].strip(os.sep) for s in jsons]
+        jsons = self._dir_index.files_with_ext('.json')
 
-        print(jsons)
+        log.debug("Found %d json files.", len(jsons))
+        stale = []
         for json_fname in jsons:
-            json_fname_abspath = os.path.abspath(os.path.join(self._directory_name, json_fname))
-            clip = None
-            with open(json_fname_abspath) as json_file:
-                json_str = json_file.read()
-                try:
-                    clip = self._clip_from_json(json_str)
-                except json.decoder.JSONDecodeError:
-                    print("Failed to read json from file '%s'" % json_fname_abspath)
-
+            fingerprint = self._dir_index.get_fingerprint(json_fname)
+            entry = self._reuse_cached(self._json_cache.get(json_fname), fingerprint)
+            if entry is None:
+                stale.append(json_fname)
+            else:
+                json_cache[json_fname] = entry
+
+        if stale:
+            for json_fname, clip in zip(stale, self._load_json_clips(stale)):
+                inferred = clip is not None and clip.get_thumbnail_page() == 'static/missing_media.jpg'
+                if inferred:
+                    self._infer_thumbnail(clip)
+                json_cache[json_fname] = (self._dir_index.get_fingerprint(json_fname), clip, inferred)
+
+        # Keep the scan order, whichever way the clips were loaded.
+        for json_fname in jsons:
+            json_cache[json_fname] = self._with_media_info(json_cache[json_fname])
+            clip = json_cache[json_fname][1]
             if clip is not None:
                 clips.append(clip)
 
+        self._json_cache = json_cache
         return clips
 
-    def _clip_from_json(self, json_str):
+    def _load_json_clips(self, json_fnames):
         """
-        Given a string of json, return a media clip.
-
-        Return None is loading / parsing json fails.
+        Read and parse sidecar jsons, returns clips in the same order.
         """
+        abspaths = [os.path.abspath(os.path.join(self._directory_name, json_fname))
+                    for json_fname in json_fnames]
+        workers = self._discovery_workers
 
-        json_obj = json.loads(json_str)
-        keys = list(json_obj)
-        print("Got %d keys worth of json." % len(keys))
+        if workers <= 1 or len(abspaths) < 2:
+            return [load_json_clip(abspath) for abspath in abspaths]
 
-        uid = None
-        filename = None
-        title = None
-        thumbnail_filename = None
+        if self._discovery_processes:
+            chunksize = max(1, len(abspaths) // (workers * 4))
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                return list(pool.map(load_json_clip, abspaths, chunksize=chunksize))
 
-        for key in json_obj:
-            val = json_obj[key]
+        # Overlap the reads, parsing is cheap next to storage latency.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            json_strs = list(pool.map(read_json_file, abspaths))
+        return [None if json_str is None else parse_json_clip(json_str, abspath)
+                for abspath, json_str in zip(abspaths, json_strs)]
 
-            if key.startswith('_'):
-                key = key.lstrip('_')
+    def _reuse_cached(self, entry, fingerprint):
+        """
+        Return a cache entry still valid for fingerprint, or None.
 
-            if key == 'id' or key == 'uid':
-                if type(val) == str:
-                    uid = val
+        Clips whose thumbnail was inferred are re-inferred on a copy
+        when the set of images changed, so published clips are never
+        mutated.
+        """
+        if entry is None or entry[0] != fingerprint:
+            return None
 
-            if key == 'filename':
-                if type(val) == str:
-                    filename = val
+        _, clip, inferred = entry
+        if inferred and self._thumbnails_changed:
+            fresh = clip.without_thumbnail()
+            self._infer_thumbnail(fresh)
+            if fresh.get_thumbnail_page() != clip.get_thumbnail_page():
+                return (fingerprint, fresh, inferred)
 
-            if key == 'title':
-                if type(val) == str:
-                    try:
-                        title = MediaClip.check_string_safe(val)
-                    except TypeError:
-                        # title contains invalid chars.
-                        alternate = MediaClip.censor_string_chs(val)
-                        if len(alternate) > 5:
-                            print("Title '%s has alternate '%s'" % (val, alternate) )
-                            title = alternate
-
-
-            # Thumbnail must have image-ish file extension.
-            if key in ['thumbnail_filename', 'thumbnail']:
-                if type(val) == str and '.' in val:
-                    _, ext = os.path.splitext(val)
-                    if ext in ['.jpg', '.jpeg', '.png', 'gif']:
-                        try:
-                            # Check if thumbnail filename is in any way
-                            # 'dangerous'. Admittedly there is low
-                            # risk that someone would inject
-                            # directory traversal or html escapes
-                            # via metadata. But still...
-                            MediaClip.check_string_safe(val)
-                            thumbnail_filename = val
-                        except TypeError:
-                            # Thumbnail contains invalid chars.
-                            pass
-
-        if filename is None:
-            print("Failed to extract filename from json keys %s" % keys)
-            return
-            
-        clip = None
-        try:
-            clip = MediaClip(uid, filename, title, thumbnail_filename)
-            if thumbnail_filename is None:
-                clip.infer_thumbnail(self._directory_name)
-        except TypeError as err:
-            # If filename is valid, _discover_raws will catch this clip.
-            print("Failed to create clip for filename '%s'" % str(filename))
+        return entry
 
-        return clip
+    def _refresh_hashes(self):
+        """
+        Content hash of every media file, hashing the ones added or
+        changed. Renamed files keep their stat fingerprint, and their
+        hash.
+        """
+        hash_cache = {}
+        renamed = None
+        stale = []
+        for fname in self._dir_index.files_with_ext('.mp4'):
+            fingerprint = self._dir_index.get_fingerprint(fname)
+            entry = self._hash_cache.get(fname)
+            if entry is None or entry[0] != fingerprint:
+                if renamed is None:
+                    renamed = dict(self._hash_cache.values())
+                entry = None
+                if renamed.get(fingerprint) is not None:
+                    entry = (fingerprint, renamed[fingerprint])
+            if entry is None:
+                stale.append(fname)
+            else:
+                hash_cache[fname] = entry
+
+        if stale:
+            log.debug("Hashing %d media files.", len(stale))
+            with self._phase_clock.phase('content_hash'):
+                hashes = content_hashes([os.path.join(self._directory_name, fname) for fname in stale],
+                                        self._hash_workers)
+            for fname, content_hash in zip(stale, hashes):
+                hash_cache[fname] = (self._dir_index.get_fingerprint(fname), content_hash)
+
+        self._hash_cache = hash_cache
+
+    def get_content_hash(self, name):
+        """
+        Content hash of a media file as of the last scan, or None.
+        """
+        entry = self._hash_cache.get(name)
+        return None if entry is None else entry[1]
+
+    def _refresh_raw_cache(self, previous_hashes):
+        """
+        Track every media file, probing the ones added or changed,
+        unless their content was probed before under previous_hashes.
+        """
+        raw_cache = {}
+        listed = []
+        for fname in self._dir_index.files_with_ext('.mp4'):
+            fingerprint = self._dir_index.get_fingerprint(fname)
+            listed.append((fname, fingerprint,
+                           self._reuse_cached(self._raw_cache.get(fname), fingerprint)))
+
+        # Raw clips are named after their file, check the new names
+        # in one batch.
+        new_names = [fname for fname, _, entry in listed if entry is None]
+        safe_names = set(name for name, safe in zip(
+            new_names, MediaClip.check_strings_safe(new_names)) if safe)
+
+        probed = {}
+        if new_names:
+            for fname, (fingerprint, clip, _) in self._raw_cache.items():
+                previous = previous_hashes.get(fname)
+                if clip is not None and previous is not None and previous[0] == fingerprint and \
+                        previous[1] is not None:
+                    probed[previous[1]] = clip.get_media_info()
+
+        for fname, fingerprint, entry in listed:
+            if entry is None:
+                clip = None
+                content_hash = self._hash_cache[fname][1]
+                uid = fname if content_hash is None else content_hash
+                try:
+                    if fname in safe_names:
+                        clip = MediaClip.from_fields((uid, fname, fname, None))
+                    else:
+                        # Raises, telling why.
+                        clip = MediaClip(uid, fname, fname, None)
+                    self._infer_thumbnail(clip)
+                    if content_hash in probed:
+                        media_info = probed[content_hash]
+                    else:
+                        with self._phase_clock.phase('probe'):
+                            media_info = probe_mp4(os.path.join(self._directory_name, fname))
+                    clip = clip.with_media_info(media_info)
+                except Exception as ex:
+                    log.warning("Skipping media file '%s': %s", fname, ex)
+                entry = (fingerprint, clip, True)
+            raw_cache[fname] = entry
+
+        self._raw_cache = raw_cache
 
+    def _infer_thumbnail(self, clip):
+        with self._phase_clock.phase('thumbnail_inference'):
+            clip.infer_thumbnail(dir_index=self._dir_index)
+
+    def _with_media_info(self, entry):
+        """
+        Cache entry whose clip carries the media info probed for its
+        media file, the same entry if it already does.
+        """
+        clip = entry[1]
+        if clip is None:
+            return entry
+
+        raw = self._raw_cache.get(clip.get_filename())
+        media_info = None
+        if raw is not None and raw[1] is not None:
+            media_info = raw[1].get_media_info()
+        if clip.get_media_info() == media_info:
+            return entry
+        return (entry[0], clip.with_media_info(media_info), entry[2])
 
     def _discover_raws(self, already_claimed=[]):
         """
         Helper function that discoveres media via raw metafiles.
         """
 
-        fname_whitelist = [str(p) for p in pathlib.Path(self._directory_name).rglob("*")]
-        fname_whitelist = [s[len(self._directory_name):].strip(os.sep) for s in fname_whitelist]
-        self._fname_whitelist = fname_whitelist
+        already_claimed = set(already_claimed)
+        # Content already in the library, by sidecar or an earlier copy.
+        seen = set(self.get_content_hash(fname) for fname in already_claimed)
+        seen.discard(None)
+        duplicates = 0
         clips = []
-        for fname in self._fname_whitelist:
-            if fname in already_claimed:
+        for fname in self._dir_index.files_with_ext('.mp4'):
+            # Media files claimed by json are still in the cache, their
+            # fingerprint and media info are still worth tracking.
+            clip = self._raw_cache[fname][1]
+            if fname in already_claimed or clip is None:
                 continue
-
-            if fname.endswith('.mp4'):
-                try:
-                    clip = MediaClip(fname, fname, fname, None)
-                    clips.append(clip)
-                    clip.infer_thumbnail(self._directory_name)
-                except Exception as ex:
-                    print(ex)
-
+            content_hash = self._hash_cache[fname][1]
+            if content_hash is not None:
+                if content_hash in seen:
+                    log.debug("Skipping media file '%s', a copy of a clip in the library.", fname)
+                    duplicates += 1
+                    continue
+                seen.add(content_hash)
+            clips.append(clip)
+
+        self._duplicates = duplicates
         return clips
 
     def discover(self):
         """
         Traverse directory and re-populate any media clips.
         """
+        with self._rescan_lock:
+            self._json_cache = {}
+            self._raw_cache = {}
+            self._hash_cache = {}
+            self._thumbnail_signature = None
+            self._rescan()
+
+    def rescan(self, dirty_dirs=None):
+        """
+        Incrementally refresh the library.
+
+        Walks the directory and stats every file, but only re-parses
+        sidecar jsons and media files that were added or changed since
+        the last scan. The clip list is replaced as a whole, so readers
+        holding the previous list are not disturbed.
+
+        If dirty_dirs is given (directories relative to the library
+        root), only those are walked, e.g. as reported by a watcher.
+
+        Returns True if the clip list changed.
+        """
+        with self._rescan_lock:
+            return self._rescan(dirty_dirs)
+
+    def _rescan(self, dirty_dirs=None):
+        self._phase_clock = PhaseClock()
+        with self._phase_clock.phase('dir_walk'):
+            if dirty_dirs is None or self._dir_index is None:
+                self._dir_index = DirectoryIndex(self._directory_name)
+            else:
+                self._dir_index = self._dir_index.refresh(dirty_dirs)
+            signature = self._dir_index.thumbnail_signature()
+        self._thumbnails_changed = signature != self._thumbnail_signature
+        self._thumbnail_signature = signature
+        old_caches = (self._json_cache, self._raw_cache, self._hash_cache)
+
+        with self._phase_clock.phase('raw_scan'):
+            self._refresh_hashes()
+            self._refresh_raw_cache(old_caches[2])
+
         clips = []
-        clips += self._discover_jsons()
+        with self._phase_clock.phase('json_scan'):
+            clips += self._discover_jsons()
 
         already_claimed = []
         for clip in clips:
@@ -173,24 +703,65 @@ class MediaLibrary(object):
 
         clips += self._discover_raws(already_claimed)
 
-        self._clips = clips
-
-
-    def get_clip_filenames(self):
+        old = self._snapshot
+        changed = old is None or len(old._clips) != len(clips) or \
+            any(a is not b for a, b in zip(old._clips, clips))
+
+        content_names = self._dir_index.files_in_dir('')
+        if changed:
+            generation = 1 if old is None else old._generation + 1
+            self._set_snapshot(LibrarySnapshot(clips, content_names, generation))
+        elif old._content_names != frozenset(content_names):
+            self._set_snapshot(LibrarySnapshot(old._clips, content_names, old._generation))
+
+        if self._catalog is not None and (
+                self._thumbnails_changed or
+                self._cache_changed(old_caches[0], self._json_cache) or
+                self._cache_changed(old_caches[1], self._raw_cache) or
+                self._cache_changed(old_caches[2], self._hash_cache)):
+            with self._phase_clock.phase('catalog_save'):
+                self._catalog.save(self._directory_name, self._json_cache, self._raw_cache,
+                                   self._hash_cache, self._thumbnail_signature)
+
+        self._record_scan(self._phase_clock.get_totals())
+        return changed
+
+    def _record_scan(self, timings):
+        self._scans += 1
+        self._last_scan = timings
+        totals = dict(self._scan_totals)
+        for phase, seconds in timings.items():
+            totals[phase] = totals.get(phase, 0.0) + seconds
+        self._scan_totals = totals
+        log.debug("Scan %d took %s", self._scans,
+                  ', '.join('%s %.3f s' % item for item in timings.items()))
+
+    def get_scan_stats(self):
         """
-        Get filenames of media library.
+        {'scans': n, 'last': {phase: seconds}, 'total': {phase: seconds},
+        'duplicates': n}.
+
+        Phases are dir_walk, raw_scan, content_hash, probe, json_scan,
+        thumbnail_inference and catalog_save. Hashing, probing and
+        thumbnail inference are not counted in the scan phase they
+        happen in. Duplicates are media files left out of the last scan
+        as copies of clips in the library.
         """
-        toreturn = []
-        for clip in self._clips:
-            filename = clip.get_filename()
-            if filename is not None:
-                toreturn.append(filename)
-
-        return toreturn
+        return {'scans': self._scans, 'last': self._last_scan, 'total': self._scan_totals,
+                'duplicates': self._duplicates}
 
+    @staticmethod
+    def _cache_changed(old, new):
+        if len(old) != len(new):
+            return True
+        return any(old.get(relpath) is not entry for relpath, entry in new.items())
 
-    def get_clips(self):
-        return self._clips
+    def get_fingerprint(self, name):
+        """
+        (inode, size, mtime_ns) of a library file as of the last scan,
+        or None.
+        """
+        return self._dir_index.get_fingerprint(name)
 
 
 class TestMediaLibrary(unittest.TestCase):
@@ -201,6 +772,39 @@ class TestMediaLibrary(unittest.TestCase):
         clips = ml.get_clips()
         self.assertTrue(len(clips) > 0)
 
+    def test_media_info(self):
+        ml = MediaLibrary('../media')
+        for clip in ml.get_clips():
+            self.assertGreater(clip.get_duration(), 0)
+        json_clip = ml.get_clip_by_uid('landscape_clip')
+        self.assertEqual(json_clip.get_media_info().width, 640)
+
+        # Unchanged files keep their clips, info and all.
+        before = ml.get_clips()
+        self.assertFalse(ml.rescan())
+        self.assertIs(ml.get_clips(), before)
+
+    def test_search(self):
+        ml = MediaLibrary('../media')
+        clips, total = ml.search('landscap')
+        self.assertEqual(total, 1)
+        self.assertEqual(clips[0].get_uid(), 'landscape_clip')
+        self.assertEqual(ml.search('donut codec:avc1')[0][0].get_filename(), 'Moving donut.mp4')
+        self.assertEqual(ml.get_search_facets()['height'], [('480', 2)])
+
+    def test_scan_stats(self):
+        ml = MediaLibrary('../media')
+        stats = ml.get_scan_stats()
+        self.assertEqual(stats['scans'], 1)
+        for phase in ('dir_walk', 'raw_scan', 'probe', 'json_scan'):
+            self.assertGreater(stats['last'][phase], 0)
+
+        # Nothing changed, so nothing is probed again.
+        ml.rescan()
+        stats = ml.get_scan_stats()
+        self.assertEqual(stats['scans'], 2)
+        self.assertNotIn('probe', stats['last'])
+        self.assertGreater(stats['total']['dir_walk'], stats['last']['dir_walk'])
 
     def test_discover_thumbnails(self):
         ml = MediaLibrary('../media')
@@ -211,5 +815,142 @@ class TestMediaLibrary(unittest.TestCase):
         thumb = landscape_clips[0].get_thumbnail_page()
         self.assertTrue(thumb.endswith('thumb.png'))
 
+    def test_lookups(self):
+        ml = MediaLibrary('../media')
+        clip = ml.get_clip_by_uid('landscape_clip')
+        self.assertEqual(clip.get_filename(), 'Simple landscape flyover.mp4')
+        self.assertIs(ml.get_clip_by_filename('Simple landscape flyover.mp4'), clip)
+        self.assertIs(ml.get_clip_by_fkey('U2ltcGxlIGxhbmRzY2FwZSBmbHlvdmVyLm1wNA=='), clip)
+        self.assertIsNone(ml.get_clip_by_uid('nope'))
+        self.assertIsNone(ml.get_clip_by_fkey('U2ltcGxlIGxhbmRzY2FwZSBmbHlvdmVyLm1wNA'))
+        self.assertIsNone(ml.get_clip_by_fkey('not b64'))
+
+        self.assertEqual(ml.resolve_content('hello.txt'), os.path.abspath('../media/hello.txt'))
+        self.assertEqual(ml.resolve_content('aGVsbG8udHh0'), os.path.abspath('../media/hello.txt'))
+        self.assertIsNone(ml.resolve_content('../srv/media_library.py'))
+        self.assertIsNone(ml.resolve_content(base64.b64encode(b'../srv/media_library.py').decode('ascii')))
+        self.assertIsNone(ml.resolve_content('nope'))
+
+    def test_parallel_discovery(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for i in range(20):
+                with open(os.path.join(tmpdir, 'clip%02d.mp4' % i), 'w') as f:
+                    f.write('x')
+                # Two sidecars per media file, each one its own clip.
+                for dup in ['a', 'b']:
+                    with open(os.path.join(tmpdir, 'clip%02d%s.json' % (i, dup)), 'w') as f:
+                        json.dump({'id': 'uid%02d%s' % (i, dup), 'filename': 'clip%02d.mp4' % i}, f)
+            with open(os.path.join(tmpdir, 'broken.json'), 'w') as f:
+                f.write('{')
+
+            serial = [c.to_fields() for c in MediaLibrary(tmpdir).get_clips()]
+            threaded = [c.to_fields() for c in MediaLibrary(tmpdir, discovery_workers=4).get_clips()]
+            processes = [c.to_fields() for c in MediaLibrary(
+                tmpdir, discovery_workers=4, discovery_processes=True).get_clips()]
+
+            self.assertEqual(len(serial), 40)
+            self.assertEqual(threaded, serial)
+            self.assertEqual(processes, serial)
+
+    def test_clip_pages(self):
+        ml = MediaLibrary('../media')
+        clips, total = ml.get_clip_page(0, 1, 'title')
+        self.assertEqual(total, 2)
+        self.assertEqual([c.get_uid() for c in clips], ['landscape_clip'])
+        clips, total = ml.get_clip_page(1, 10, 'title')
+        self.assertEqual([c.get_filename() for c in clips], ['Moving donut.mp4'])
+        self.assertEqual(ml.get_clip_page(0, 10)[0], ml.get_clips())
+        self.assertEqual(ml.get_clip_page(5, 10), ([], 2))
+        self.assertRaises(KeyError, ml.get_clip_page, 0, 10, 'nope')
+
+    def test_rescan(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            shutil.copy('../media/landscape_clip.json', tmpdir)
+            shutil.copy('../media/landscape_thumb.png', tmpdir)
+            ml = MediaLibrary(tmpdir)
+            self.assertEqual(len(ml.get_clips()), 1)
+            clips_before = ml.get_clips()
+            generation = ml.get_generation()
+
+            self.assertFalse(ml.rescan())
+            self.assertIs(ml.get_clips(), clips_before)
+            self.assertEqual(ml.get_generation(), generation)
+
+            self.assertEqual(ml.search('new')[1], 0)
+            with open(os.path.join(tmpdir, 'new.mp4'), 'wb') as f:
+                f.write(b'\0')
+            self.assertTrue(ml.rescan())
+            self.assertEqual(len(ml.get_clips()), 2)
+            self.assertIs(ml.get_clips()[0], clips_before[0])
+            self.assertEqual(len(clips_before), 1)
+            self.assertEqual(ml.search('new')[0], ml.get_clips()[1:])
+
+            # Thumbnail dropped in later is picked up for the raw clip.
+            shutil.copy('../media/donut_thumb.png', os.path.join(tmpdir, 'new.png'))
+            self.assertTrue(ml.rescan())
+            self.assertEqual(ml.get_clips()[1].get_thumbnail_page(), 'serve_content?fkey=new.png')
+
+            os.remove(os.path.join(tmpdir, 'new.mp4'))
+            self.assertTrue(ml.rescan())
+            self.assertEqual(len(ml.get_clips()), 1)
+            self.assertEqual(ml.search('new')[1], 0)
+
+    def test_content_hashes(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            shutil.copy('../media/Moving donut.mp4', os.path.join(tmpdir, 'donut.mp4'))
+            shutil.copy('../media/Moving donut.mp4', os.path.join(tmpdir, 'donut copy.mp4'))
+            ml = MediaLibrary(tmpdir)
+
+            # One clip for both copies, named by its content.
+            content_hash = ml.get_content_hash('donut.mp4')
+            self.assertEqual(ml.get_content_hash('donut copy.mp4'), content_hash)
+            self.assertEqual([c.get_uid() for c in ml.get_clips()], [content_hash])
+            self.assertEqual(ml.get_scan_stats()['duplicates'], 1)
+            self.assertEqual(ml.get_content_key('donut.mp4'), (content_hash,))
+            self.assertIsNone(ml.get_content_key('nope.mp4'))
+
+            # A sidecar claiming either copy makes it the one shown.
+            with open(os.path.join(tmpdir, 'donut.json'), 'w') as f:
+                json.dump({'id': 'donut', 'filename': 'donut copy.mp4'}, f)
+            self.assertTrue(ml.rescan())
+            self.assertEqual([c.get_uid() for c in ml.get_clips()], ['donut'])
+
+            # Renamed, neither hashed nor probed again.
+            os.remove(os.path.join(tmpdir, 'donut.json'))
+            os.remove(os.path.join(tmpdir, 'donut copy.mp4'))
+            os.rename(os.path.join(tmpdir, 'donut.mp4'), os.path.join(tmpdir, 'renamed.mp4'))
+            self.assertTrue(ml.rescan())
+            clip = ml.get_clips()[0]
+            self.assertEqual(clip.get_filename(), 'renamed.mp4')
+            self.assertEqual(clip.get_uid(), content_hash)
+            self.assertGreater(clip.get_duration(), 0)
+            self.assertNotIn('content_hash', ml.get_scan_stats()['last'])
+            self.assertNotIn('probe', ml.get_scan_stats()['last'])
+            # Old links by file name still work.
+            self.assertIs(ml.get_clip_by_uid('renamed.mp4'), clip)
+
+    def test_catalog(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            catalog_path = os.path.join(tmpdir, 'catalog.db')
+            ml = MediaLibrary('../media', catalog_path=catalog_path)
+            self.assertTrue(os.path.exists(catalog_path))
+
+            warm = MediaLibrary('../media', catalog_path=catalog_path)
+            self.assertEqual([c.to_fields() for c in warm.get_clips()],
+                             [c.to_fields() for c in ml.get_clips()])
+            self.assertEqual(warm.get_content_hash('Moving donut.mp4'), ml.get_content_hash('Moving donut.mp4'))
+            self.assertNotIn('content_hash', warm.get_scan_stats()['last'])
+
+            # Clips come from the catalog, not from re-parsing the jsons.
+            original = MediaLibrary._load_json_clips
+            MediaLibrary._load_json_clips = lambda *args: self.fail("json re-parsed")
+            try:
+                MediaLibrary('../media', catalog_path=catalog_path)
+            finally:
+                MediaLibrary._load_json_clips = original
+
+            rebuilt = MediaLibrary('../media', catalog_path=catalog_path, rebuild_catalog=True)
+            self.assertEqual(len(rebuilt.get_clips()), len(ml.get_clips()))
+
 if __name__ == '__main__':
     unittest.main()
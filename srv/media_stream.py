@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2019 Erik Mossberg
+
+This file is part of SeriousBusiness.
+
+SeriousBusiness is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+SeriousBusiness is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+import os
+import ssl
+import uuid
+import tempfile
+import mimetypes
+import email.utils
+import threading
+import time
+
+import cheroot.wsgi
+from cherrypy._cpwsgi_server import CPWSGIServer
+from cherrypy.process.servers import ServerAdapter
+
+from page_cache import etag_matches
+from bandwidth import BandwidthScheduler
+
+# More ranges than this in one request is treated as abuse and the
+# header is ignored, as RFC 7233 permits.
+MAX_RANGES = 16
+
+CHUNK_SIZE = 256 * 1024
+
+
+class FileRegion(object):
+
+    def __init__(self, fileobj, offset, count):
+        """
+        count bytes of an open file, starting at offset.
+
+        Yielded from response bodies in place of bytes, so that a
+        gateway able to do so can hand them to sendfile.
+        """
+        self.fileobj = fileobj
+        self.offset = offset
+        self.count = count
+
+    def read_chunks(self, chunk_size=CHUNK_SIZE):
+        """
+        The region as bytes chunks, for gateways without sendfile.
+        """
+        fd = self.fileobj.fileno()
+        offset = self.offset
+        end = self.offset + self.count
+        while offset < end:
+            chunk = os.pread(fd, min(chunk_size, end - offset), offset)
+            if not chunk:
+                raise IOError("File shrank while being served")
+            offset += len(chunk)
+            yield chunk
+
+    def split(self, size=CHUNK_SIZE):
+        """
+        The region as consecutive regions of at most size bytes.
+        """
+        return [FileRegion(self.fileobj, offset, min(size, self.offset + self.count - offset))
+                for offset in range(self.offset, self.offset + self.count, size)]
+
+
+def parse_range_header(header, size):
+    """
+    Parse a Range header against a file of size bytes.
+
+    Returns None if the whole file should be served (no header, a
+    header we do not understand, or too many ranges), an empty list if
+    no range is satisfiable, and otherwise a sorted list of
+    non-overlapping (start, end) pairs, end inclusive.
+    """
+    if not header:
+        return None
+
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec:
+        return None
+
+    ranges = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, dash, last = part.partition('-')
+        if not dash:
+            return None
+        try:
+            if first == '':
+                # Suffix range, the last N bytes.
+                suffix = int(last)
+                if suffix < 0:
+                    return None
+                if suffix == 0:
+                    continue
+                start, end = max(0, size - suffix), size - 1
+            else:
+                start = int(first)
+                end = int(last) if last != '' else start
+                if start < 0 or end < start:
+                    return None
+                end = size - 1 if last == '' else min(end, size - 1)
+        except ValueError:
+            return None
+
+        if start < size:
+            ranges.append((start, end))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    # Coalesce overlapping and adjacent ranges.
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def file_etag(st):
+    return '"%x-%x-%x"' % (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def if_range_matches(if_range, etag, mtime):
+    """
+    Does an If-Range header still allow a partial response.
+    """
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        # Strong comparison only.
+        return if_range == etag
+    date = email.utils.parsedate_to_datetime(if_range)
+    return int(date.timestamp()) == int(mtime)
+
+
+def prepare_file_response(fileobj, st, path, get_header, method='GET'):
+    """
+    Work out the response for serving an open file.
+
+    get_header(name) returns a request header or None. Returns
+    (status, headers, body) where headers is a list of pairs and body a
+    list of bytes and FileRegion items. Handles Range (single and
+    multiple), If-Range, If-None-Match and If-Modified-Since.
+    """
+    size = st.st_size
+    etag = file_etag(st)
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    headers = [
+        ('Accept-Ranges', 'bytes'),
+        ('ETag', etag),
+        ('Last-Modified', email.utils.formatdate(st.st_mtime, usegmt=True)),
+    ]
+
+    if etag_matches(get_header('If-None-Match'), etag):
+        return 304, headers, []
+
+    since = get_header('If-Modified-Since')
+    if since and get_header('If-None-Match') is None:
+        try:
+            if int(st.st_mtime) <= int(email.utils.parsedate_to_datetime(since).timestamp()):
+                return 304, headers, []
+        except (TypeError, ValueError):
+            pass
+
+    ranges = None
+    if method in ('GET', 'HEAD'):
+        try:
+            if if_range_matches(get_header('If-Range'), etag, st.st_mtime):
+                ranges = parse_range_header(get_header('Range'), size)
+        except (TypeError, ValueError):
+            ranges = None
+
+    if ranges is None:
+        headers += [('Content-Type', content_type), ('Content-Length', str(size))]
+        return 200, headers, [FileRegion(fileobj, 0, size)] if size else []
+
+    if not ranges:
+        headers += [('Content-Range', 'bytes */%d' % size), ('Content-Length', '0')]
+        return 416, headers, []
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers += [
+            ('Content-Type', content_type),
+            ('Content-Range', 'bytes %d-%d/%d' % (start, end, size)),
+            ('Content-Length', str(end - start + 1)),
+        ]
+        return 206, headers, [FileRegion(fileobj, start, end - start + 1)]
+
+    boundary = uuid.uuid4().hex
+    body = []
+    length = 0
+    for start, end in ranges:
+        part_header = ('\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n'
+                       % (boundary, content_type, start, end, size)).encode('ascii')
+        body += [part_header, FileRegion(fileobj, start, end - start + 1)]
+        length += len(part_header) + end - start + 1
+    closing = ('\r\n--%s--\r\n' % boundary).encode('ascii')
+    body.append(closing)
+    length += len(closing)
+
+    headers += [
+        ('Content-Type', 'multipart/byteranges; boundary=%s' % boundary),
+        ('Content-Length', str(length)),
+    ]
+    return 206, headers, body
+
+
+def iter_body(body, release, sendfile=False, transfer=None):
+    """
+    Generator over a prepared body that calls release() when done.
+
+    With sendfile, FileRegion items are passed through for the gateway,
+    otherwise they are read into bytes chunks.
+
+    With a bandwidth Transfer, the body is sent at its pace, in pieces
+    of CHUNK_SIZE if it is shaped, and the transfer is finished along
+    with release().
+    """
+    try:
+        for item in body:
+            pieces = [item]
+            if transfer is not None and transfer.is_shaped() and isinstance(item, FileRegion):
+                pieces = item.split()
+            for piece in pieces:
+                if transfer is not None:
+                    delay = transfer.reserve(piece.count if isinstance(piece, FileRegion) else len(piece))
+                    if delay:
+                        time.sleep(delay)
+                if isinstance(piece, FileRegion) and not sendfile:
+                    for chunk in piece.read_chunks():
+                        yield chunk
+                else:
+                    yield piece
+    finally:
+        if transfer is not None:
+            transfer.finish()
+        release()
+
+
+class SendfileGateway(cheroot.wsgi.Gateway_10):
+    """
+    WSGI gateway that sends FileRegion body items with sendfile.
+
+    Advertises itself in the environ as 'sbsns.sendfile', so that the
+    application only yields FileRegions to gateways that handle them.
+    """
+
+    def get_environ(self):
+        env = super(SendfileGateway, self).get_environ()
+        env['sbsns.sendfile'] = True
+        return env
+
+    def respond(self):
+        response = self.req.server.wsgi_app(self.env, self.start_response)
+        try:
+            for chunk in response:
+                if isinstance(chunk, FileRegion):
+                    self._sendfile(chunk)
+                elif chunk:
+                    if not isinstance(chunk, bytes):
+                        raise ValueError('WSGI Applications must yield bytes')
+                    self.write(chunk)
+        finally:
+            self.req.ensure_headers_sent()
+            if hasattr(response, 'close'):
+                response.close()
+
+    def _sendfile(self, region):
+        sock = self.req.conn.socket
+        if self.req.chunked_write or isinstance(sock, ssl.SSLSocket):
+            # Chunked framing needs to wrap the data and TLS encrypts it
+            # in userland, copy it instead. This also avoids the seek and
+            # read fallback of socket.sendfile(), as files may be shared.
+            for chunk in region.read_chunks():
+                self.write(chunk)
+            return
+
+        self.req.ensure_headers_sent()
+        self.req.conn.wfile.flush()
+        sent = sock.sendfile(region.fileobj, region.offset, region.count)
+        if sent != region.count:
+            raise IOError("Short sendfile, %d of %d bytes" % (sent, region.count))
+        if self.remaining_bytes_out is not None:
+            self.remaining_bytes_out -= sent
+
+
+class SendfileWSGIServer(CPWSGIServer):
+
+    def __init__(self, *args, **kwargs):
+        """
+        CherryPy's WSGI server, with the sendfile gateway.
+        """
+        super(SendfileWSGIServer, self).__init__(*args, **kwargs)
+        self.gateway = SendfileGateway
+
+
+class SharedPortServer(ServerAdapter):
+
+    def start(self):
+        """
+        Start an HTTP server on a port shared by several processes with
+        SO_REUSEPORT. CherryPy's own adapter checks the port is free
+        first, which it rightly is not.
+        """
+        self.httpserver.reuse_port = True
+        thread = threading.Thread(target=self._start_http_thread, name='HTTPServer')
+        thread.start()
+        self.wait()
+        self.running = True
+        self.bus.log('Serving on %s' % self.description)
+    start.priority = 75
+
+
+class TestMediaStream(unittest.TestCase):
+
+    def test_parse_range(self):
+        self.assertIsNone(parse_range_header(None, 100))
+        self.assertIsNone(parse_range_header('items=0-1', 100))
+        self.assertIsNone(parse_range_header('bytes=a-b', 100))
+        self.assertIsNone(parse_range_header('bytes=5-2', 100))
+        self.assertEqual(parse_range_header('bytes=0-9', 100), [(0, 9)])
+        self.assertEqual(parse_range_header('bytes=90-', 100), [(90, 99)])
+        self.assertEqual(parse_range_header('bytes=-10', 100), [(90, 99)])
+        self.assertEqual(parse_range_header('bytes=-1000', 100), [(0, 99)])
+        self.assertEqual(parse_range_header('bytes=50-1000', 100), [(50, 99)])
+        self.assertEqual(parse_range_header('bytes=0-4, 5-9, 20-29', 100), [(0, 9), (20, 29)])
+        self.assertEqual(parse_range_header('bytes=100-200', 100), [])
+        self.assertIsNone(parse_range_header('bytes=' + ','.join(['%d-%d' % (i, i) for i in range(0, 40, 2)]), 100))
+
+    def setUp(self):
+        self._tmp = tempfile.NamedTemporaryFile(suffix='.mp4')
+        self._tmp.write(b'0123456789' * 10)
+        self._tmp.flush()
+
+    def tearDown(self):
+        self._tmp.close()
+
+    def _respond(self, headers):
+        fileobj = open(self._tmp.name, 'rb')
+        st = os.fstat(fileobj.fileno())
+        status, out_headers, body = prepare_file_response(fileobj, st, self._tmp.name, headers.get)
+        payload = b''.join(iter_body(body, fileobj.close))
+        self.assertTrue(fileobj.closed)
+        return status, dict(out_headers), payload, st
+
+    def test_full(self):
+        status, headers, payload, _ = self._respond({})
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Content-Type'], 'video/mp4')
+        self.assertEqual(headers['Accept-Ranges'], 'bytes')
+        self.assertEqual(len(payload), 100)
+
+    def test_single_range(self):
+        status, headers, payload, _ = self._respond({'Range': 'bytes=10-14'})
+        self.assertEqual(status, 206)
+        self.assertEqual(headers['Content-Range'], 'bytes 10-14/100')
+        self.assertEqual(payload, b'01234')
+
+        status, headers, _, _ = self._respond({'Range': 'bytes=200-'})
+        self.assertEqual(status, 416)
+        self.assertEqual(headers['Content-Range'], 'bytes */100')
+
+    def test_multi_range(self):
+        status, headers, payload, _ = self._respond({'Range': 'bytes=0-1,50-52'})
+        self.assertEqual(status, 206)
+        self.assertTrue(headers['Content-Type'].startswith('multipart/byteranges; boundary='))
+        self.assertEqual(len(payload), int(headers['Content-Length']))
+        self.assertIn(b'Content-Range: bytes 0-1/100\r\n\r\n01\r\n', payload)
+        self.assertIn(b'Content-Range: bytes 50-52/100\r\n\r\n012\r\n', payload)
+
+    def test_paced(self):
+        fileobj = open(self._tmp.name, 'rb')
+        st = os.fstat(fileobj.fileno())
+        _, _, body = prepare_file_response(fileobj, st, self._tmp.name, {}.get)
+        self.assertEqual([(r.offset, r.count) for r in body[0].split(40)], [(0, 40), (40, 40), (80, 20)])
+
+        scheduler = BandwidthScheduler(stream_rate=10 ** 9)
+        transfer = scheduler.admit(200, st.st_size)
+        payload = b''.join(iter_body(body, fileobj.close, transfer=transfer))
+        self.assertEqual(payload, b'0123456789' * 10)
+        self.assertTrue(fileobj.closed)
+        stats = scheduler.get_stats()
+        self.assertEqual((stats['active_interactive'], stats['bytes_interactive']), (0, 100))
+
+    def test_conditionals(self):
+        _, _, _, st = self._respond({})
+        status, _, _, _ = self._respond({'Range': 'bytes=0-1', 'If-Range': '"stale"'})
+        self.assertEqual(status, 200)
+        status, _, payload, _ = self._respond({'If-None-Match': file_etag(st)})
+        self.assertEqual((status, payload), (304, b''))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2019 Erik Mossberg
+
+This file is part of SeriousBusiness.
+
+SeriousBusiness is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+SeriousBusiness is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+import bisect
+import collections
+import threading
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds of the request latency buckets, in seconds.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Paths with their own route label, anything else is 'other' so that
+# scanners probing random paths cannot grow the label set.
+ROUTES = frozenset(['index', 'search', 'fronter', 'serve_content', 'thumbnail', 'hls', 'hls_init',
+                    'hls_segment', 'metrics', 'static', 'api/clips', 'api/status', 'api/jobs'])
+
+
+def route_label(path):
+    """
+    Route a request path is counted under.
+    """
+    parts = path.strip('/').split('/')
+    route = parts[0] or 'index'
+    if route == 'api' and len(parts) > 1:
+        route = 'api/' + parts[1]
+    return route if route in ROUTES else 'other'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape_label(value)) for name, value in labels)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class MetricsWriter(object):
+
+    def __init__(self):
+        """
+        Collects samples and renders them in the Prometheus text format,
+        grouped by metric family.
+        """
+        self._families = collections.OrderedDict()
+
+    def add(self, name, kind, doc, value, labels=()):
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = (kind, doc, [])
+        family[2].append((name, tuple(labels), value))
+
+    def add_histogram(self, name, doc, histogram, labels=()):
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = ('histogram', doc, [])
+        bounds, cumulative, total, count = histogram.get_snapshot()
+        for bound, n in zip(bounds + (float('inf'),), cumulative):
+            family[2].append((name + '_bucket', tuple(labels) + (('le', format_value(bound)),), n))
+        family[2].append((name + '_sum', tuple(labels), total))
+        family[2].append((name + '_count', tuple(labels), count))
+
+    def add_stats(self, prefix, doc, stats, labels=()):
+        """
+        One gauge per numeric entry of a get_stats() dict.
+        """
+        for key, value in sorted(stats.items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                self.add('%s_%s' % (prefix, key), 'gauge', '%s: %s.' % (doc, key), value, labels)
+
+    def render(self):
+        lines = []
+        for name, (kind, doc, samples) in self._families.items():
+            lines.append('# HELP %s %s' % (name, doc))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for sample_name, labels, value in samples:
+                lines.append('%s%s %s' % (sample_name, format_labels(labels), format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class Histogram(object):
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        """
+        Counts of observations per bucket, not thread safe on its own.
+        """
+        self._bounds = tuple(bounds)
+        self._counts = [0] * (len(self._bounds) + 1)
+        self._sum = 0.0
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self._bounds, value)] += 1
+        self._sum += value
+
+    def get_snapshot(self):
+        """
+        (bounds, cumulative counts including +Inf, sum, count).
+        """
+        cumulative = []
+        running = 0
+        for n in self._counts:
+            running += n
+            cumulative.append(running)
+        return self._bounds, cumulative, self._sum, running
+
+
+class RequestMetrics(object):
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        """
+        Per route latency, responses by status and bytes served, shared
+        by whichever HTTP engine serves the routes.
+
+        Latency is the time until the response head is ready. Streamed
+        bodies show in the byte count rather than the latency.
+        """
+        self._bounds = bounds
+        self._lock = threading.Lock()
+        self._latency = {}
+        self._responses = collections.Counter()
+        self._bytes = collections.Counter()
+
+    def observe(self, route, seconds, status, nbytes):
+        with self._lock:
+            histogram = self._latency.get(route)
+            if histogram is None:
+                histogram = self._latency[route] = Histogram(self._bounds)
+            histogram.observe(seconds)
+            self._responses[(route, status)] += 1
+            self._bytes[route] += nbytes
+
+    def write(self, writer):
+        with self._lock:
+            for route, histogram in sorted(self._latency.items()):
+                writer.add_histogram('sbsns_http_request_duration_seconds',
+                                     'Time until the response head was ready, per route.',
+                                     histogram, [('route', route)])
+            for (route, status), n in sorted(self._responses.items()):
+                writer.add('sbsns_http_responses_total', 'counter', 'Responses per route and status.',
+                           n, [('route', route), ('status', status)])
+            for route, n in sorted(self._bytes.items()):
+                writer.add('sbsns_http_response_bytes_total', 'counter',
+                           'Response body bytes per route, as declared by Content-Length.',
+                           n, [('route', route)])
+
+
+class PhaseClock(object):
+
+    def __init__(self, clock=time.perf_counter):
+        """
+        Wall time per named phase. Time spent in a phase entered while
+        another is running only counts for the inner one.
+        """
+        self._clock = clock
+        self._totals = collections.OrderedDict()
+        self._stack = []
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def _enter(self, name):
+        now = self._clock()
+        if self._stack:
+            self._charge(self._stack[-1], now)
+        self._stack.append([name, now])
+
+    def _exit(self):
+        now = self._clock()
+        self._charge(self._stack.pop(), now)
+        if self._stack:
+            self._stack[-1][1] = now
+
+    def _charge(self, entry, now):
+        self._totals[entry[0]] = self._totals.get(entry[0], 0.0) + now - entry[1]
+
+    def get_totals(self):
+        return dict(self._totals)
+
+
+class _Phase(object):
+
+    def __init__(self, clock, name):
+        self._clock = clock
+        self._name = name
+
+    def __enter__(self):
+        self._clock._enter(self._name)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._clock._exit()
+        return False
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_route_label(self):
+        self.assertEqual(route_label('/'), 'index')
+        self.assertEqual(route_label('/api/clips'), 'api/clips')
+        self.assertEqual(route_label('/static/sbsns.css'), 'static')
+        self.assertEqual(route_label('/wp-login.php'), 'other')
+
+    def test_render(self):
+        metrics = RequestMetrics(bounds=(0.01, 0.1))
+        metrics.observe('index', 0.005, 200, 100)
+        metrics.observe('index', 0.05, 304, 0)
+        metrics.observe('index', 1.0, 200, 100)
+        writer = MetricsWriter()
+        metrics.write(writer)
+        writer.add('sbsns_library_clips', 'gauge', 'Clips in the library.', 2)
+        text = writer.render()
+        self.assertIn('# TYPE sbsns_http_request_duration_seconds histogram\n', text)
+        self.assertIn('sbsns_http_request_duration_seconds_bucket{route="index",le="0.01"} 1\n', text)
+        self.assertIn('sbsns_http_request_duration_seconds_bucket{route="index",le="0.1"} 2\n', text)
+        self.assertIn('sbsns_http_request_duration_seconds_bucket{route="index",le="+Inf"} 3\n', text)
+        self.assertIn('sbsns_http_request_duration_seconds_count{route="index"} 3\n', text)
+        self.assertIn('sbsns_http_responses_total{route="index",status="304"} 1\n', text)
+        self.assertIn('sbsns_http_response_bytes_total{route="index"} 200\n', text)
+        self.assertTrue(text.endswith('sbsns_library_clips 2\n'))
+
+    def test_phase_clock(self):
+        now = [0.0]
+        clock = PhaseClock(lambda: now[0])
+        with clock.phase('json_scan'):
+            now[0] = 1.0
+            with clock.phase('thumbnail_inference'):
+                now[0] = 3.0
+            now[0] = 4.0
+        self.assertEqual(clock.get_totals(), {'json_scan': 2.0, 'thumbnail_inference': 2.0})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2019 Erik Mossberg
+
+This file is part of SeriousBusiness.
+
+SeriousBusiness is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+SeriousBusiness is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+import logs
+
+log = logs.get_logger('mp4_probe')
+
+_BOX_HEADER = struct.Struct('>I4s')
+_U64 = struct.Struct('>Q')
+
+# Containers walked on the way to the boxes we read.
+_CONTAINERS = {b'moov', b'trak', b'mdia', b'minf', b'stbl', b'edts', b'mvex'}
+
+# A moov larger than this is not a moov we want to parse.
+MAX_MOOV_SIZE = 64 * 1024 * 1024
+
+
+class Mp4Error(Exception):
+    pass
+
+
+class Mp4Info(object):
+
+    FIELDS = ('duration', 'width', 'height', 'video_codec', 'audio_codec', 'bitrate',
+              'moov_offset', 'moov_size', 'mdat_offset', 'fragmented')
+    __slots__ = FIELDS
+
+    def __init__(self, duration=None, width=None, height=None, video_codec=None,
+                 audio_codec=None, bitrate=None, moov_offset=None, moov_size=None,
+                 mdat_offset=None, fragmented=False):
+        """
+        What the box structure of an MP4 file tells about it.
+
+        duration is in seconds, bitrate in bits per second averaged over
+        the whole file, codecs as RFC 6381 strings (e.g. 'avc1.64001f',
+        'mp4a.40.2'). Offsets are in bytes from the start of the file.
+        """
+        self.duration = duration
+        self.width = width
+        self.height = height
+        self.video_codec = video_codec
+        self.audio_codec = audio_codec
+        self.bitrate = bitrate
+        self.moov_offset = moov_offset
+        self.moov_size = moov_size
+        self.mdat_offset = mdat_offset
+        self.fragmented = fragmented
+
+    def is_faststart(self):
+        """
+        Is the moov atom ahead of the media data, so playback can start
+        before the whole file was downloaded.
+        """
+        return self.moov_offset is not None and (
+            self.mdat_offset is None or self.moov_offset < self.mdat_offset)
+
+    def get_codecs(self):
+        """
+        Codecs string for a MIME type parameter, e.g. 'avc1.64001f,mp4a.40.2'.
+        """
+        return ','.join(c for c in (self.video_codec, self.audio_codec) if c)
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.FIELDS)
+
+    @classmethod
+    def from_dict(cls, fields):
+        info = cls(**dict((name, fields.get(name)) for name in cls.FIELDS))
+        # A library has few distinct codecs, share their strings.
+        if info.video_codec is not None:
+            info.video_codec = sys.intern(info.video_codec)
+        if info.audio_codec is not None:
+            info.audio_codec = sys.intern(info.audio_codec)
+        return info
+
+    def __eq__(self, other):
+        return isinstance(other, Mp4Info) and self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Mp4Info(%s)' % ', '.join('%s=%r' % item for item in self.to_dict().items())
+
+
+def walk_boxes(buf, start, end):
+    """
+    (type, box_start, payload_start, box_end) of the boxes in
+    buf[start:end].
+
+    Only box headers are touched, so with buf an mmap, the media data
+    in between is never read from storage.
+    """
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = _BOX_HEADER.unpack_from(buf, offset)
+        header = 8
+        if size == 1:
+            if offset + 16 > end:
+                raise Mp4Error("Truncated box header at %d" % offset)
+            size = _U64.unpack_from(buf, offset + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header or offset + size > end:
+            raise Mp4Error("Bad size %d for box %r at %d" % (size, box_type, offset))
+        yield box_type, offset, offset + header, offset + size
+        offset += size
+
+
+def iter_boxes(buf, start, end):
+    """
+    (type, payload_start, box_end) of the boxes in buf[start:end].
+    """
+    for box_type, _, payload, box_end in walk_boxes(buf, start, end):
+        yield box_type, payload, box_end
+
+
+def _full_box_version(buf, start):
+    return buf[start]
+
+
+def _parse_mvhd(buf, start):
+    if _full_box_version(buf, start) == 1:
+        timescale, duration = struct.unpack_from('>IQ', buf, start + 20)
+    else:
+        timescale, duration = struct.unpack_from('>II', buf, start + 12)
+    return timescale, duration
+
+
+def _parse_tkhd(buf, start):
+    offset = start + (92 if _full_box_version(buf, start) == 1 else 80)
+    width, height = struct.unpack_from('>II', buf, offset)
+    return width >> 16, height >> 16
+
+
+def _read_descriptor(buf, offset, end):
+    """
+    (tag, payload_start, payload_end) of an MPEG-4 descriptor.
+    """
+    tag = buf[offset]
+    offset += 1
+    length = 0
+    for _ in range(4):
+        byte = buf[offset]
+        offset += 1
+        length = (length << 7) | (byte & 0x7f)
+        if not byte & 0x80:
+            break
+    return tag, offset, min(offset + length, end)
+
+
+def _parse_esds(buf, start, end):
+    """
+    RFC 6381 codec string from an esds box, e.g. 'mp4a.40.2'.
+    """
+    tag, offset, es_end = _read_descriptor(buf, start + 4, end)
+    if tag != 0x03:
+        return 'mp4a'
+    flags = buf[offset + 2]
+    offset += 3
+    if flags & 0x80:
+        offset += 2
+    if flags & 0x40:
+        offset += 1 + buf[offset]
+    if flags & 0x20:
+        offset += 2
+
+    tag, offset, dc_end = _read_descriptor(buf, offset, es_end)
+    if tag != 0x04:
+        return 'mp4a'
+    object_type = buf[offset]
+    codec = 'mp4a.%x' % object_type
+
+    offset += 13
+    if offset < dc_end:
+        tag, offset, _ = _read_descriptor(buf, offset, dc_end)
+        if tag == 0x05:
+            audio_object_type = buf[offset] >> 3
+            codec += '.%d' % audio_object_type
+    return codec
+
+
+def _parse_stsd(buf, start, end):
+    """
+    (codec, width, height) of the first sample entry.
+    """
+    offset = start + 8
+    for entry_type, entry_start, entry_end in iter_boxes(buf, offset, end):
+        codec = entry_type.decode('ascii', 'replace')
+        if entry_type in (b'avc1', b'avc3', b'hvc1', b'hev1', b'vp09', b'av01'):
+            width, height = struct.unpack_from('>HH', buf, entry_start + 24)
+            for child, child_start, _ in iter_boxes(buf, entry_start + 78, entry_end):
+                if child == b'avcC':
+                    profile, compat, level = buf[child_start + 1:child_start + 4]
+                    codec = '%s.%02x%02x%02x' % (codec, profile, compat, level)
+            return codec, width, height
+        if entry_type == b'mp4a':
+            for child, child_start, child_end in iter_boxes(buf, entry_start + 28, entry_end):
+                if child == b'esds':
+                    codec = _parse_esds(buf, child_start, child_end)
+            return codec, None, None
+        return codec, None, None
+    return None, None, None
+
+
+def _parse_trak(buf, start, end, info):
+    handler = None
+    codec = None
+    width = height = None
+    stack = [(start, end)]
+    while stack:
+        box_start, box_end = stack.pop()
+        for box_type, payload, child_end in iter_boxes(buf, box_start, box_end):
+            if box_type in _CONTAINERS:
+                stack.append((payload, child_end))
+            elif box_type == b'tkhd':
+                width, height = _parse_tkhd(buf, payload)
+            elif box_type == b'hdlr':
+                handler = bytes(buf[payload + 8:payload + 12])
+            elif box_type == b'stsd':
+                codec, entry_width, entry_height = _parse_stsd(buf, payload, child_end)
+                if entry_width:
+                    width, height = entry_width, entry_height
+
+    if handler == b'vide' and info.video_codec is None:
+        info.video_codec = codec
+        info.width = width
+        info.height = height
+    elif handler == b'soun' and info.audio_codec is None:
+        info.audio_codec = codec
+
+
+def parse_mp4(buf, size):
+    """
+    Mp4Info from a buffer (bytes or mmap) holding a whole file.
+    """
+    info = Mp4Info()
+    moov = None
+    for box_type, box_start, payload, box_end in walk_boxes(buf, 0, size):
+        if box_type == b'moov':
+            info.moov_offset = box_start
+            info.moov_size = box_end - box_start
+            moov = (payload, box_end)
+        elif box_type == b'mdat' and info.mdat_offset is None:
+            info.mdat_offset = box_start
+        elif box_type == b'moof':
+            info.fragmented = True
+
+    if moov is None:
+        raise Mp4Error("No moov box")
+    if info.moov_size > MAX_MOOV_SIZE:
+        raise Mp4Error("moov box of %d bytes" % info.moov_size)
+
+    timescale = duration = None
+    for box_type, payload, box_end in iter_boxes(buf, moov[0], moov[1]):
+        if box_type == b'mvhd':
+            timescale, duration = _parse_mvhd(buf, payload)
+        elif box_type == b'trak':
+            _parse_trak(buf, payload, box_end, info)
+        elif box_type == b'mvex':
+            info.fragmented = True
+
+    if timescale and duration and duration != 0xffffffff:
+        info.duration = duration / timescale
+        info.bitrate = int(size * 8 / info.duration)
+    return info
+
+
+def probe_mp4(path):
+    """
+    Mp4Info for an MP4 file, or None if it is not a readable MP4.
+
+    The file is mapped, not read. Only box headers and the moov box
+    are touched, so the cost does not depend on the length of the clip.
+    """
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < 8:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                return parse_mp4(buf, size)
+    except (OSError, ValueError, IndexError, struct.error, Mp4Error) as ex:
+        log.warning("Could not probe '%s': %s", path, ex)
+        return None
+
+
+def _box(box_type, payload):
+    return _BOX_HEADER.pack(8 + len(payload), box_type) + payload
+
+
+class TestMp4Probe(unittest.TestCase):
+
+    def test_sample_clip(self):
+        info = probe_mp4('../media/Simple landscape flyover.mp4')
+        self.assertIsNotNone(info)
+        self.assertGreater(info.duration, 0)
+        self.assertGreater(info.width, 0)
+        self.assertGreater(info.height, 0)
+        self.assertTrue(info.video_codec.startswith('avc1.'))
+        self.assertFalse(info.is_faststart())
+        self.assertEqual(info.moov_offset + info.moov_size, os.path.getsize('../media/Simple landscape flyover.mp4'))
+        self.assertEqual(Mp4Info.from_dict(info.to_dict()), info)
+
+    def test_synthetic(self):
+        mvhd = _box(b'mvhd', bytes(12) + struct.pack('>II', 1000, 90000) + bytes(80))
+        moov = _box(b'moov', mvhd)
+        # A 64-bit size mdat ahead of the moov.
+        mdat = struct.pack('>I4sQ', 1, b'mdat', 16 + 100) + bytes(100)
+        data = _box(b'ftyp', b'isom' + bytes(4)) + moov + mdat
+
+        info = parse_mp4(data, len(data))
+        self.assertEqual(info.duration, 90.0)
+        self.assertEqual(info.bitrate, int(len(data) * 8 / 90))
+        self.assertTrue(info.is_faststart())
+
+        with self.assertRaises(Mp4Error):
+            parse_mp4(data[:-10], len(data) - 10)
+
+        # AAC-LC: object type 0x40, audio object type 2.
+        esds = bytes(4) + bytes([0x03, 25, 0, 1, 0, 0x04, 17, 0x40, 0x15]) + bytes(11) + \
+            bytes([0x05, 2, 0x12, 0x10])
+        self.assertEqual(_parse_esds(esds, 0, len(esds)), 'mp4a.40.2')
+
+    def test_not_mp4(self):
+        self.assertIsNone(probe_mp4('../media/hello.txt'))
+        with tempfile.NamedTemporaryFile(suffix='.mp4') as f:
+            self.assertIsNone(probe_mp4(f.name))
+
+if __name__ == '__main__':
+    unittest.main()
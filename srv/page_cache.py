@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2019 Erik Mossberg
+
+This file is part of SeriousBusiness.
+
+SeriousBusiness is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+SeriousBusiness is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+import collections
+import gzip
+import hashlib
+import threading
+
+
+class RenderedPage(object):
+
+    def __init__(self, text, content_type='text/html;charset=utf-8'):
+        """
+        A page rendered once, kept as utf-8 bytes and a gzipped copy,
+        each with its own strong ETag.
+        """
+        self._body = text.encode('utf-8')
+        self._gzipped = gzip.compress(self._body, compresslevel=6, mtime=0)
+        digest = hashlib.sha1(self._body).hexdigest()
+        self._etag = '"%s"' % digest
+        self._gzipped_etag = '"%s-gz"' % digest
+        self._content_type = content_type
+
+    def get_body(self, gzipped=False):
+        if gzipped:
+            return self._gzipped
+        return self._body
+
+    def get_etag(self, gzipped=False):
+        if gzipped:
+            return self._gzipped_etag
+        return self._etag
+
+    def get_content_type(self):
+        return self._content_type
+
+
+class PageCache(object):
+
+    def __init__(self, max_pages=1024):
+        """
+        Rendered pages for one library generation.
+
+        Everything is dropped when the generation changes, so the cache
+        never outlives the library state it was rendered from. Keys may
+        come from request parameters, so at most max_pages are kept,
+        the least recently used are dropped past that.
+        """
+        self._max_pages = max_pages
+        self._generation = None
+        self._pages = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, generation, key, render, content_type='text/html;charset=utf-8'):
+        """
+        Cached RenderedPage for key, calling render() to produce its
+        text on a miss.
+        """
+        with self._lock:
+            if generation != self._generation:
+                self._generation = generation
+                self._pages = collections.OrderedDict()
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+                self._hits += 1
+                return page
+            self._misses += 1
+
+        page = RenderedPage(render(), content_type)
+        with self._lock:
+            if generation == self._generation and self._max_pages > 0:
+                self._pages[key] = page
+                while len(self._pages) > self._max_pages:
+                    self._pages.popitem(last=False)
+        return page
+
+    def get_stats(self):
+        with self._lock:
+            return {'hits': self._hits, 'misses': self._misses, 'pages': len(self._pages)}
+
+
+def etag_matches(if_none_match, etag):
+    """
+    Does an If-None-Match header value match etag.
+    """
+    if not if_none_match:
+        return False
+
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*':
+            return True
+        # If-None-Match uses weak comparison.
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def accepts_gzip(accept_encoding):
+    """
+    Does an Accept-Encoding header value allow gzip.
+    """
+    if not accept_encoding:
+        return False
+
+    for coding in accept_encoding.split(','):
+        name, _, params = coding.partition(';')
+        if name.strip().lower() not in ('gzip', '*'):
+            continue
+        params = params.strip().replace(' ', '')
+        if params.startswith('q='):
+            try:
+                if float(params[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        return True
+    return False
+
+
+class TestPageCache(unittest.TestCase):
+
+    def test_rendered_page(self):
+        page = RenderedPage('<p>hello</p>')
+        self.assertEqual(page.get_body(), b'<p>hello</p>')
+        self.assertEqual(gzip.decompress(page.get_body(gzipped=True)), b'<p>hello</p>')
+        self.assertEqual(page.get_etag(), RenderedPage('<p>hello</p>').get_etag())
+        self.assertNotEqual(page.get_etag(gzipped=True), page.get_etag())
+        self.assertNotEqual(page.get_etag(), RenderedPage('<p>bye</p>').get_etag())
+
+    def test_generations(self):
+        cache = PageCache()
+        renders = []
+
+        def render():
+            renders.append(1)
+            return 'page %d' % len(renders)
+
+        first = cache.get(1, 'index', render)
+        self.assertIs(cache.get(1, 'index', render), first)
+        self.assertEqual(len(renders), 1)
+
+        second = cache.get(2, 'index', render)
+        self.assertEqual(second.get_body(), b'page 2')
+        self.assertEqual(cache.get_stats(), {'hits': 1, 'misses': 2, 'pages': 1})
+
+    def test_bounded(self):
+        cache = PageCache(max_pages=2)
+        index = cache.get(1, 'index', lambda: 'index')
+        for key in range(5):
+            cache.get(1, key, lambda: 'page')
+            # Kept while in use, junk keys only push each other out.
+            self.assertIs(cache.get(1, 'index', lambda: 'index'), index)
+        self.assertEqual(cache.get_stats()['pages'], 2)
+
+    def test_headers(self):
+        self.assertTrue(etag_matches('"abc"', '"abc"'))
+        self.assertTrue(etag_matches('"x", W/"abc"', '"abc"'))
+        self.assertTrue(etag_matches('*', '"abc"'))
+        self.assertFalse(etag_matches('"abcd"', '"abc"'))
+        self.assertFalse(etag_matches(None, '"abc"'))
+
+        self.assertTrue(accepts_gzip('gzip, deflate, br'))
+        self.assertTrue(accepts_gzip('deflate;q=1.0, gzip;q=0.5'))
+        self.assertFalse(accepts_gzip('gzip;q=0'))
+        self.assertFalse(accepts_gzip('identity'))
+        self.assertFalse(accepts_gzip(None))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2019 Erik Mossberg
+
+This file is part of SeriousBusiness.
+
+SeriousBusiness is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+SeriousBusiness is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+import collections
+import heapq
+import json
+import operator
+import os
+import tempfile
+import threading
+import time
+
+from disk_cache import write_atomic
+from media_stream import FileRegion
+from metrics import Histogram
+import logs
+
+log = logs.get_logger('readahead')
+
+# A request this many seconds ago weighs half of one now.
+POPULARITY_HALF_LIFE = 24 * 3600.0
+
+# Clips tracked at most, the least requested are forgotten past that.
+MAX_TRACKED = 100000
+
+# Bytes read ahead of each range a player is sent.
+READAHEAD_BYTES = 8 * 1024 * 1024
+
+# Bytes read from the head of each warmed clip.
+WARM_BYTES = 4 * 1024 * 1024
+
+# Bytes per read while warming.
+WARM_CHUNK = 1024 * 1024
+
+# Readahead hints waiting at most, more are dropped.
+MAX_PENDING = 256
+
+# Bytes read at the start of each stream, to tell whether the page
+# cache had it and how long the disk took if not.
+PROBE_BYTES = 4096
+
+# From page cache hits to seeks on a busy disk, in seconds.
+READ_LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                        0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+HAVE_FADVISE = hasattr(os, 'posix_fadvise')
+
+
+class PopularityTracker(object):
+
+    def __init__(self, half_life=POPULARITY_HALF_LIFE, max_tracked=MAX_TRACKED, clock=time.time):
+        """
+        Requests per clip, decayed so that recent requests count most.
+        Thread safe.
+        """
+        self._half_life = half_life
+        self._max_tracked = max_tracked
+        self._clock = clock
+        self._lock = threading.Lock()
+        # Scores are in requests made at _epoch. Later requests weigh
+        # more instead of older ones being decayed, so a request is
+        # O(1), and scores are rebased before they overflow.
+        self._epoch = clock()
+        self._scores = {}
+
+    def _weight(self, now):
+        return 2.0 ** ((now - self._epoch) / self._half_life)
+
+    def record(self, key):
+        with self._lock:
+            now = self._clock()
+            weight = self._weight(now)
+            if weight > 2.0 ** 64:
+                self._scores = {k: score / weight for k, score in self._scores.items()}
+                self._epoch = now
+                weight = 1.0
+            self._scores[key] = self._scores.get(key, 0.0) + weight
+            if len(self._scores) > self._max_tracked:
+                forget = max(1, self._max_tracked // 10)
+                for k, _ in heapq.nsmallest(forget, self._scores.items(), key=operator.itemgetter(1)):
+                    del self._scores[k]
+
+    def get_score(self, key):
+        """
+        Requests for key, each decayed by its age.
+        """
+        with self._lock:
+            return self._scores.get(key, 0.0) / self._weight(self._clock())
+
+    def top(self, n):
+        """
+        The n most requested keys, most requested first.
+        """
+        with self._lock:
+            return [k for k, _ in heapq.nlargest(n, self._scores.items(), key=operator.itemgetter(1))]
+
+    def get_stats(self):
+        with self._lock:
+            return {'tracked': len(self._scores)}
+
+    def save(self, path):
+        with self._lock:
+            now = self._clock()
+            weight = self._weight(now)
+            data = {'version': 1, 'saved': now,
+                    'scores': {k: score / weight for k, score in self._scores.items()}}
+        write_atomic(path, json.dumps(data).encode('utf-8'))
+
+    def load(self, path):
+        """
+        Scores saved by save(), decayed for the time since. A missing
+        or unreadable file leaves the tracker empty.
+        """
+        try:
+            with open(path, 'rb') as f:
+                data = json.loads(f.read().decode('utf-8'))
+            saved = float(data['saved'])
+            scores = data['scores']
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError) as ex:
+            log.warning("Ignoring popularity state '%s': %s", path, ex)
+            return
+        with self._lock:
+            now = self._clock()
+            factor = self._weight(now) * 2.0 ** (-max(0.0, now - saved) / self._half_life)
+            self._scores = {k: float(score) * factor for k, score in scores.items()}
+        log.info("Loaded request counts of %d clips.", len(scores))
+
+
+class Readahead(object):
+
+    def __init__(self, window=READAHEAD_BYTES, max_pending=MAX_PENDING):
+        """
+        Gets media into the page cache before requests need it:
+        readahead past the ranges being streamed, and warming of the
+        heads of popular clips. The reads run on a background thread,
+        started with the first of them.
+
+        The start of every stream is probed, counting whether the page
+        cache had it and how long it took to read. With window 0 there
+        is no readahead, only the probes.
+        """
+        self._window = window
+        self._max_pending = max_pending
+        self._nowait = hasattr(os, 'RWF_NOWAIT')
+        self._cond = threading.Condition()
+        self._hints = collections.deque()
+        self._warm = collections.deque()
+        self._thread = None
+        self._stopping = False
+        self._hits = 0
+        self._misses = 0
+        self._latency = Histogram(READ_LATENCY_BUCKETS)
+        self._hinted = 0
+        self._hinted_bytes = 0
+        self._dropped = 0
+        self._warmed_files = 0
+        self._warmed_bytes = 0
+        self._warm_seconds = 0.0
+
+    def start_stream(self, path, fileobj, body):
+        """
+        Note a response about to send the FileRegions in body from the
+        open file at path: probe the start of the first one and queue
+        readahead past each. Blocks while the disk seeks on a cold
+        cache, so call it off an event loop.
+        """
+        regions = [item for item in body if isinstance(item, FileRegion)]
+        if not regions:
+            return
+        hit, seconds = self._probe(fileobj.fileno(), regions[0].offset)
+        with self._cond:
+            if hit is True:
+                self._hits += 1
+            elif hit is False:
+                self._misses += 1
+            self._latency.observe(seconds)
+            if not self._window:
+                return
+            for region in regions:
+                # Up to a window of the region itself, and one past it,
+                # where a player's next range is likely to start.
+                count = min(region.count, self._window) + self._window
+                if len(self._hints) >= self._max_pending:
+                    self._dropped += 1
+                    continue
+                self._hints.append((path, region.offset, count))
+                self._hinted += 1
+                self._hinted_bytes += count
+            self._wake()
+
+    def _probe(self, fd, offset):
+        """
+        (hit, seconds) of reading PROBE_BYTES at offset. hit is None
+        where the page cache cannot be asked, without RWF_NOWAIT.
+        """
+        start = time.perf_counter()
+        hit = None
+        if self._nowait:
+            try:
+                os.preadv(fd, [bytearray(PROBE_BYTES)], offset, os.RWF_NOWAIT)
+                return True, time.perf_counter() - start
+            except BlockingIOError:
+                hit = False
+            except OSError as ex:
+                log.info("Page cache probes are not supported here: %s", ex)
+                self._nowait = False
+        os.pread(fd, PROBE_BYTES, offset)
+        return hit, time.perf_counter() - start
+
+    def warm(self, targets):
+        """
+        Read targets, (path, [(offset, count), ...]) pairs, into the
+        page cache. Replaces targets still waiting from earlier calls.
+        """
+        with self._cond:
+            self._warm = collections.deque(targets)
+            self._wake()
+
+    def _wake(self):
+        if self._thread is None and not self._stopping:
+            self._thread = threading.Thread(target=self._run, name='Readahead', daemon=True)
+            self._thread.start()
+        self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            thread = self._thread
+            self._cond.notify()
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not (self._hints or self._warm or self._stopping):
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                # Streams in progress go before warming.
+                if self._hints:
+                    task, args = self._read_ahead, self._hints.popleft()
+                else:
+                    task, args = self._read_warm, self._warm.popleft()
+            try:
+                task(*args)
+            except OSError as ex:
+                log.debug("Readahead of '%s' failed: %s", args[0], ex)
+
+    def _read_ahead(self, path, offset, count):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if HAVE_FADVISE:
+                os.posix_fadvise(fd, offset, count, os.POSIX_FADV_WILLNEED)
+            else:
+                self._read(fd, offset, count)
+        finally:
+            os.close(fd)
+
+    def _read_warm(self, path, regions):
+        start = time.perf_counter()
+        nbytes = 0
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            for offset, count in regions:
+                if HAVE_FADVISE:
+                    os.posix_fadvise(fd, offset, count, os.POSIX_FADV_WILLNEED)
+                nbytes += self._read(fd, offset, count)
+        finally:
+            os.close(fd)
+        with self._cond:
+            self._warmed_files += 1
+            self._warmed_bytes += nbytes
+            self._warm_seconds += time.perf_counter() - start
+
+    def _read(self, fd, offset, count):
+        """
+        Read a range through the page cache, returning the bytes read.
+        """
+        end = offset + count
+        while offset < end and not self._stopping:
+            chunk = os.pread(fd, min(WARM_CHUNK, end - offset), offset)
+            if not chunk:
+                break
+            offset += len(chunk)
+        return offset + count - end
+
+    def get_stats(self):
+        with self._cond:
+            return {'hits': self._hits, 'misses': self._misses,
+                    'hints': self._hinted, 'hinted_bytes': self._hinted_bytes,
+                    'hints_dropped': self._dropped, 'pending': len(self._hints) + len(self._warm),
+                    'warmed_files': self._warmed_files, 'warmed_bytes': self._warmed_bytes,
+                    'warm_seconds': self._warm_seconds}
+
+    def write(self, writer):
+        stats = self.get_stats()
+        hits, misses = stats['hits'], stats['misses']
+        writer.add('sbsns_stream_start_reads_total', 'counter',
+                   'Stream starts, by whether the page cache held them.', hits, [('result', 'hit')])
+        writer.add('sbsns_stream_start_reads_total', 'counter',
+                   'Stream starts, by whether the page cache held them.', misses, [('result', 'miss')])
+        writer.add('sbsns_stream_start_hit_ratio', 'gauge',
+                   'Share of stream starts the page cache held, since start.',
+                   hits / (hits + misses) if hits + misses else 0.0)
+        with self._cond:
+            writer.add_histogram('sbsns_stream_start_read_seconds',
+                                 'Time to read the first page of each stream.', self._latency)
+        writer.add('sbsns_readahead_hints_total', 'counter', 'Ranges queued for readahead.',
+                   stats['hints'], [('result', 'queued')])
+        writer.add('sbsns_readahead_hints_total', 'counter', 'Ranges queued for readahead.',
+                   stats['hints_dropped'], [('result', 'dropped')])
+        writer.add('sbsns_readahead_bytes_total', 'counter', 'Bytes queued for readahead.',
+                   stats['hinted_bytes'])
+        writer.add('sbsns_readahead_pending', 'gauge', 'Readahead and warming waiting.', stats['pending'])
+        writer.add('sbsns_warm_files_total', 'counter', 'Clips read into the page cache.',
+                   stats['warmed_files'])
+        writer.add('sbsns_warm_bytes_total', 'counter', 'Bytes read to warm the page cache.',
+                   stats['warmed_bytes'])
+        writer.add('sbsns_warm_seconds_total', 'counter', 'Time spent warming the page cache.',
+                   stats['warm_seconds'])
+
+
+class TestReadahead(unittest.TestCase):
+
+    def test_popularity(self):
+        now = [0.0]
+        tracker = PopularityTracker(half_life=10.0, max_tracked=3, clock=lambda: now[0])
+        for key in ['a', 'a', 'a', 'b']:
+            tracker.record(key)
+        self.assertEqual(tracker.top(1), ['a'])
+        now[0] = 20.0
+        self.assertAlmostEqual(tracker.get_score('a'), 0.75)
+        tracker.record('b')
+        tracker.record('b')
+        self.assertEqual(tracker.top(5), ['b', 'a'])
+        tracker.record('c')
+        tracker.record('d')
+        # Past max_tracked, the least requested is forgotten, by now
+        # that is 'a'.
+        self.assertEqual(sorted(tracker.top(5)), ['b', 'c', 'd'])
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'popularity.json')
+            tracker.save(path)
+            now[0] = 30.0
+            loaded = PopularityTracker(half_life=10.0, clock=lambda: now[0])
+            loaded.load(path)
+            self.assertEqual(loaded.top(5), tracker.top(5))
+            self.assertAlmostEqual(loaded.get_score('b'), tracker.get_score('b'))
+            empty = PopularityTracker()
+            empty.load(os.path.join(tmpdir, 'nope.json'))
+            self.assertEqual(empty.top(5), [])
+
+    def test_readahead(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'clip.mp4')
+            with open(path, 'wb') as f:
+                f.write(os.urandom(3 * WARM_CHUNK))
+            readahead = Readahead(window=WARM_CHUNK, max_pending=1)
+            try:
+                with open(path, 'rb') as f:
+                    readahead.start_stream(path, f, [b'--', FileRegion(f, 0, 100), FileRegion(f, 200, 100)])
+                readahead.warm([(path, [(0, 2 * WARM_CHUNK), (10 * WARM_CHUNK, 1)])])
+                deadline = time.monotonic() + 10
+                while not readahead.get_stats()['warmed_files'] and time.monotonic() < deadline:
+                    time.sleep(0.01)
+            finally:
+                readahead.stop()
+
+            stats = readahead.get_stats()
+            self.assertLessEqual(stats['hits'] + stats['misses'], 1)
+            self.assertEqual(readahead._latency.get_snapshot()[3], 1)
+            self.assertEqual((stats['hints'], stats['hints_dropped']), (1, 1))
+            self.assertEqual(stats['hinted_bytes'], 100 + WARM_CHUNK)
+            self.assertEqual(stats['warmed_files'], 1)
+            self.assertEqual(stats['warmed_bytes'], 2 * WARM_CHUNK)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2019 Erik Mossberg
+
+This file is part of SeriousBusiness.
+
+SeriousBusiness is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+SeriousBusiness is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+import array
+import bisect
+import collections
+import heapq
+import os
+import re
+import threading
+
+from media_clip import MediaClip
+from mp4_probe import Mp4Info
+
+_TOKEN = re.compile(r'[a-z0-9]+')
+
+# Weight of a query term matching a token exactly, as a prefix, or
+# within one edit.
+EXACT = 4
+PREFIX = 2
+FUZZY = 1
+
+# Tokens a prefix expands to, at most.
+MAX_PREFIX_EXPANSIONS = 64
+
+# Shorter terms are not matched fuzzily, too many tokens are one edit
+# away from them.
+MIN_FUZZY_LENGTH = 4
+
+# Matches ranked per query, at most. Beyond that the total is a lower
+# bound.
+MAX_MATCHES = 100000
+
+MAX_TERMS = 16
+
+_EDIT_CHARS = 'abcdefghijklmnopqrstuvwxyz0123456789'
+
+# Text fields a term can be restricted to, as in 'title:flyover'.
+FIELDS = {
+    'title': lambda clip: clip.get_title(),
+    'file': lambda clip: os.path.splitext(clip.get_filename())[0],
+    'uid': lambda clip: clip.get_uid(),
+}
+
+
+def tokenize(text):
+    if not text:
+        return []
+    return _TOKEN.findall(text.lower())
+
+
+def _codec_family(codec):
+    return codec.split('.')[0].lower()
+
+
+def facets_of(clip):
+    """
+    Facet tokens of a clip, e.g. 'codec:avc1', 'height:720' or
+    'length:short', from its probed media info.
+    """
+    info = clip.get_media_info()
+    if info is None:
+        return []
+    facets = []
+    if info.video_codec:
+        facets.append('codec:' + _codec_family(info.video_codec))
+    if info.audio_codec:
+        facets.append('audio:' + _codec_family(info.audio_codec))
+    if info.height:
+        facets.append('height:%d' % info.height)
+    if info.duration:
+        if info.duration < 5 * 60:
+            facets.append('length:short')
+        elif info.duration < 30 * 60:
+            facets.append('length:medium')
+        else:
+            facets.append('length:long')
+    return facets
+
+
+def tokens_of(clip):
+    """
+    Distinct tokens of a clip: words of its title, file name and uid,
+    plus its facets.
+    """
+    tokens = set()
+    for field in FIELDS.values():
+        tokens.update(tokenize(field(clip)))
+    tokens.update(facets_of(clip))
+    return tokens
+
+
+def edits1(term):
+    """
+    Strings one deletion, transposition, replacement or insertion away
+    from term.
+    """
+    splits = [(term[:i], term[i:]) for i in range(len(term) + 1)]
+    edits = set(a + b[1:] for a, b in splits if b)
+    edits.update(a + b[1] + b[0] + b[2:] for a, b in splits if len(b) > 1)
+    edits.update(a + c + b[1:] for a, b in splits if b for c in _EDIT_CHARS)
+    edits.update(a + c + b for a, b in splits for c in _EDIT_CHARS)
+    edits.discard(term)
+    return edits
+
+
+def _contains(postings, doc):
+    if isinstance(postings, int):
+        return postings == doc
+    i = bisect.bisect_left(postings, doc)
+    return i < len(postings) and postings[i] == doc
+
+
+def _size(postings):
+    return 1 if isinstance(postings, int) else len(postings)
+
+
+def _iter(postings):
+    return (postings,) if isinstance(postings, int) else postings
+
+
+class SearchIndex(object):
+
+    def __init__(self):
+        """
+        Inverted index from tokens to the clips they occur in, with
+        prefix and fuzzy token matching.
+
+        Postings are sorted arrays of document ids, or a bare id for
+        tokens of a single clip, such as most uids. update() changes
+        only the entries of clips added or removed since the last call,
+        searches see the index before or after a whole update.
+        """
+        self._lock = threading.Lock()
+        self._update_lock = threading.Lock()
+        # token -> doc id, or array of doc ids in ascending order
+        self._postings = {}
+        # Sorted tokens, for prefix matching, and the facet tokens.
+        self._vocabulary = []
+        self._facets = set()
+        # doc id -> clip, None once removed
+        self._docs = []
+        self._doc_of = {}
+        self._removed = 0
+        self._indexed = None
+
+    def update(self, clips):
+        """
+        Make the index cover exactly clips, reusing the entries of clips
+        already indexed. Clips are matched by identity. Returns whether
+        anything changed.
+        """
+        with self._update_lock:
+            if clips is self._indexed:
+                return False
+            self._indexed = clips
+            current = set(clips)
+            added = [clip for clip in clips if clip not in self._doc_of]
+            removed = [clip for clip in self._doc_of if clip not in current]
+            if not added and not removed:
+                return False
+
+            # Tokenized before blocking searches.
+            rebuild = self._removed + len(removed) > max(1000, len(self._docs) // 2)
+            if rebuild:
+                # Renumber, rather than carry mostly empty slots.
+                added = [(clip, tokens_of(clip)) for clip in clips]
+                removed = []
+            else:
+                added = [(clip, tokens_of(clip)) for clip in added]
+                removed = [(clip, tokens_of(clip)) for clip in removed]
+
+            with self._lock:
+                if rebuild:
+                    self._clear()
+                emptied = set()
+                for clip, tokens in removed:
+                    self._remove(clip, tokens, emptied)
+                new_tokens = set()
+                for clip, tokens in added:
+                    self._add(clip, tokens, new_tokens)
+                self._update_vocabulary(new_tokens - emptied, emptied - new_tokens)
+            return True
+
+    def _clear(self):
+        self._postings = {}
+        self._vocabulary = []
+        self._facets = set()
+        self._docs = []
+        self._doc_of = {}
+        self._removed = 0
+
+    def _add(self, clip, tokens, new_tokens):
+        doc = len(self._docs)
+        self._docs.append(clip)
+        self._doc_of[clip] = doc
+        postings = self._postings
+        for token in tokens:
+            entry = postings.get(token)
+            if entry is None:
+                postings[token] = doc
+                new_tokens.add(token)
+            elif isinstance(entry, int):
+                postings[token] = array.array('I', (entry, doc))
+            else:
+                # Ids only grow, appending keeps the order.
+                entry.append(doc)
+
+    def _remove(self, clip, tokens, emptied):
+        doc = self._doc_of.pop(clip)
+        self._docs[doc] = None
+        self._removed += 1
+        postings = self._postings
+        for token in tokens:
+            entry = postings[token]
+            if isinstance(entry, int):
+                del postings[token]
+                emptied.add(token)
+                continue
+            del entry[bisect.bisect_left(entry, doc)]
+            if len(entry) == 1:
+                postings[token] = entry[0]
+
+    def _update_vocabulary(self, added, removed):
+        vocabulary = self._vocabulary
+        if len(added) + len(removed) > len(vocabulary) // 100:
+            self._vocabulary = sorted(set(vocabulary).union(added).difference(removed))
+        else:
+            for token in removed:
+                del vocabulary[bisect.bisect_left(vocabulary, token)]
+            for token in added:
+                bisect.insort(vocabulary, token)
+        self._facets.difference_update(removed)
+        self._facets.update(token for token in added if ':' in token)
+
+    def get_size(self):
+        return len(self._doc_of)
+
+    def get_facets(self, query=''):
+        """
+        {facet: [(value, clips)]} of the clips matching query, like
+        search() does, or of every clip in the index for an empty query.
+        """
+        terms = self._parse(query)
+        with self._lock:
+            if terms:
+                counts = collections.Counter()
+                for doc in _iter(self._match(terms)):
+                    counts.update(facets_of(self._docs[doc]))
+            else:
+                counts = dict((token, _size(self._postings[token])) for token in self._facets)
+        facets = {}
+        for token, count in counts.items():
+            name, value = token.split(':', 1)
+            facets.setdefault(name, []).append((value, count))
+        for values in facets.values():
+            values.sort()
+        return facets
+
+    def _expand(self, term):
+        """
+        [(weight, token)] a query term matches.
+        """
+        if ':' in term:
+            return [(EXACT, term)] if term in self._postings else []
+
+        matches = []
+        if term in self._postings:
+            matches.append((EXACT, term))
+        vocabulary = self._vocabulary
+        i = bisect.bisect_right(vocabulary, term)
+        prefixed = set()
+        while i < len(vocabulary) and len(prefixed) < MAX_PREFIX_EXPANSIONS and \
+                vocabulary[i].startswith(term):
+            if ':' not in vocabulary[i]:
+                prefixed.add(vocabulary[i])
+                matches.append((PREFIX, vocabulary[i]))
+            i += 1
+        if len(term) >= MIN_FUZZY_LENGTH:
+            matches += [(FUZZY, token) for token in edits1(term)
+                        if token in self._postings and token not in prefixed]
+        return matches
+
+    def _parse(self, query):
+        """
+        [(field or None, term)]. 'field:text' restricts the words of
+        text to a field, facets such as 'codec:avc1' are terms as is.
+        """
+        terms = []
+        for word in query.split():
+            field = None
+            name, sep, text = word.partition(':')
+            if sep and name.lower() in FIELDS:
+                field, word = name.lower(), text
+            elif sep:
+                terms.append((None, word.lower()))
+                continue
+            terms += [(field, token) for token in tokenize(word)]
+        return terms[:MAX_TERMS]
+
+    def search(self, query, offset=0, limit=48):
+        """
+        (clips, total) of the clips matching every term of query, best
+        matches first, ties in index order. A total of MAX_MATCHES or
+        more is a lower bound.
+        """
+        terms = self._parse(query)
+        if not terms:
+            return [], 0
+
+        with self._lock:
+            matched = self._match(terms)
+            if not isinstance(matched, dict):
+                # One token, its postings are the answer in index order.
+                docs = _iter(matched)[offset:offset + limit]
+                return [self._docs[doc] for doc in docs], _size(matched)
+
+            ranked = heapq.nsmallest(offset + limit, matched.items(), key=lambda item: (-item[1], item[0]))
+            return [self._docs[doc] for doc, _ in ranked[offset:]], len(matched)
+
+    def _match(self, terms):
+        """
+        The docs matching every term, with the lock held: {doc: score},
+        or the postings entry of a query of one token.
+        """
+        postings = self._postings
+        expanded = []
+        for field, term in terms:
+            matches = [(weight, token, postings[token]) for weight, token in self._expand(term)]
+            if not matches:
+                return {}
+            expanded.append((sum(_size(entry) for _, _, entry in matches), field, matches))
+        expanded.sort(key=lambda item: item[0])
+
+        _, field, matches = expanded[0]
+        if len(expanded) == 1 and len(matches) == 1 and field is None:
+            return matches[0][2]
+
+        scores = self._score_driver(field, matches)
+        for _, field, matches in expanded[1:]:
+            scores = self._score_term(scores, field, matches)
+            if not scores:
+                return {}
+        return scores
+
+    def _score_driver(self, field, matches):
+        """
+        {doc: weight} of the docs a term matches, the term with the
+        fewest postings, best matching tokens first.
+        """
+        scores = {}
+        for weight, token, entry in sorted(matches, key=lambda match: -match[0]):
+            for doc in _iter(entry):
+                if doc not in scores and (field is None or self._field_has(doc, field, token)):
+                    scores[doc] = weight
+                    if len(scores) >= MAX_MATCHES:
+                        return scores
+        return scores
+
+    def _score_term(self, scores, field, matches):
+        matches = sorted(matches, key=lambda match: -match[0])
+        kept = {}
+        for doc, score in scores.items():
+            for weight, token, entry in matches:
+                if _contains(entry, doc) and (field is None or self._field_has(doc, field, token)):
+                    kept[doc] = score + weight
+                    break
+        return kept
+
+    def _field_has(self, doc, field, token):
+        return token in tokenize(FIELDS[field](self._docs[doc]))
+
+
+class TestSearchIndex(unittest.TestCase):
+
+    def _clip(self, uid, title, codec='avc1.64001e', height=720, duration=60.0):
+        info = Mp4Info(duration=duration, width=height * 16 // 9, height=height, video_codec=codec)
+        return MediaClip.from_fields((uid, uid + '.mp4', title, None), info)
+
+    def setUp(self):
+        self.clips = [self._clip('flyover', 'A simple landscape flyover'),
+                      self._clip('donut', 'Moving donut', height=480),
+                      self._clip('landmarks', 'Famous landmarks', codec='hvc1', duration=3600.0),
+                      self._clip('lands', 'Landscapes of the north')]
+        self.index = SearchIndex()
+        self.index.update(self.clips)
+
+    def uids(self, query, **kwargs):
+        return [clip.get_uid() for clip in self.index.search(query, **kwargs)[0]]
+
+    def test_search(self):
+        self.assertEqual(self.uids('donut'), ['donut'])
+        self.assertEqual(self.uids('MOVING Donut'), ['donut'])
+        self.assertEqual(self.uids('nothing'), [])
+        # Exact matches first, then prefixes, then one edit away.
+        self.assertEqual(self.uids('landscape'), ['flyover', 'lands'])
+        self.assertEqual(self.uids('lands'), ['lands', 'flyover'])
+        self.assertEqual(self.uids('land'), ['flyover', 'landmarks', 'lands'])
+        self.assertEqual(self.uids('landscpe'), ['flyover'])
+        self.assertEqual(self.index.search('land', offset=1, limit=1)[1], 3)
+        self.assertEqual(self.uids('land', offset=1, limit=1), ['landmarks'])
+
+    def test_fields_and_facets(self):
+        self.assertEqual(self.uids('uid:lands'), ['lands'])
+        self.assertEqual(self.uids('title:lands'), ['flyover', 'lands'])
+        self.assertEqual(self.uids('codec:hvc1'), ['landmarks'])
+        self.assertEqual(self.uids('land height:720'), ['flyover', 'landmarks', 'lands'])
+        self.assertEqual(self.uids('length:long land'), ['landmarks'])
+        facets = self.index.get_facets()
+        self.assertEqual(facets['codec'], [('avc1', 3), ('hvc1', 1)])
+        self.assertEqual(facets['height'], [('480', 1), ('720', 3)])
+
+        # Facets of a search describe its results.
+        facets = self.index.get_facets('land')
+        self.assertEqual(facets['codec'], [('avc1', 2), ('hvc1', 1)])
+        self.assertEqual(facets['height'], [('720', 3)])
+        self.assertEqual(self.index.get_facets('donut')['height'], [('480', 1)])
+        self.assertEqual(self.index.get_facets('nothing'), {})
+
+    def test_update(self):
+        added = self._clip('northern', 'Northern lights')
+        self.assertTrue(self.index.update(self.clips[1:] + [added]))
+        self.assertFalse(self.index.update(self.clips[1:] + [added]))
+        self.assertEqual(self.uids('north'), ['lands', 'northern'])
+        self.assertEqual(self.uids('flyover'), [])
+        self.assertEqual(self.index.get_size(), 4)
+
+        # Mostly removed, renumbered.
+        many = [self._clip('c%d' % i, 'Clip %d' % i) for i in range(3000)]
+        self.index.update(many)
+        self.index.update(many[:10])
+        self.assertEqual(self.index.search('clip')[1], 10)
+        self.assertEqual(len(self.index._docs), 10)
+        self.assertEqual(self.uids('clip 7'), ['c7'])
+
+if __name__ == '__main__':
+    unittest.main()
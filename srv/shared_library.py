@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2019 Erik Mossberg
+
+This file is part of SeriousBusiness.
+
+SeriousBusiness is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+SeriousBusiness is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+import json
+import os
+import shutil
+import struct
+import tempfile
+import threading
+
+from media_clip import MediaClip
+from media_library import LibraryReader, LibrarySnapshot, MediaLibrary
+from mp4_probe import Mp4Info
+from disk_cache import write_atomic
+import logs
+
+log = logs.get_logger('shared_library')
+
+SNAPSHOT_FORMAT = 2
+
+# Fingerprints are kept packed, a tuple of three ints is about three
+# times the size.
+_FINGERPRINT = struct.Struct('=qqq')
+
+
+def write_snapshot(library, path):
+    """
+    Write the current state of a library to a snapshot file, atomically
+    replacing the previous one.
+    """
+    snapshot = library.get_snapshot()
+    names = sorted(snapshot.get_content_names())
+    clips = []
+    for clip in snapshot.get_clips():
+        media_info = clip.get_media_info()
+        clips.append(list(clip.to_fields()) + [None if media_info is None else media_info.to_dict()])
+
+    data = {
+        'format': SNAPSHOT_FORMAT,
+        'directory_name': os.path.abspath(library.get_directory_name()),
+        'generation': snapshot.get_generation(),
+        'content_names': names,
+        'fingerprints': dict((name, library.get_fingerprint(name)) for name in names),
+        'content_hashes': dict((name, library.get_content_hash(name)) for name in names
+                               if library.get_content_hash(name) is not None),
+        'clips': clips,
+    }
+    write_atomic(path, json.dumps(data, separators=(',', ':')).encode('utf-8'))
+
+
+class SnapshotPublisher(object):
+
+    def __init__(self, path):
+        """
+        Writes snapshots of a library for SharedLibrary readers in other
+        processes, whenever its clips, servable files or their
+        fingerprints changed.
+        """
+        self._path = path
+        self._lock = threading.Lock()
+        self._published = None
+
+    def get_path(self):
+        return self._path
+
+    def publish(self, library):
+        """
+        Write a new snapshot if the library changed since the last one.
+        Returns whether one was written.
+        """
+        with self._lock:
+            snapshot = library.get_snapshot()
+            fingerprints = dict((name, library.get_fingerprint(name))
+                                for name in snapshot.get_content_names())
+            if self._published is not None and self._published[0] is snapshot and \
+                    self._published[1] == fingerprints:
+                return False
+            write_snapshot(library, self._path)
+            self._published = (snapshot, fingerprints)
+            return True
+
+
+class SharedLibrary(LibraryReader):
+
+    def __init__(self, snapshot_path, directory_name):
+        """
+        Read-only library loaded from a snapshot file that another
+        process publishes, e.g. the one scanning the library for a set
+        of worker processes.
+
+        The file is replaced atomically, so readers see one whole
+        snapshot or the next. rescan() picks up a newer one.
+        """
+        LibraryReader.__init__(self)
+        self._snapshot_path = snapshot_path
+        self._directory_name = directory_name
+        self._stamp = None
+        self._fingerprints = {}
+        self._content_hashes = {}
+        if not self._load():
+            raise IOError("No usable library snapshot at '%s'" % snapshot_path)
+
+    def _load(self):
+        try:
+            with open(self._snapshot_path, 'rb') as f:
+                st = os.fstat(f.fileno())
+                data = json.loads(f.read().decode('utf-8'))
+        except (OSError, ValueError) as ex:
+            log.warning("Failed to load library snapshot '%s': %s", self._snapshot_path, ex)
+            return False
+
+        if data.get('format') != SNAPSHOT_FORMAT or \
+                data.get('directory_name') != os.path.abspath(self._directory_name):
+            log.warning("Ignoring library snapshot '%s' written for another library.", self._snapshot_path)
+            return False
+
+        # One copy of every name, shared by the servable file set, the
+        # fingerprints and the clips.
+        strings = {}
+
+        def share(string):
+            return string if string is None else strings.setdefault(string, string)
+
+        # Unchanged clips are kept, like a rescan keeps them, so caches
+        # keyed on clips survive a reload.
+        previous = {}
+        if self._snapshot is not None:
+            previous = self._snapshot._by_filename
+
+        clips = []
+        for uid, filename, title, thumbnail, media_info in data['clips']:
+            if media_info is not None:
+                media_info = Mp4Info.from_dict(media_info)
+            fields = (uid, filename, title, thumbnail)
+            clip = previous.get(filename)
+            if clip is None or clip.to_fields() != fields or clip.get_media_info() != media_info:
+                clip = MediaClip.from_fields(tuple(share(field) for field in fields), media_info)
+            else:
+                for field in clip.to_fields():
+                    share(field)
+            clips.append(clip)
+
+        content_names = [share(name) for name in data['content_names']]
+        fingerprints = data['fingerprints']
+        fingerprints = dict((name, _FINGERPRINT.pack(*fingerprints[name])) for name in content_names
+                            if fingerprints.get(name))
+
+        self._stamp = (st.st_ino, st.st_size, st.st_mtime_ns)
+        self._fingerprints = fingerprints
+        self._content_hashes = dict((share(name), content_hash)
+                                    for name, content_hash in data['content_hashes'].items())
+        self._set_snapshot(LibrarySnapshot(clips, content_names, data['generation']))
+        return True
+
+    def get_fingerprint(self, name):
+        """
+        (inode, size, mtime_ns) of a servable file as of the snapshot,
+        or None.
+        """
+        packed = self._fingerprints.get(name)
+        if packed is None:
+            return None
+        return _FINGERPRINT.unpack(packed)
+
+    def get_content_hash(self, name):
+        """
+        Content hash of a servable media file as of the snapshot, or
+        None.
+        """
+        return self._content_hashes.get(name)
+
+    def rescan(self, dirty_dirs=None):
+        """
+        Load the published snapshot if it was replaced since the last
+        load. Returns True if the clip list changed.
+        """
+        try:
+            st = os.stat(self._snapshot_path)
+        except OSError:
+            return False
+        if (st.st_ino, st.st_size, st.st_mtime_ns) == self._stamp:
+            return False
+
+        generation = self._snapshot.get_generation()
+        return self._load() and self._snapshot.get_generation() != generation
+
+
+class TestSharedLibrary(unittest.TestCase):
+
+    def test_publish(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            media = os.path.join(tmpdir, 'media')
+            os.mkdir(media)
+            for name in ['landscape_clip.json', 'landscape_thumb.png', 'Simple landscape flyover.mp4']:
+                shutil.copy(os.path.join('../media', name), media)
+
+            library = MediaLibrary(media)
+            publisher = SnapshotPublisher(os.path.join(tmpdir, 'snapshot.json'))
+            self.assertTrue(publisher.publish(library))
+            self.assertFalse(publisher.publish(library))
+
+            shared = SharedLibrary(publisher.get_path(), media)
+            self.assertEqual([c.to_fields() for c in shared.get_clips()],
+                             [c.to_fields() for c in library.get_clips()])
+            clip = shared.get_clip_by_uid('landscape_clip')
+            self.assertEqual(clip.get_media_info(), library.get_clip_by_uid('landscape_clip').get_media_info())
+            self.assertEqual(shared.get_fingerprint('landscape_thumb.png'),
+                             library.get_fingerprint('landscape_thumb.png'))
+            self.assertEqual(shared.get_content_key('Simple landscape flyover.mp4'),
+                             library.get_content_key('Simple landscape flyover.mp4'))
+            self.assertEqual(shared.get_content_key('landscape_thumb.png'),
+                             library.get_content_key('landscape_thumb.png'))
+            self.assertEqual(shared.resolve_content('landscape_thumb.png'),
+                             library.resolve_content('landscape_thumb.png'))
+            self.assertFalse(shared.rescan())
+
+            shutil.copy('../media/Moving donut.mp4', media)
+            self.assertTrue(library.rescan())
+            self.assertTrue(publisher.publish(library))
+            kept = shared.get_clip_by_uid('landscape_clip')
+            self.assertTrue(shared.rescan())
+            self.assertEqual(shared.get_generation(), library.get_generation())
+            self.assertEqual(len(shared.get_clips()), 2)
+            self.assertIs(shared.get_clip_by_uid('landscape_clip'), kept)
+
+            self.assertRaises(IOError, SharedLibrary, publisher.get_path(), '../media')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -21,15 +21,45 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import os
+import sys
+import json
+import gzip
+import unittest
+import socket
+import time
+import html
 import base64
+import tempfile
+import concurrent.futures
+import wsgiref.util
 import pathlib
+import urllib.parse
 
 import argparse
 import cherrypy
-from cherrypy.lib import static as lib_static
+from cherrypy import _cprequest
+from cherrypy.lib import httputil
+from cherrypy.process.plugins import Monitor
 
 from media_clip import MediaClip
 from media_library import MediaLibrary
+from library_watcher import LibraryWatcher
+from shared_library import SharedLibrary, SnapshotPublisher
+from page_cache import PageCache, etag_matches, accepts_gzip
+from fd_cache import FileCache
+from bandwidth import BandwidthScheduler, RETRY_AFTER
+from readahead import PopularityTracker, Readahead
+from thumbnails import ThumbnailService, IMAGE_EXTENSIONS, derive_file
+from job_queue import JobQueue, JobForwarder, PRIORITY_VISIBLE, PRIORITY_BACKGROUND
+from faststart import FaststartCache, remux_faststart, needs_faststart, faststart_key
+from hls import HlsSegmenter
+import search_index
+from metrics import RequestMetrics, MetricsWriter, route_label
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+import media_stream
+import logs
+
+log = logs.get_logger('srv_main')
 
 def media_abs_location(args):
     media_location = args.media_location
@@ -39,15 +69,292 @@ def media_abs_location(args):
         media_location = os.path.abspath('media')
     return media_location
 
+# How often --workers processes check for a new library snapshot.
+SNAPSHOT_POLL_INTERVAL = 1.0
+
+PAGE_SIZE = 48
+MAX_PAGE_SIZE = 200
+
+# Derived thumbnails are addressed by content, so a versioned URL never
+# changes meaning.
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+class SeriousApi(object):
+
+    def __init__(self, server):
+        """
+        JSON endpoints, mounted under /api.
+        """
+        self._server = server
+
+    @cherrypy.expose
+    def clips(self, offset=0, limit=PAGE_SIZE, sort='library'):
+        """
+        One page of rendered tiles and clip metadata.
+        """
+        return self._server.serve_clip_feed(offset, limit, sort)
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def status(self):
+        """
+        Cache counters, for tuning.
+        """
+        return self._server.get_status()
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def jobs(self):
+        """
+        Background job queue depth and throughput.
+        """
+        return self._server.get_job_queue().get_stats()
+
+
 class SeriousServer(object):
 
-    def __init__(self, args):
+    def __init__(self, args, library=None, job_queue=None):
         """
         SeriousServer : A Super Basic Streaming Network Server
+
+        Scans the media location itself, unless given a library to
+        read from, e.g. a SharedLibrary in a --workers process. Only
+        the process scanning the library schedules background jobs.
+        Jobs run in a JobQueue of its own, unless given one, e.g. a
+        JobForwarder to the scanning process.
         """
+        self.api = SeriousApi(self)
+        self._request_metrics = RequestMetrics()
         self._tilecon_render_cache = {}
+        self._tilecon_generation = None
+        self._tilecon_hits = 0
+        self._tilecon_misses = 0
+        self._page_cache = PageCache()
+        self._file_cache = FileCache(max_files=args.fd_cache_size)
+        # Limits are for the whole server, --workers processes get a
+        # share each.
+        share = max(1, args.workers)
+        self._scheduler = BandwidthScheduler(max_rate=args.max_rate_mbit * 125000 / share,
+                                             stream_rate=args.stream_rate_mbit * 125000,
+                                             max_streams=-(-args.max_streams // share))
+        self._readahead = Readahead(window=args.readahead_mb * 1024 * 1024)
+        self._popularity = PopularityTracker()
+        self._popularity_state = args.popularity_state
+        if self._popularity_state is not None:
+            self._popularity.load(self._popularity_state)
+        self._warm_clips = args.warm_clips
+        self._warm_bytes = args.warm_mb * 1024 * 1024
         self._media_location = media_abs_location(args)
-        self._media_library = MediaLibrary(self._media_location)
+        # Cache directories are shared by --workers processes, each
+        # bounding the files of all.
+        shared = args.workers > 1
+        self._thumbnail_service = None
+        if args.thumbnail_cache is not None:
+            self._thumbnail_service = ThumbnailService(args.thumbnail_cache,
+                                                       max_bytes=args.thumbnail_cache_mb * 1024 * 1024,
+                                                       width=args.thumbnail_width, shared=shared)
+        self._scans_library = library is None
+        if library is None:
+            library = MediaLibrary(self._media_location,
+                                   catalog_path=args.catalog,
+                                   rebuild_catalog=args.rebuild_catalog,
+                                   discovery_workers=args.discovery_workers,
+                                   discovery_processes=args.discovery_processes,
+                                   hash_workers=args.hash_workers)
+        self._media_library = library
+
+        self._hls = None
+        if args.hls_cache is not None:
+            self._hls = HlsSegmenter(args.hls_cache, max_bytes=args.hls_cache_mb * 1024 * 1024,
+                                     target_duration=args.hls_segment_seconds, shared=shared)
+
+        self._faststart_cache = None
+        if args.faststart_cache is not None:
+            self._faststart_cache = FaststartCache(args.faststart_cache,
+                                                   max_bytes=args.faststart_cache_mb * 1024 * 1024,
+                                                   shared=shared)
+
+        if job_queue is None:
+            job_queue = JobQueue(workers=args.jobs, state_path=args.job_state)
+        self._job_queue = job_queue
+        if self._faststart_cache is not None:
+            self._job_queue.register('faststart', remux_faststart,
+                                     lambda key, created: created and self._faststart_cache.add(key))
+        if self._thumbnail_service is not None:
+            self._job_queue.register('thumbnail', derive_file,
+                                     lambda key, created: created and self._thumbnail_service.add_derived(key))
+        if self._scans_library:
+            self._schedule_jobs(self._media_library.get_clips(), PRIORITY_BACKGROUND)
+
+    def get_media_location(self):
+        return self._media_location
+
+    def get_media_library(self):
+        return self._media_library
+
+    def get_job_queue(self):
+        return self._job_queue
+
+    def get_request_metrics(self):
+        return self._request_metrics
+
+    def get_scheduler(self):
+        return self._scheduler
+
+    def get_readahead(self):
+        return self._readahead
+
+    def get_tile_stats(self):
+        return {'hits': self._tilecon_hits, 'misses': self._tilecon_misses,
+                'tiles': len(self._tilecon_render_cache)}
+
+    def get_status(self):
+        return {
+            'library_generation': self._media_library.get_generation(),
+            'clips': len(self._media_library.get_clips()),
+            'discovery': self._media_library.get_scan_stats(),
+            'page_cache': self._page_cache.get_stats(),
+            'tile_cache': self.get_tile_stats(),
+            'file_cache': self._file_cache.get_stats(),
+            'bandwidth': self._scheduler.get_stats(),
+            'readahead': dict(self._readahead.get_stats(), **self._popularity.get_stats()),
+            'thumbnails': self._thumbnail_service.get_stats() if self._thumbnail_service else None,
+            'jobs': self._job_queue.get_stats(),
+            'hls': self._hls.get_stats() if self._hls else None,
+            'faststart': self._faststart_cache.get_stats() if self._faststart_cache else None,
+        }
+
+    def render_metrics(self, engine_stats=None):
+        """
+        Request, cache, discovery and job counters in the Prometheus
+        text format. engine_stats are gauges of the serving HTTP engine.
+        """
+        writer = MetricsWriter()
+        self._request_metrics.write(writer)
+        self._scheduler.write(writer)
+        self._readahead.write(writer)
+        writer.add('sbsns_popularity_tracked_clips', 'gauge', 'Clips with request counts.',
+                   self._popularity.get_stats()['tracked'])
+
+        caches = [('page', self._page_cache.get_stats()),
+                  ('tile', self.get_tile_stats()),
+                  ('file', self._file_cache.get_stats())]
+        if self._thumbnail_service is not None:
+            caches.append(('thumbnail', self._thumbnail_service.get_stats()))
+        if self._hls is not None:
+            caches.append(('hls', self._hls.get_stats()))
+        if self._faststart_cache is not None:
+            caches.append(('faststart', self._faststart_cache.get_stats()))
+        for name, stats in caches:
+            labels = [('cache', name)]
+            hits = stats.pop('hits')
+            misses = stats.pop('misses')
+            writer.add('sbsns_cache_hits_total', 'counter', 'Cache hits.', hits, labels)
+            writer.add('sbsns_cache_misses_total', 'counter', 'Cache misses.', misses, labels)
+            writer.add('sbsns_cache_hit_ratio', 'gauge', 'Share of lookups that hit, since start.',
+                       hits / (hits + misses) if hits + misses else 0.0, labels)
+            writer.add_stats('sbsns_cache', 'Cache state', stats, labels)
+
+        writer.add('sbsns_library_clips', 'gauge', 'Clips in the library.',
+                   len(self._media_library.get_clips()))
+        writer.add('sbsns_library_generation', 'gauge', 'Library generation, bumped by every change.',
+                   self._media_library.get_generation())
+        scans = self._media_library.get_scan_stats()
+        if scans is not None:
+            writer.add('sbsns_discovery_scans_total', 'counter', 'Library scans.', scans['scans'])
+            for phase, seconds in sorted(scans['last'].items()):
+                writer.add('sbsns_discovery_last_seconds', 'gauge',
+                           'Time per discovery phase in the last scan.', seconds, [('phase', phase)])
+            for phase, seconds in sorted(scans['total'].items()):
+                writer.add('sbsns_discovery_seconds_total', 'counter',
+                           'Time per discovery phase, all scans.', seconds, [('phase', phase)])
+            writer.add('sbsns_library_duplicates', 'gauge',
+                       'Media files left out as copies of clips in the library.', scans['duplicates'])
+
+        writer.add_stats('sbsns_jobs', 'Background jobs', self._job_queue.get_stats())
+        if engine_stats:
+            writer.add_stats('sbsns_engine', 'HTTP engine', engine_stats)
+        return writer.render()
+
+    def rescan_library(self, dirty_dirs=None):
+        """
+        Pick up added, changed or removed media without a restart.
+        """
+        if self._media_library.rescan(dirty_dirs):
+            if self._scans_library:
+                self._schedule_jobs(self._media_library.get_clips(), PRIORITY_BACKGROUND)
+            self.warm_cache()
+
+    def warm_cache(self):
+        """
+        Queue the heads of the most requested clips, topped up in
+        library order, to be read into the page cache. Clips whose moov
+        is at the end get it warmed as well. Saves the request counts
+        with --popularity-state.
+        """
+        if self._popularity_state is not None:
+            self._popularity.save(self._popularity_state)
+        if self._warm_clips <= 0 or self._warm_bytes <= 0:
+            return
+
+        clips = []
+        for uid in self._popularity.top(self._warm_clips):
+            clip = self._media_library.get_clip_by_uid(uid)
+            if clip is not None:
+                clips.append(clip)
+        uids = set(clip.get_uid() for clip in clips)
+        for clip in self._media_library.get_clips():
+            if len(clips) >= self._warm_clips:
+                break
+            if clip.get_uid() not in uids:
+                clips.append(clip)
+
+        targets = []
+        for clip in clips:
+            fname = self._media_library.resolve_content(clip.get_filename())
+            if fname is None:
+                continue
+            path = self._served_path(fname, clip)
+            regions = [(0, self._warm_bytes)]
+            info = clip.get_media_info()
+            if path == fname and info is not None and info.moov_offset and info.moov_offset > self._warm_bytes:
+                regions.append((info.moov_offset, info.moov_size))
+            targets.append((path, regions))
+        log.debug("Warming %d clips.", len(targets))
+        self._readahead.warm(targets)
+
+    def stop_readahead(self):
+        self._readahead.stop()
+        if self._popularity_state is not None:
+            self._popularity.save(self._popularity_state)
+
+    def _schedule_jobs(self, clips, priority):
+        """
+        Queue preprocessing for clips that still need it: whose
+        thumbnail is not in the cache, and did not fail to derive
+        before. Clips a user is looking at are queued again with
+        PRIORITY_VISIBLE.
+        """
+        if self._thumbnail_service is None:
+            return
+        jobs = []
+        for clip in clips:
+            source, content_key = self._thumbnail_source(clip)
+            if content_key is None:
+                continue
+            args = self._thumbnail_service.get_derive_args(
+                os.path.join(self._media_location, source), content_key)
+            if args is None:
+                continue
+            key = self._thumbnail_service.get_key(content_key)
+            done, created = self._job_queue.get_result('thumbnail', key)
+            if done and not created:
+                continue
+            # Redone if done before, the thumbnail was evicted since.
+            jobs.append(('thumbnail', key, args, priority))
+        if jobs:
+            self._job_queue.submit_many(jobs, redo=True)
 
     def _header(self):
         """
@@ -74,52 +381,279 @@ class SeriousServer(object):
 
 
     @cherrypy.expose
-    def index(self):
+    def index(self, offset=0, sort='library'):
+        return self._serve_page(self.get_index_page(offset, sort))
+
+    def serve_clip_feed(self, offset, limit, sort):
+        return self._serve_page(self.get_clip_feed_page(offset, limit, sort))
+
+    # The get_*, locate_* and render_* methods below do not touch the
+    # CherryPy request, so other server backends can use them too.
+    # They raise cherrypy.HTTPError (or HTTPRedirect) for bad requests.
+
+    def get_index_page(self, offset=0, sort='library'):
+        offset, _ = self._parse_page_args(offset, PAGE_SIZE)
+        return self._get_cached(('index', offset, sort),
+                                lambda: self._render_index(offset, sort))
+
+    def get_search_page(self, q='', offset=0):
+        offset, _ = self._parse_page_args(offset, PAGE_SIZE)
+        return self._get_cached(('search', q, offset), lambda: self._render_search(q, offset))
+
+    def get_clip_feed_page(self, offset=0, limit=PAGE_SIZE, sort='library'):
+        offset, limit = self._parse_page_args(offset, limit)
+        return self._get_cached(('api_clips', offset, limit, sort),
+                                lambda: self._render_clip_feed(offset, limit, sort),
+                                'application/json')
+
+    def _parse_page_args(self, offset, limit):
+        try:
+            offset = int(offset)
+            limit = int(limit)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "offset and limit must be integers")
+        if offset < 0 or limit < 1:
+            raise cherrypy.HTTPError(400, "offset must be >= 0 and limit >= 1")
+        return offset, min(limit, MAX_PAGE_SIZE)
+
+    def _clip_page(self, offset, limit, sort):
+        try:
+            return self._media_library.get_clip_page(offset, limit, sort)
+        except KeyError:
+            raise cherrypy.HTTPError(400, "Unknown sort order '%s'" % sort)
+
+    def _get_cached(self, key, render, content_type='text/html;charset=utf-8'):
+        """
+        A page from the page cache, rendered on a miss.
+        """
+        return self._page_cache.get(self._media_library.get_generation(), key,
+                                    render, content_type)
+
+    def _serve_page(self, page):
+        """
+        Serve a RenderedPage, honouring If-None-Match and gzip.
+        """
+        request = cherrypy.request
+        response = cherrypy.response
+        gzipped = accepts_gzip(request.headers.get('Accept-Encoding'))
+        etag = page.get_etag(gzipped)
+        response.headers['ETag'] = etag
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Content-Type'] = page.get_content_type()
+
+        if etag_matches(request.headers.get('If-None-Match'), etag):
+            response.status = 304
+            return b''
+
+        if gzipped:
+            response.headers['Content-Encoding'] = 'gzip'
+        return page.get_body(gzipped)
+
+    def _render_index(self, offset, sort):
+        """
+        First page of tiles, later pages are fetched from /api/clips
+        on scroll. Without javascript, a link leads to the next page.
+        """
+        clips, total = self._clip_page(offset, PAGE_SIZE, sort)
+        self._schedule_jobs(clips, PRIORITY_VISIBLE)
+
         segments = [self._header()]
         segments.append('<body>')
         segments.append('<h3>Super Basic Streaming Network Server</h3>')
-        fnames = self._media_library.get_clip_filenames()
+        segments.append(self._search_form())
+        segments.append("<div id='tilecons'>")
 
-        for clip in self._media_library.get_clips():
-            segments += self._render_tilecon(clip)
+        for clip in clips:
+            segments.append(self._render_tilecon(clip))
+
+        segments.append('</div>')
+        next_offset = offset + len(clips)
+        if next_offset < total:
+            segments.append("<div id='tilecon_more' data-offset='%d' data-limit='%d' data-sort='%s'>"
+                            % (next_offset, PAGE_SIZE, sort))
+            segments.append("<a href='./?offset=%d&amp;sort=%s'>More</a></div>" % (next_offset, sort))
+            segments.append("<script src='./static/sbsns.js'></script>")
 
         segments.append('</body>')
         return "\n".join(segments)
 
+    def _search_form(self, q=''):
+        return ("<form id='search' action='./search'><input type='search' name='q' value='%s' />"
+                "<input type='submit' value='Search' /></form>" % html.escape(q))
+
+    def _search_link(self, q, offset=0):
+        link = './search?q=%s' % urllib.parse.quote_plus(q)
+        if offset:
+            link += '&amp;offset=%d' % offset
+        return link
+
+    def _render_search(self, q, offset):
+        """
+        Tiles of the clips matching a query, best matches first, and
+        the facets of the library to narrow it down with.
+        """
+        clips, total = self._media_library.search(q, offset, PAGE_SIZE)
+        self._schedule_jobs(clips, PRIORITY_VISIBLE)
+
+        segments = [self._header()]
+        segments.append('<body>')
+        segments.append('<h3>Super Basic Streaming Network Server</h3>')
+        segments.append(self._search_form(q))
+
+        segments.append("<div id='facets'>")
+        for name, values in sorted(self._media_library.get_search_facets(q).items()):
+            links = ["<a href='%s'>%s</a> (%d)" % (self._search_link(('%s %s:%s' % (q, name, value)).strip()),
+                                                  html.escape(value), count)
+                     for value, count in values]
+            segments.append("<span class='facet'>%s: %s</span>" % (html.escape(name), ', '.join(links)))
+        segments.append('</div>')
+
+        if q.strip():
+            segments.append("<p class='search_total'>%d%s matches</p>" % (
+                total, '+' if total >= search_index.MAX_MATCHES else ''))
+        segments.append("<div id='tilecons'>")
+        for clip in clips:
+            segments.append(self._render_tilecon(clip))
+        segments.append('</div>')
+
+        next_offset = offset + len(clips)
+        if next_offset < total:
+            segments.append("<a href='%s'>More</a>" % self._search_link(q, next_offset))
+        segments.append('</body>')
+        return "\n".join(segments)
+
+    def _render_clip_feed(self, offset, limit, sort):
+        """
+        JSON for one page of the library, tiles pre-rendered.
+        """
+        clips, total = self._clip_page(offset, limit, sort)
+        self._schedule_jobs(clips, PRIORITY_VISIBLE)
+        next_offset = offset + len(clips)
+        feed = {
+            'offset': offset,
+            'limit': limit,
+            'sort': sort,
+            'total': total,
+            'next_offset': next_offset if next_offset < total else None,
+            'clips': [{'uid': clip.get_uid(),
+                       'title': clip.get_title(),
+                       'filename': clip.get_filename(),
+                       'thumbnail': self._thumbnail_url(clip),
+                       'duration': clip.get_duration(),
+                       'tile': self._render_tilecon(clip)} for clip in clips],
+        }
+        return json.dumps(feed)
+
     def _render_tilecon(self, clip):
         """
         Render a tile/icon to html.
+
+        Tiles are cached per clip object, as one string. Rescans keep unchanged clips,
+        so their tiles survive, while entries for clips no longer in
+        the library are dropped.
         """
+        generation = self._media_library.get_generation()
+        if generation != self._tilecon_generation:
+            current = set(id(c) for c in self._media_library.get_clips())
+            self._tilecon_render_cache = dict(
+                (uid, cached) for uid, cached in self._tilecon_render_cache.items()
+                if id(cached[0]) in current)
+            self._tilecon_generation = generation
 
-        if clip.get_uid() in self._tilecon_render_cache:
-            return self._tilecon_render_cache[clip.get_uid()]
+        urls = (self._thumbnail_url(clip), self._content_url(clip.get_filename()))
+        cached = self._tilecon_render_cache.get(clip.get_uid())
+        if cached is not None and cached[0] is clip and cached[1] == urls:
+            self._tilecon_hits += 1
+            return cached[2]
+        self._tilecon_misses += 1
 
-        fname = clip.get_filename()
+        thumbnail_url, content_url = urls
         toreturn = ["<div class='tilecon'>"]
-        b64key = base64.b64encode(fname.encode('ascii')).decode('ascii')
-
-        toreturn.append("<a href='./serve_content?fkey=%s'>" % b64key)
-        toreturn.append("<img class='tilecon_thumb' src='./%s' /></a>" % clip.get_thumbnail_page())
+        toreturn.append("<a href='./%s'>" % content_url.replace('&', '&amp;'))
+        toreturn.append("<img class='tilecon_thumb' src='./%s' /></a>" % thumbnail_url.replace('&', '&amp;'))
         toreturn.append("<br /><a href='./fronter?clip_uid=%s' class='tilecon_title'>" % clip.get_uid())
         toreturn.append("%s</a></div>" % (clip.get_title()))
 
-        self._tilecon_render_cache[clip.get_uid()] = toreturn
+        toreturn = "\n".join(toreturn)
+        self._tilecon_render_cache[clip.get_uid()] = (clip, urls, toreturn)
         return toreturn
 
+    def _thumbnail_url(self, clip):
+        """
+        Tile-sized thumbnail for a clip, versioned by the source file.
+        Without a thumbnail cache, the source image itself.
+        """
+        if self._thumbnail_service is None:
+            return clip.get_thumbnail_page()
+
+        source, content_key = self._thumbnail_source(clip)
+        if content_key is None:
+            return clip.get_thumbnail_page()
+
+        b64key = base64.b64encode(source.encode('ascii')).decode('ascii')
+        return "thumbnail?fkey=%s&v=%s" % (urllib.parse.quote(b64key, safe=''),
+                                            self._thumbnail_service.get_key(content_key))
+
+    def _thumbnail_source(self, clip):
+        """
+        (file name, content key) a clip's thumbnail is derived from,
+        the key None if there is nothing to derive it from.
+        """
+        # Clips without an image get a poster frame from the video.
+        source = clip.get_thumbnail_filename()
+        if source is None and self._thumbnail_service.can_derive(clip.get_filename()):
+            source = clip.get_filename()
+        content_key = self._media_library.get_content_key(source) if source else None
+        return source, content_key
 
     @cherrypy.expose
-    def serve_content(self, fkey):
+    def thumbnail(self, fkey, v=None):
         """
-        Serves raw files. Allows b64-encoded filenames.
+        Serves a tile-sized thumbnail for an image or clip, queueing it
+        on first request. Versioned requests may be cached forever.
         """
-        clearkey = None
-        try:
-            clearkey = base64.b64decode(fkey.encode('ascii')).decode('ascii')
-            print("Clearkey is now '%s'" % clearkey)
-        except Exception as ex:
-            print("Key %s not b64-decodable." % fkey)
+        return self._serve_located(self.locate_thumbnail(fkey, v))
+
+    def locate_thumbnail(self, fkey, v=None):
+        """
+        (path, Cache-Control) of a thumbnail. One not derived yet is
+        queued, and the placeholder served meanwhile.
+        """
+        fname = self._media_library.resolve_content(fkey)
+        if fname is None or self._thumbnail_service is None:
+            raise cherrypy.NotFound()
+
+        content_key = self._media_library.get_content_key(os.path.basename(fname))
+        if content_key is None:
+            raise cherrypy.NotFound()
 
+        key = self._thumbnail_service.get_key(content_key)
+        derived = self._thumbnail_service.find(content_key)
+        if derived is None and os.path.splitext(fname)[1].lower() in IMAGE_EXTENSIONS \
+                and not self._thumbnail_service.resizes_images():
+            # No Pillow, the source image is the thumbnail.
+            derived = fname
+        if derived is not None:
+            return derived, self._cache_control(v == key)
 
+        # Derivation can take seconds (ffmpeg), it is not done in the
+        # request. Failed ones are not retried on every request.
+        done, created = self._job_queue.get_result('thumbnail', key)
+        if not done or created:
+            args = self._thumbnail_service.get_derive_args(fname, content_key)
+            if args is not None:
+                self._job_queue.submit('thumbnail', key, args, PRIORITY_VISIBLE, redo=True)
+        # Not to be cached, the thumbnail is on its way.
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        raise cherrypy.HTTPRedirect('./static/missing_media.jpg')
+
+
+    @cherrypy.expose
+    def serve_content(self, fkey, v=None):
+        """
+        Serves raw files. Allows b64-encoded filenames. With v, the
+        faststart copy of that version.
+        """
         #return serve_file(media[fkey], "application/x-download", "attachment")
 
 
@@ -127,37 +661,256 @@ class SeriousServer(object):
         # whilelist, only containing content in
         # the media directory. Basic protection
         # against directory traversal.
-        fname_whitelist = os.listdir(self._media_location)
-
-        if fkey in fname_whitelist:
-            fname = os.path.join(self._media_location, fkey)
-            fname = os.path.abspath(fname)
-            print("Statically serving '%s" % fname)
-            return lib_static.serve_file(fname)
+        fname = self.locate_content(fkey, v)
 
-        elif clearkey is not None and clearkey in fname_whitelist:
-            fname = os.path.join(self._media_location, clearkey)
-            fname = os.path.abspath(fname)
-            print("Statically serving '%s" % fname)
-            return lib_static.serve_file(fname)
+        if fname is not None:
+            log.debug("Statically serving '%s'", fname)
+            return self._stream_file(fname, media=True)
 
         else:
             cherrypy.response.headers['Content-Type'] = 'text/plain'
             cherrypy.response.status=404
             return "No such fkey"
 
+    def locate_content(self, fkey, v=None):
+        """
+        Path to serve for a serve_content fkey, or None. Without v that
+        is always the file itself, with v its faststart copy. A copy
+        that is gone is redirected to the file.
+        """
+        fname, clip = self._resolve_fkey(fkey)
+        if fname is None:
+            return None
+        if clip is not None:
+            self._popularity.record(clip.get_uid())
+
+        content_key = self._faststart_source(fname)
+        if v is None:
+            if content_key is not None and not self._faststart_cache.contains(content_key):
+                self._job_queue.submit('faststart', self._faststart_cache.get_name(content_key),
+                                       [fname, self._faststart_cache.get_path(content_key)],
+                                       PRIORITY_VISIBLE, redo=True)
+            return fname
+
+        copy = None
+        if content_key is not None and v == faststart_key(content_key):
+            copy = self._faststart_cache.find(content_key)
+        if copy is None:
+            cherrypy.response.headers['Cache-Control'] = 'no-cache'
+            raise cherrypy.HTTPRedirect('./serve_content?fkey=%s' % urllib.parse.quote(fkey, safe=''))
+        return copy
+
+    def _resolve_fkey(self, fkey):
+        """
+        (path, clip) for an fkey, clip None for files that are no clip
+        and path None for fkeys naming nothing servable. Clips are
+        found by their fkey, other files by their name.
+        """
+        clip = self._media_library.get_clip_by_fkey(fkey)
+        if clip is None:
+            return self._media_library.resolve_content(fkey), None
+        return self._media_library.resolve_content(clip.get_filename()), clip
+
+    def _content_url(self, fname):
+        """
+        serve_content URL of a media file, naming its faststart copy
+        once there is one. Players send Range requests without
+        If-Range, so one URL always serves the same bytes.
+        """
+        b64key = base64.b64encode(fname.encode('ascii')).decode('ascii')
+        url = 'serve_content?fkey=%s' % urllib.parse.quote(b64key, safe='')
+        content_key = self._faststart_source(fname)
+        if content_key is not None and self._faststart_cache.contains(content_key):
+            url += '&v=%s' % faststart_key(content_key)
+        return url
+
+    def open_file(self, fname):
+        """
+        Acquired CachedFile for fname, release() it when done.
+        """
+        return self._file_cache.open(fname, self._media_library.get_generation())
+
+    def _served_path(self, fname, clip):
+        """
+        Path served for a clip, its faststart copy if there is one.
+        """
+        if self._faststart_cache is None or not needs_faststart(clip.get_media_info()):
+            return fname
+        content_key = self._media_library.get_content_key(os.path.basename(fname))
+        if content_key is None:
+            return fname
+        return self._faststart_cache.find(content_key) or fname
+
+    def _faststart_source(self, fname):
+        """
+        Content key of a clip whose moov is at the end, to make a
+        faststart copy of, or None.
+        """
+        if self._faststart_cache is None:
+            return None
+        name = os.path.basename(fname)
+        clip = self._media_library.get_clip_by_filename(name)
+        if clip is None or not needs_faststart(clip.get_media_info()):
+            return None
+        return self._media_library.get_content_key(name)
+
+    def _stream_file(self, fname, media=False):
+        """
+        Stream a file with Range support. Under the sendfile gateway the
+        file data never passes through Python. Bodies are admitted and
+        paced by the bandwidth scheduler, 503 once its budget is spent.
+        Media bodies get readahead past the ranges sent.
+        """
+        request = cherrypy.request
+        response = cherrypy.response
+        try:
+            cached = self.open_file(fname)
+        except OSError:
+            raise cherrypy.NotFound()
+
+        try:
+            status, headers, body = media_stream.prepare_file_response(
+                cached.fileobj, cached.st, fname, request.headers.get, request.method)
+        except Exception:
+            cached.release()
+            raise
+
+        transfer = None
+        if request.method != 'HEAD' and body:
+            transfer = self._scheduler.admit(status, int(dict(headers)['Content-Length']))
+            if transfer is None:
+                cached.release()
+                response.status = 503
+                response.headers['Retry-After'] = str(RETRY_AFTER)
+                response.headers['Content-Type'] = 'text/plain'
+                return b'Too many streams, retry later'
+
+        response.status = status
+        for name, value in headers:
+            response.headers[name] = value
+
+        # Streamed also without a body, so the Content-Length set
+        # above is kept, e.g. for HEAD.
+        response.stream = True
+        if transfer is None:
+            cached.release()
+            return b''
+
+        if media:
+            self._readahead.start_stream(fname, cached.fileobj, body)
+        sendfile = request.wsgi_environ.get('sbsns.sendfile', False)
+        return media_stream.iter_body(body, cached.release, sendfile, transfer)
+
+    def _hls_source(self, fkey):
+        """
+        (path, content key, plan) of a clip to stream as HLS, raises
+        NotFound if it cannot be.
+        """
+        fname, _ = self._resolve_fkey(fkey)
+        if fname is None or self._hls is None or not fname.lower().endswith('.mp4'):
+            raise cherrypy.NotFound()
+        content_key = self._media_library.get_content_key(os.path.basename(fname))
+        if content_key is None:
+            raise cherrypy.NotFound()
+        plan = self._hls.get_plan(fname, content_key)
+        if plan is None:
+            raise cherrypy.NotFound()
+        return fname, content_key, plan
+
+    @cherrypy.expose
+    def hls(self, fkey):
+        """
+        HLS playlist of fMP4 segments for a clip, cut from the MP4
+        without transcoding.
+        """
+        page = self.get_hls_playlist(fkey)
+        cherrypy.response.headers['Cache-Control'] = self._cache_control(False)
+        return self._serve_page(page)
+
+    @cherrypy.expose
+    def hls_init(self, fkey, v=None):
+        return self._serve_located(self.locate_hls_init(fkey, v))
+
+    @cherrypy.expose
+    def hls_segment(self, fkey, n, v=None):
+        return self._serve_located(self.locate_hls_segment(fkey, n, v))
+
+    def get_hls_playlist(self, fkey):
+        _, content_key, plan = self._hls_source(fkey)
+        version = self._hls.get_key(content_key)
+
+        # b64 keys may hold '+', which a query string decodes as ' '.
+        quoted = urllib.parse.quote(fkey, safe='')
+
+        def render():
+            return self._hls.render_playlist(
+                plan, 'hls_init?fkey=%s&v=%s' % (quoted, version),
+                lambda n: 'hls_segment?fkey=%s&n=%d&v=%s' % (quoted, n, version))
+        return self._get_cached(('hls', fkey, version), render, 'application/vnd.apple.mpegurl')
+
+    def locate_hls_init(self, fkey, v=None):
+        _, content_key, plan = self._hls_source(fkey)
+        path = self._hls.get_init_segment(plan, content_key)
+        if path is None:
+            raise cherrypy.NotFound()
+        return path, self._cache_control(v == self._hls.get_key(content_key))
+
+    def locate_hls_segment(self, fkey, n, v=None):
+        _, content_key, plan = self._hls_source(fkey)
+        try:
+            n = int(n)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "n must be an integer")
+        path = self._hls.get_segment(plan, content_key, n)
+        if path is None:
+            raise cherrypy.NotFound()
+        return path, self._cache_control(v == self._hls.get_key(content_key))
+
+    @staticmethod
+    def _cache_control(versioned):
+        """
+        Derived files requested with their current version can be
+        cached forever.
+        """
+        if versioned:
+            return 'public, max-age=%d, immutable' % IMMUTABLE_MAX_AGE
+        return 'public, max-age=60'
+
+    def _serve_located(self, located):
+        path, cache_control = located
+        cherrypy.response.headers['Cache-Control'] = cache_control
+        return self._stream_file(path)
+
+    @cherrypy.expose
+    def search(self, q='', offset=0):
+        """
+        Clips matching a query, e.g. 'landscape codec:avc1'.
+        """
+        return self._serve_page(self.get_search_page(q, offset))
+
+    @cherrypy.expose
+    def metrics(self):
+        """
+        Counters for Prometheus to scrape.
+        """
+        cherrypy.response.headers['Content-Type'] = METRICS_CONTENT_TYPE
+        return self.render_metrics()
+
     @cherrypy.expose
     def fronter(self, clip_uid):
         """
         Return full page for a given fkey.
         """
+        return self.render_fronter(clip_uid)
+
+    def render_fronter(self, clip_uid):
         segments = [self._header()]
         segments.append('<body>')
         segments.append('<h3>Super Basic Streaming Network Server</h3><div class="fronted_clip"><p>')
 
         template = """<video id='my-video' class='video-js' controls preload='auto' width='640' height='264'
             poster='THUMBNAIL_IMAGE' data-setup='{}'>
-            <source src='./serve_content?fkey=MP4_B64KEY' type='video/mp4'>
+            HLS_SOURCE<source src='./CONTENT_URL' type='video/mp4'>
             <!-- <source src='void.webm' type='video/webm'> -->
             <p class='vjs-no-js'>
             To view this video please enable JavaScript, and consider upgrading to a web browser that supports HTML5 video.
@@ -171,15 +924,21 @@ class SeriousServer(object):
         thumbnail_image = clip_uid
         mp4_filename = clip_uid
         mp4_b64key = clip_uid
+        content_url = 'serve_content?fkey=%s' % urllib.parse.quote(clip_uid, safe='')
+        hls_source = ''
 
-        clips = self._media_library.get_clips()
-        for clip in clips:
-            if clip.get_uid() == clip_uid:
-                thumbnail_image = clip.get_thumbnail_page()
-                mp4_filename = clip.get_filename()
-                mp4_b64key = base64.b64encode(mp4_filename.encode('ascii')).decode('ascii')
+        clip = self._media_library.get_clip_by_uid(clip_uid)
+        if clip is not None:
+            thumbnail_image = self._thumbnail_url(clip)
+            mp4_filename = clip.get_filename()
+            mp4_b64key = base64.b64encode(mp4_filename.encode('ascii')).decode('ascii')
+            content_url = self._content_url(mp4_filename).replace('&', '&amp;')
+            media_info = clip.get_media_info()
+            if self._hls is not None and media_info is not None and not media_info.fragmented:
+                hls_source = "<source src='./hls?fkey=%s' type='application/x-mpegURL'>\n            " % \
+                    urllib.parse.quote(mp4_b64key, safe='')
 
-        render = template.replace('THUMBNAIL_IMAGE', thumbnail_image).replace('MP4_B64KEY', mp4_b64key)
+        render = template.replace('THUMBNAIL_IMAGE', thumbnail_image).replace('CONTENT_URL', content_url).replace('HLS_SOURCE', hls_source)
         segments += [render]
         segments += [self._footer()]
         return "\n".join(segments)
@@ -193,7 +952,276 @@ class Static:
     def index(self):
         return """Index."""
 
-if __name__ == '__main__':
+
+class MetricsTool(cherrypy.Tool):
+
+    def __init__(self):
+        """
+        Records CherryPy requests in a RequestMetrics, given as the
+        tool's metrics argument: latency until the handler is done,
+        status and declared body size.
+        """
+        cherrypy.Tool.__init__(self, 'on_start_resource', self._start)
+
+    def _setup(self):
+        cherrypy.Tool._setup(self)
+        conf = self._merged_args()
+        conf.pop('priority', None)
+        hooks = cherrypy.serving.request.hooks
+        hooks.attach('before_finalize', self._handled, priority=90)
+        hooks.attach('on_end_request', self._finish, **conf)
+
+    @staticmethod
+    def _start(metrics):
+        cherrypy.serving.request.sbsns_started = time.perf_counter()
+
+    @staticmethod
+    def _handled():
+        cherrypy.serving.request.sbsns_handled = time.perf_counter()
+
+    @staticmethod
+    def _finish(metrics):
+        request = cherrypy.serving.request
+        response = cherrypy.serving.response
+        started = getattr(request, 'sbsns_started', None)
+        if started is None:
+            return
+        # Errors skip before_finalize.
+        handled = getattr(request, 'sbsns_handled', time.perf_counter())
+        nbytes = 0
+        if request.method != 'HEAD':
+            try:
+                nbytes = int(response.headers.get('Content-Length', 0))
+            except ValueError:
+                pass
+        metrics.observe(route_label(request.script_name + request.path_info), handled - started,
+                        int(str(response.status).split()[0]), nbytes)
+
+cherrypy.tools.sbsns_metrics = MetricsTool()
+
+
+def run_faststart(args):
+    """
+    Offline pass writing faststart copies of every clip that needs one,
+    and removing copies of media files that changed or are gone.
+    """
+
+    library = MediaLibrary(media_abs_location(args), catalog_path=args.catalog,
+                           hash_workers=args.hash_workers)
+    cache = FaststartCache(args.faststart_cache, max_bytes=args.faststart_cache_mb * 1024 * 1024)
+
+    todo = []
+    keep = []
+    for clip in library.get_clips():
+        content_key = library.get_content_key(clip.get_filename())
+        if content_key is None or not needs_faststart(clip.get_media_info()):
+            continue
+        keep.append(content_key)
+        if cache.find(content_key) is None:
+            source = os.path.join(media_abs_location(args), clip.get_filename())
+            todo.append((source, cache.get_path(content_key)))
+
+    log.info("%d clips need a faststart copy, %d already have one.", len(todo), len(keep) - len(todo))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        futures = dict((pool.submit(remux_faststart, source, out), (source, out)) for source, out in todo)
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                if future.result():
+                    cache.add(os.path.basename(futures[future][1]))
+                log.info("Wrote faststart copy of '%s'", futures[future][0])
+            except Exception as ex:
+                log.warning("Failed to remux '%s': %s", futures[future][0], ex)
+
+    removed = cache.prune(keep)
+    if removed:
+        log.info("Removed %d stale faststart copies.", removed)
+
+def serve(server, args, reuse_port=False):
+    """
+    Serve HTTP with the engine chosen in args until interrupted.
+    """
+    if args.engine == 'asyncio':
+        run_asyncio(server, args, reuse_port)
+        return
+
+    conf_metrics = {
+        'tools.sbsns_metrics.on': True,
+        'tools.sbsns_metrics.metrics': server.get_request_metrics(),
+    }
+
+    conf_static = {
+        '/': dict(conf_metrics, **{
+                'tools.staticdir.on': True,
+                'tools.staticdir.dir': PATH,
+            }),
+    }
+
+    conf_global = {'server.socket_port': args.port,
+                   'server.socket_host': '0.0.0.0' }
+    cherrypy.config.update(conf_global)
+    if reuse_port:
+        cherrypy.server.unsubscribe()
+        media_stream.SharedPortServer(cherrypy.engine,
+                                      media_stream.SendfileWSGIServer(cherrypy.server),
+                                      cherrypy.server.bind_addr).subscribe()
+    else:
+        cherrypy.server.httpserver = media_stream.SendfileWSGIServer(cherrypy.server)
+
+    cherrypy.tree.mount(server, '/', {'/': conf_metrics})
+    cherrypy.tree.mount(Static(), '/static', conf_static)
+
+    if args.rescan_interval > 0:
+        Monitor(cherrypy.engine, server.rescan_library,
+                frequency=args.rescan_interval, name='LibraryRescan').subscribe()
+    if args.warm_interval > 0:
+        Monitor(cherrypy.engine, server.warm_cache,
+                frequency=args.warm_interval, name='CacheWarming').subscribe()
+
+    cherrypy.engine.subscribe('start', server.get_job_queue().start)
+    cherrypy.engine.subscribe('stop', server.get_job_queue().stop)
+    cherrypy.engine.subscribe('start', server.warm_cache)
+    cherrypy.engine.subscribe('stop', server.stop_readahead)
+
+    if args.watch:
+        watcher = LibraryWatcher(server.get_media_location(), server.rescan_library,
+                                 debounce=args.watch_debounce)
+        cherrypy.engine.subscribe('start', watcher.start)
+        cherrypy.engine.subscribe('stop', watcher.stop)
+
+    cherrypy.engine.start()
+    cherrypy.engine.block()
+
+
+def run_asyncio(server, args, reuse_port=False):
+    """
+    Serve with the asyncio backend until interrupted.
+    """
+    import asyncio
+    from async_server import AsyncMediaServer
+
+    watcher = None
+    if args.watch:
+        watcher = LibraryWatcher(server.get_media_location(), server.rescan_library,
+                                 debounce=args.watch_debounce)
+
+    async def run_periodically(interval, func):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            await loop.run_in_executor(None, func)
+
+    async def serve():
+        app = AsyncMediaServer(server, PATH, '0.0.0.0', args.port, reuse_port=reuse_port)
+        await app.start()
+        log.info("Serving on port %d with the asyncio engine", args.port)
+        if args.rescan_interval > 0:
+            asyncio.ensure_future(run_periodically(args.rescan_interval, server.rescan_library))
+        if args.warm_interval > 0:
+            asyncio.ensure_future(run_periodically(args.warm_interval, server.warm_cache))
+        await app.serve_forever()
+
+    server.get_job_queue().start()
+    server.warm_cache()
+    if watcher is not None:
+        watcher.start()
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if watcher is not None:
+            watcher.stop()
+        server.stop_readahead()
+        server.get_job_queue().stop()
+
+
+def run_worker(args, snapshot_path, jobs):
+    """
+    Entry point of a --workers process. Serves the library snapshot
+    published by the parent, polling it for updates. Jobs its requests
+    queue are put on jobs, and run by the parent.
+    """
+    args = argparse.Namespace(**vars(args))
+    args.rescan_interval = SNAPSHOT_POLL_INTERVAL
+    args.watch = False
+    logs.configure(args.log_level)
+    cherrypy.config.update({'engine.autoreload.on': False})
+    library = SharedLibrary(snapshot_path, media_abs_location(args))
+    serve(SeriousServer(args, library, JobForwarder(jobs, args.job_state)), args, reuse_port=True)
+
+
+def run_workers(args):
+    """
+    Prefork mode. This process scans the library and runs background
+    jobs, also the ones worker requests queue, args.workers processes
+    serve HTTP on the same port with SO_REUSEPORT. Workers read the
+    library from a snapshot file, republished atomically after every
+    rescan that changed it, and job results from the job state.
+    """
+    import multiprocessing
+    import shutil
+    import signal
+
+    snapshot_dir = tempfile.mkdtemp(prefix='sbsns-')
+    if args.job_state is None:
+        args = argparse.Namespace(**vars(args))
+        args.job_state = os.path.join(snapshot_dir, 'jobs.db')
+    server = SeriousServer(args)
+    publisher = SnapshotPublisher(os.path.join(snapshot_dir, 'library.json'))
+    publisher.publish(server.get_media_library())
+
+    def rescan(dirty_dirs=None):
+        server.rescan_library(dirty_dirs)
+        publisher.publish(server.get_media_library())
+
+    # Spawn, not fork, so workers can be restarted once this process
+    # runs threads.
+    context = multiprocessing.get_context('spawn')
+    jobs = context.Queue()
+    server.get_job_queue().listen(jobs)
+
+    def spawn(number):
+        worker = context.Process(target=run_worker, args=(args, publisher.get_path(), jobs),
+                                 name='Worker-%d' % number, daemon=True)
+        worker.start()
+        return worker
+
+    workers = [spawn(number) for number in range(args.workers)]
+    log.info("Started %d workers on port %d", len(workers), args.port)
+
+    watcher = None
+    if args.watch:
+        watcher = LibraryWatcher(server.get_media_location(), rescan, debounce=args.watch_debounce)
+        watcher.start()
+    server.get_job_queue().start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        next_scan = time.monotonic() + args.rescan_interval
+        while True:
+            time.sleep(1.0)
+            for number, worker in enumerate(workers):
+                if not worker.is_alive():
+                    log.warning("Worker %d exited with %s, restarting.", number, worker.exitcode)
+                    workers[number] = spawn(number)
+            if args.rescan_interval > 0 and time.monotonic() >= next_scan:
+                rescan()
+                next_scan = time.monotonic() + args.rescan_interval
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+        if watcher is not None:
+            watcher.stop()
+        jobs.put(None)
+        server.get_job_queue().stop()
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+
+
+def build_parser():
     parser = argparse.ArgumentParser(description='Serious Business simple media server.')
     parser.add_argument('-m', '--media-location',
                         help='Path to media content.')
@@ -201,26 +1229,246 @@ if __name__ == '__main__':
                         help='Path to static assets.')
     parser.add_argument('-p', '--port', type=int, default=8080,
                         help='Port.')
+    parser.add_argument('--engine', choices=('cherrypy', 'asyncio'), default='cherrypy',
+                        help='HTTP server backend. asyncio scales to many concurrent streams.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Server processes sharing the port, each using a core.')
+    parser.add_argument('-r', '--rescan-interval', type=float, default=0,
+                        help='Seconds between incremental library rescans, 0 to disable.')
+    parser.add_argument('-c', '--catalog',
+                        help='Path to a library catalog file, for fast restarts.')
+    parser.add_argument('--rebuild-catalog', action='store_true',
+                        help='Ignore and rewrite the catalog at startup.')
+    parser.add_argument('--discovery-workers', type=int, default=1,
+                        help='Parallel workers for reading sidecar json files.')
+    parser.add_argument('--discovery-processes', action='store_true',
+                        help='Parse sidecar json in worker processes instead of threads.')
+    parser.add_argument('--hash-workers', type=int, default=4,
+                        help='Parallel workers for hashing new or changed media files.')
+    parser.add_argument('--fd-cache-size', type=int, default=128,
+                        help='Media files kept open between requests, 0 to disable.')
+    parser.add_argument('--max-rate-mbit', type=float, default=0,
+                        help='Bound on the rate of all media transfers together, in Mbit/s, 0 for none.')
+    parser.add_argument('--stream-rate-mbit', type=float, default=0,
+                        help='Bound on the rate of each media transfer, in Mbit/s, 0 for none.')
+    parser.add_argument('--max-streams', type=int, default=0,
+                        help='Concurrent media transfers, more are refused with 503. 0 for no limit.')
+    parser.add_argument('--readahead-mb', type=int, default=8,
+                        help='MiB read ahead past each media range served, 0 to disable.')
+    parser.add_argument('--warm-clips', type=int, default=16,
+                        help='Most requested clips read into the page cache at start and after rescans.')
+    parser.add_argument('--warm-mb', type=int, default=4,
+                        help='MiB read from the head of each warmed clip.')
+    parser.add_argument('--warm-interval', type=float, default=600,
+                        help='Seconds between warming the most requested clips again, 0 to disable.')
+    parser.add_argument('--popularity-state',
+                        help='Path to a file keeping clip request counts across restarts.')
+    parser.add_argument('--thumbnail-cache',
+                        help='Directory for derived thumbnails, enables resizing and poster frames.')
+    parser.add_argument('--thumbnail-cache-mb', type=int, default=256,
+                        help='Size bound of the thumbnail cache, in MiB.')
+    parser.add_argument('--thumbnail-width', type=int, default=640,
+                        help='Width of derived thumbnails, in pixels.')
+    parser.add_argument('-j', '--jobs', type=int, default=2,
+                        help='Worker processes for background preprocessing.')
+    parser.add_argument('--job-state',
+                        help='Path to a job state file, so restarts resume unfinished jobs.')
+    parser.add_argument('--faststart-cache',
+                        help='Directory for faststart copies of clips with the moov box at the end.')
+    parser.add_argument('--faststart-cache-mb', type=int, default=16384,
+                        help='Size bound of the faststart cache, in MiB.')
+    parser.add_argument('--hls-cache',
+                        help='Directory for HLS segments, enables HLS streaming.')
+    parser.add_argument('--hls-cache-mb', type=int, default=1024,
+                        help='Size bound of the HLS segment cache, in MiB.')
+    parser.add_argument('--hls-segment-seconds', type=float, default=6.0,
+                        help='Target HLS segment duration.')
+    parser.add_argument('--log-level', choices=logs.LEVELS, default='info',
+                        help='Least severe log messages shown.')
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help='Watch the media location for changes (inotify, polling fallback).')
+    parser.add_argument('--watch-debounce', type=float, default=1.0,
+                        help='Seconds of quiet before a batch of changes is applied.')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('faststart', help='Write faststart copies of all clips that need one, then exit.')
+    return parser
+
+
+class TestSeriousServer(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls._server = SeriousServer(build_parser().parse_args(['-m', '../media']))
+
+    def _request(self, handler, headers=()):
+        """
+        Call a page handler with a fresh CherryPy request and response.
+        """
+        request = _cprequest.Request(httputil.Host('127.0.0.1', 80), httputil.Host('127.0.0.1', 1234))
+        response = _cprequest.Response()
+        cherrypy.serving.load(request, response)
+        request.headers = httputil.HeaderMap(headers)
+        body = handler()
+        return response.status, response.headers, body
+
+    def _wsgi(self, method, path, query):
+        """
+        (status, headers, body) of a request through the whole CherryPy
+        request pipeline.
+        """
+        environ = {'REQUEST_METHOD': method, 'PATH_INFO': path, 'QUERY_STRING': query}
+        wsgiref.util.setup_testing_defaults(environ)
+        started = []
+        body = b''.join(cherrypy.Application(self._server, '')(
+            environ, lambda status, headers, exc_info=None: started.append((status, dict(headers)))))
+        return started[0] + (body,)
+
+    def test_head(self):
+        size = os.path.getsize('../media/hello.txt')
+        status, headers, body = self._wsgi('HEAD', '/serve_content', 'fkey=hello.txt')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['Content-Length'], str(size))
+        self.assertEqual(body, b'')
+        _, headers, body = self._wsgi('GET', '/serve_content', 'fkey=hello.txt')
+        self.assertEqual(headers['Content-Length'], str(size))
+        self.assertEqual(len(body), size)
+
+    def test_etag(self):
+        status, headers, body = self._request(self._server.index)
+        self.assertIsNone(status)
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertIn(b'<html', body)
+        etag = headers['ETag']
+
+        status, headers, body = self._request(self._server.index, {'If-None-Match': etag})
+        self.assertEqual(status, 304)
+        self.assertEqual(body, b'')
+        self.assertEqual(headers['ETag'], etag)
+
+    def test_gzip(self):
+        _, plain_headers, plain = self._request(self._server.index)
+        status, headers, body = self._request(self._server.index, {'Accept-Encoding': 'gzip, deflate'})
+        self.assertIsNone(status)
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(plain_headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(gzip.decompress(body), plain)
+
+        # Each encoding only revalidates against its own ETag.
+        self.assertNotEqual(headers['ETag'], plain_headers['ETag'])
+        status, _, _ = self._request(self._server.index, {'If-None-Match': plain_headers['ETag'],
+                                                          'Accept-Encoding': 'gzip'})
+        self.assertIsNone(status)
+
+    def test_page_bounds(self):
+        total = len(self._server.get_media_library().get_clips())
+        for offset, limit in ((-1, 10), ('x', 10), (0, 0), (0, 'x')):
+            with self.assertRaises(cherrypy.HTTPError) as raised:
+                self._server.get_clip_feed_page(offset, limit)
+            self.assertEqual(raised.exception.status, 400)
+        with self.assertRaises(cherrypy.HTTPError):
+            self._server.get_search_page('donut', -1)
+        with self.assertRaises(cherrypy.HTTPError):
+            self._server.get_clip_feed_page(0, 10, 'nope')
+
+        feed = json.loads(self._server.get_clip_feed_page(0, MAX_PAGE_SIZE + 1).get_body(False))
+        self.assertEqual(feed['limit'], MAX_PAGE_SIZE)
+        self.assertEqual(len(feed['clips']), total)
+        self.assertIsNone(feed['next_offset'])
+        feed = json.loads(self._server.get_clip_feed_page(0, 1).get_body(False))
+        self.assertEqual((len(feed['clips']), feed['next_offset']), (1, 1))
+        feed = json.loads(self._server.get_clip_feed_page(total, 1).get_body(False))
+        self.assertEqual((feed['clips'], feed['next_offset']), ([], None))
+
+        # Past the last match, an empty page without a 'More' link.
+        self.assertIn(b'Moving donut.mp4', self._server.get_search_page('donut').get_body(False))
+        page = self._server.get_search_page('donut', 1).get_body(False)
+        self.assertNotIn(b'Moving donut.mp4', page)
+        self.assertNotIn(b'>More<', page)
+
+    def test_hls_uris(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            media = os.path.join(tmpdir, 'media')
+            os.mkdir(media)
+            # Not a valid clip name, but servable, and its b64 key
+            # holds a '+'.
+            with open('../media/Simple landscape flyover.mp4', 'rb') as src:
+                with open(os.path.join(media, 'ab>.mp4'), 'wb') as dst:
+                    dst.write(src.read())
+            server = SeriousServer(build_parser().parse_args(
+                ['-m', media, '--hls-cache', os.path.join(tmpdir, 'hls')]))
+            fkey = base64.b64encode(b'ab>.mp4').decode('ascii')
+            self.assertIn('+', fkey)
+
+            playlist = server.get_hls_playlist(fkey).get_body(False).decode('utf-8')
+            uris = [line for line in playlist.splitlines() if line.startswith('hls_segment')]
+            uris.append(playlist.split('URI="')[1].split('"')[0])
+            for uri in uris:
+                query = urllib.parse.parse_qs(urllib.parse.urlsplit(uri).query)
+                self.assertEqual(query['fkey'], [fkey])
+
+    def test_locate_content(self):
+        name = 'Moving donut.mp4'
+        fkey = base64.b64encode(name.encode('ascii')).decode('ascii')
+        path, clip = self._server._resolve_fkey(fkey)
+        self.assertEqual(path, os.path.abspath('../media/' + name))
+        self.assertIs(clip, self._server.get_media_library().get_clip_by_filename(name))
+        self.assertEqual(self._server._resolve_fkey('hello.txt'),
+                         (os.path.abspath('../media/hello.txt'), None))
+        self.assertEqual(self._server._resolve_fkey('../srv/srv_main.py'), (None, None))
+        self.assertEqual(self._server.locate_content(fkey), path)
+
+    def test_faststart_url(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            server = SeriousServer(build_parser().parse_args(['-m', '../media', '--faststart-cache', tmpdir]))
+            name = 'Simple landscape flyover.mp4'
+            fname = os.path.abspath('../media/' + name)
+            fkey = base64.b64encode(name.encode('ascii')).decode('ascii')
+            self.assertNotIn('&v=', server._content_url(name))
+
+            # The file itself, its copy made meanwhile.
+            self.assertEqual(server.locate_content(fkey), fname)
+            queue = server.get_job_queue()
+            queue.start()
+            self.assertTrue(queue.wait_idle(30))
+            queue.stop()
+
+            # The copy gets a URL of its own, the old one keeps
+            # serving the file.
+            url = server._content_url(name)
+            query = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query)
+            self.assertEqual(query['fkey'], [fkey])
+            self.assertEqual(server.locate_content(fkey), fname)
+            copy = server.locate_content(fkey, query['v'][0])
+            self.assertTrue(copy.startswith(tmpdir))
+            self.assertIn(url.replace('&', '&amp;'), server.render_fronter('landscape_clip'))
+            with self.assertRaises(cherrypy.HTTPRedirect):
+                server.locate_content(fkey, 'stale')
+
+if __name__ == '__main__':
+    parser = build_parser()
     args = parser.parse_args()
 
-    conf_static = {
-        '/': {
-                'tools.staticdir.on': True,
-                'tools.staticdir.dir': PATH,
-            },
-    }
+    if args.rebuild_catalog and args.catalog is None:
+        parser.error('--rebuild-catalog requires --catalog')
+
+    logs.configure(args.log_level)
+
+    if args.workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        parser.error('--workers needs SO_REUSEPORT, which this platform lacks')
+
+    if args.command == 'faststart':
+        if args.faststart_cache is None:
+            parser.error('faststart requires --faststart-cache')
+        run_faststart(args)
+        raise SystemExit(0)
 
     port = args.port
 
     if port < 1025 or port > 65530:
         raise ValueError("Bad port %d" % port)
 
-    conf_global = {'server.socket_port': port,
-                   'server.socket_host': '0.0.0.0' }
-    cherrypy.config.update(conf_global)
-
-    cherrypy.tree.mount(SeriousServer(args), '/') #, blog_conf)
-    cherrypy.tree.mount(Static(), '/static', conf_static)
-
-    cherrypy.engine.start()
-    cherrypy.engine.block()
+    if args.workers > 1:
+        run_workers(args)
+    else:
+        serve(SeriousServer(args), args)
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2019 Erik Mossberg
+
+This file is part of SeriousBusiness.
+
+SeriousBusiness is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+SeriousBusiness is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+import hashlib
+import io
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+from disk_cache import DiskCache
+import logs
+
+log = logs.get_logger('thumbnails')
+
+try:
+    from PIL import Image, features
+except ImportError:
+    Image = None
+    features = None
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif']
+VIDEO_EXTENSIONS = ['.mp4']
+
+
+def derive_key(source_fingerprint, width, fmt):
+    """
+    Cache key for a derived asset. Changes whenever the source file or
+    the derivation parameters do, so derived files are immutable.
+    """
+    desc = '%s|%d|%s' % ('-'.join(str(f) for f in source_fingerprint), width, fmt)
+    return hashlib.sha256(desc.encode('ascii')).hexdigest()[:32]
+
+
+def derive_file(source_path, path, width, fmt, ffmpeg=None):
+    """
+    Create the thumbnail for source_path at path. Returns whether it
+    was created. Safe to run in a worker process.
+    """
+    _, ext = os.path.splitext(source_path)
+    ext = ext.lower()
+    tmp_path = '%s.tmp%d.%d' % (path, os.getpid(), threading.get_ident())
+    try:
+        if ext in IMAGE_EXTENSIONS:
+            created = _resize_image(source_path, tmp_path, width, fmt)
+        elif ext in VIDEO_EXTENSIONS:
+            created = _extract_poster(source_path, tmp_path, width, fmt, ffmpeg)
+        else:
+            created = False
+        if created:
+            os.replace(tmp_path, path)
+        return created
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _resize_image(source_path, out_path, width, fmt, source=None):
+    if Image is None:
+        return False
+    try:
+        with Image.open(source or source_path) as img:
+            img.thumbnail((width, width * 4))
+            if fmt == 'jpeg' and img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+            img.save(out_path, format=fmt.upper(), quality=80)
+    except (OSError, ValueError) as ex:
+        log.warning("Failed to make thumbnail from '%s': %s", source_path, ex)
+        return False
+    return True
+
+
+def _extract_poster(source_path, out_path, width, fmt, ffmpeg):
+    if ffmpeg is None:
+        return False
+
+    # One second in, to skip black lead-in frames. Short clips fall
+    # back to the first frame.
+    for seek in ['1', '0']:
+        cmd = [ffmpeg, '-loglevel', 'error', '-y', '-ss', seek, '-i', source_path,
+               '-frames:v', '1', '-vf', 'scale=%d:-2' % width, '-f', 'image2pipe',
+               '-vcodec', 'png', '-']
+        try:
+            result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    timeout=30)
+        except (OSError, subprocess.TimeoutExpired) as ex:
+            log.warning("Failed to extract poster from '%s': %s", source_path, ex)
+            return False
+        if result.returncode == 0 and result.stdout:
+            break
+    else:
+        return False
+
+    if Image is None:
+        if fmt != 'png':
+            return False
+        with open(out_path, 'wb') as f:
+            f.write(result.stdout)
+        return True
+
+    return _resize_image(source_path, out_path, width, fmt, source=io.BytesIO(result.stdout))
+
+
+class ThumbnailService(object):
+
+    def __init__(self, cache_dir, max_bytes=256 * 1024 * 1024, width=640, fmt=None,
+                 ffmpeg='ffmpeg', shared=False):
+        """
+        Tile-sized thumbnails, derived once and kept in a
+        size-bounded on-disk cache.
+
+        Images are scaled down with Pillow, to WebP when Pillow supports
+        it and JPEG otherwise. Poster frames for .mp4 clips are
+        extracted with ffmpeg. Both are optional: without Pillow,
+        source images are used as they are, and without ffmpeg clips
+        have no poster. See DiskCache for shared.
+        """
+        self._width = width
+        if fmt is None:
+            fmt = 'webp' if Image is not None and features.check('webp') else 'jpeg'
+        self._fmt = fmt
+        self._ffmpeg = shutil.which(ffmpeg) if ffmpeg else None
+        self._cache = DiskCache(cache_dir, max_bytes, shared)
+
+    def can_derive(self, name):
+        """
+        Can a thumbnail be derived from this file name.
+        """
+        _, ext = os.path.splitext(name)
+        ext = ext.lower()
+        return ext in IMAGE_EXTENSIONS or (ext in VIDEO_EXTENSIONS and self._ffmpeg is not None)
+
+    def resizes_images(self):
+        """
+        Whether images get thumbnails, rather than being served as they
+        are. Needs Pillow.
+        """
+        return Image is not None
+
+    def get_key(self, source_fingerprint):
+        return derive_key(source_fingerprint, self._width, self._fmt)
+
+    def get_content_type(self):
+        return 'image/%s' % self._fmt
+
+    def _name_for(self, key):
+        return '%s.%s' % (key, self._fmt)
+
+    def find(self, source_fingerprint):
+        """
+        Path of the derived thumbnail for a source file if it is
+        cached, None otherwise. Never derives it.
+        """
+        return self._cache.find(self._name_for(self.get_key(source_fingerprint)))
+
+    def get_derive_args(self, source_path, source_fingerprint):
+        """
+        Arguments for derive_file() to create a thumbnail elsewhere,
+        e.g. in a worker process, or None if it is already cached.
+        Report the result with add_derived().
+        """
+        name = self._name_for(self.get_key(source_fingerprint))
+        if self._cache.contains(name):
+            return None
+        return (source_path, self._cache.path_for(name), self._width, self._fmt, self._ffmpeg)
+
+    def add_derived(self, key):
+        """
+        Take a thumbnail created by derive_file() into the cache.
+        """
+        self._cache.add(self._name_for(key))
+
+    def get_stats(self):
+        return self._cache.get_stats()
+
+
+class TestThumbnailService(unittest.TestCase):
+
+    def test_keys(self):
+        self.assertEqual(derive_key((1, 2, 3), 640, 'webp'), derive_key((1, 2, 3), 640, 'webp'))
+        self.assertNotEqual(derive_key((1, 2, 3), 640, 'webp'), derive_key((1, 2, 4), 640, 'webp'))
+        self.assertNotEqual(derive_key((1, 2, 3), 640, 'webp'), derive_key((1, 2, 3), 320, 'webp'))
+
+    @unittest.skipIf(Image is None, "Pillow not installed")
+    def test_resize_and_evict(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            source = '../media/landscape_thumb.png'
+            st = os.stat(source)
+            service = ThumbnailService(tmpdir, width=320, fmt='jpeg')
+
+            fingerprint = (st.st_ino, st.st_size, st.st_mtime_ns)
+            self.assertIsNone(service.find(fingerprint))
+            args = service.get_derive_args(source, fingerprint)
+            self.assertTrue(derive_file(*args))
+            service.add_derived(service.get_key(fingerprint))
+            self.assertIsNone(service.get_derive_args(source, fingerprint))
+
+            path = service.find(fingerprint)
+            self.assertLess(os.path.getsize(path), st.st_size)
+            with Image.open(path) as img:
+                self.assertEqual(img.size[0], 320)
+            # Lookups of thumbnails not derived yet are no misses.
+            self.assertEqual(service.get_stats()['misses'], 0)
+
+            # Reloaded from disk, then evicted once over budget.
+            size = os.path.getsize(path)
+            small = ThumbnailService(tmpdir, max_bytes=size + 1, width=320, fmt='jpeg')
+            self.assertEqual(small.get_stats()['entries'], 1)
+            derive_file(*small.get_derive_args(source, (0, 0, 0)))
+            small.add_derived(small.get_key((0, 0, 0)))
+            self.assertEqual(small.get_stats()['evictions'], 1)
+            self.assertFalse(os.path.exists(path))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+/* Super Basic Streaming Network Server: load more tiles on scroll. */
+(function () {
+  var more = document.getElementById('tilecon_more');
+  var tilecons = document.getElementById('tilecons');
+  if (!more || !tilecons || !window.fetch || !window.IntersectionObserver) {
+    return;
+  }
+
+  var offset = parseInt(more.dataset.offset, 10);
+  var limit = parseInt(more.dataset.limit, 10);
+  var sort = more.dataset.sort;
+  var loading = false;
+
+  function loadMore() {
+    if (loading || offset === null) {
+      return;
+    }
+    loading = true;
+    var url = './api/clips?offset=' + offset + '&limit=' + limit + '&sort=' + encodeURIComponent(sort);
+    fetch(url).then(function (response) {
+      return response.json();
+    }).then(function (feed) {
+      feed.clips.forEach(function (clip) {
+        tilecons.insertAdjacentHTML('beforeend', clip.tile);
+      });
+      offset = feed.next_offset;
+      if (offset === null) {
+        observer.disconnect();
+        more.remove();
+      }
+      loading = false;
+    }).catch(function () {
+      loading = false;
+    });
+  }
+
+  var observer = new IntersectionObserver(function (entries) {
+    if (entries[0].isIntersecting) {
+      loadMore();
+    }
+  }, {rootMargin: '1000px'});
+
+  more.innerHTML = '';
+  observer.observe(more);
+})();